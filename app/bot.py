@@ -74,7 +74,11 @@ async def main():
     bot = Bot(token=settings.bot_token, default=DefaultBotProperties(parse_mode="HTML"))
     dp = Dispatcher(storage=MemoryStorage())
 
-    rate_limit_mw = RateLimitLLM()
+    rate_limit_mw = RateLimitLLM(
+        settings.limits.rate_limit_seconds,
+        workers=settings.limits.max_concurrent_requests,
+    )
+    runtime.set_rate_limiter(rate_limit_mw)
     # Middlewares (внешние)
     dp.update.outer_middleware(MaintenanceMiddleware())
     dp.update.outer_middleware(SubscriptionGateMiddleware())
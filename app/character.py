@@ -1,6 +1,9 @@
 from __future__ import annotations
 
+import threading
+
 from app import storage
+from app.config import register_reload_hook
 
 CHAT_STYLE = (
     "Ты отвечаешь коротко (1–4 предложения), по делу, без лишней мета-болтовни. "
@@ -9,14 +12,47 @@ CHAT_STYLE = (
     "если ответ состоит из нескольких сообщений — каждую часть заключай в свои маркеры."
 )
 
+# (char_id, mode) -> (версия персонажа, готовая строка). Пока персонаж не
+# менялся, отдаём один и тот же объект str: префикс запроса к провайдеру
+# остаётся байт-в-байт одинаковым и попадает в его кэш.
+_prompt_cache: dict[tuple[int, str], tuple[int, str]] = {}
+_prompt_lock = threading.Lock()
+
+
+def invalidate_prompts(_settings=None) -> None:
+    """Drop all compiled prompts (also registered as a config reload hook)."""
+    with _prompt_lock:
+        _prompt_cache.clear()
+
+
+register_reload_hook(invalidate_prompts)
+
 
 def get_system_prompt_for_chat(chat_id: int) -> str:
     """
     Собираем system-подсказку из карточки персонажа + стилистика для чата (если нужно).
     """
     ch = storage.get_chat(chat_id) or {}
-    char = storage.get_character(int(ch.get("char_id"))) if ch else None
     mode = (ch.get("mode") or "rp").lower()
+    if not ch:
+        return _build_prompt(None, mode)
+    char_id = int(ch["char_id"])
+    key = (char_id, mode)
+    version = storage.character_version(char_id)
+    with _prompt_lock:
+        hit = _prompt_cache.get(key)
+        if hit is not None and hit[0] == version:
+            return hit[1]
+    prompt = _build_prompt(storage.get_character(char_id), mode)
+    with _prompt_lock:
+        hit = _prompt_cache.get(key)
+        if hit is not None and hit[0] == version:
+            return hit[1]  # параллельный вызов успел раньше — отдаём его объект
+        _prompt_cache[key] = (version, prompt)
+    return prompt
+
+
+def _build_prompt(char: dict | None, mode: str) -> str:
     parts = []
     if char:
         if char.get("prompt"):
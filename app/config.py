@@ -75,6 +75,57 @@ class LimitsConfig(BaseModel):
     auto_compress_default: bool = True
 
 
+class StorageConfig(BaseModel):
+    # SQLite: один писатель + пул соединений только для чтения (WAL)
+    read_pool_size: int = 4
+    busy_timeout_ms: int = 5000
+    # отложенная запись малоценных полей/логов: сброс раз в N мс или по M строк
+    write_behind_ms: int = 200
+    write_behind_rows: int = 500
+    # кэш строк users (LRU + TTL)
+    user_cache_size: int = 10000
+    user_cache_ttl_s: float = 30.0
+    # кэш метаданных чатов (get_chat)
+    chat_cache_size: int = 5000
+    # хвост последних сообщений активных чатов в памяти
+    tail_size: int = 50
+    tail_cache_bytes: int = 8 * 1024 * 1024
+    # фоновая доиндексация messages_fts: строк за один шаг
+    fts_backfill_batch: int = 2000
+    # шардирование данных пользователей по N файлам (хэш tg_id); персонажи —
+    # в общем файле db_path. Число шардов задаётся до первого запуска
+    shards: int = 1
+    # история сообщений (messages, FTS, архив) — в отдельном файле со своим
+    # писателем, чтобы биллинг не ждал записи сообщений
+    split_history: bool = False
+    # пачка строк для backfill-шагов миграций схемы
+    migrate_batch: int = 5000
+    # пачка пользователей на одну транзакцию в ночных массовых задачах
+    bulk_chunk_rows: int = 1000
+    # резерв баланса на ход диалога (reserve/settle) истекает через N секунд,
+    # если процесс упал и ход так и не завершился
+    hold_ttl_s: int = 600
+    # архив холодных чатов: через сколько дней простоя и сегменты по N сообщений
+    archive_after_days: float = 30
+    archive_segment_rows: int = 500
+    # сроки хранения журналов в днях (0 — хранить всегда); token_log старше
+    # срока сворачивается в помесячные итоги
+    token_log_keep_days: float = 180
+    log_keep_days: float = 90
+    plan_keep_days: float = 7
+    # сколько свободных страниц возвращать ОС за один шаг incremental_vacuum
+    vacuum_pages: int = 2000
+    # горячие копии: каталог (пусто — backups/ рядом с базой), период, сколько
+    # хранить, страниц за шаг и пауза между шагами; свежая копия служит
+    # репликой для /stats, пока она не старше snapshot_max_age_h
+    backup_dir: str = ""
+    backup_interval_h: float = 6
+    backup_keep: int = 3
+    backup_pages: int = 256
+    backup_pause_ms: int = 5
+    snapshot_max_age_h: float = 24
+
+
 class PayOption(BaseModel):
     tokens: int
     emoji: str | None = None
@@ -153,6 +204,9 @@ class Settings(BaseSettings):
     # Limits grouping
     limits: LimitsConfig = Field(default_factory=LimitsConfig)
 
+    # Storage tuning
+    storage: StorageConfig = Field(default_factory=StorageConfig)
+
     # Flags
     global_typing_enabled: bool = True
 
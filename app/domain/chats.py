@@ -22,6 +22,16 @@ DEFAULT_TOKENS_LIMIT = 700
 DEFAULT_CHAR_LIMIT = 900
 
 
+def _aio():
+    """Async view of ``storage`` (wraps a substituted storage object too)."""
+    aio = getattr(storage, "aio", None)
+    if aio is None:
+        from app.storage import AsyncStorage
+
+        aio = AsyncStorage(storage)
+    return aio
+
+
 def _size_caps(resp_size: str) -> tuple[int, int]:
     """Return token/char caps for a given ``resp_size`` value.
 
@@ -84,6 +94,7 @@ class ChatReply:
     usage_out: int = 0
     billed: int = 0
     deficit: int = 0
+    message_id: int = 0
 
 
 def _approx_tokens(text: str) -> int:
@@ -99,33 +110,40 @@ async def _collect_context(
     limit: int = 50,
     query: str | None = None,
 ) -> list[dict]:
-    msgs = storage.list_messages(chat_id, limit=limit)
+    # последняя контрольная точка + сообщения после неё
+    cp = await _aio().latest_checkpoint(chat_id)
+    msgs = await _aio().list_messages(
+        chat_id, limit=limit, after_id=cp["upto_message_id"] if cp else None
+    )
     seen_ids = {m["id"] for m in msgs}
-    res: list[dict] = []
+    history: list[dict] = []
     for m in msgs:
         role = "user" if m["is_user"] else "assistant"
-        res.append(dict(role=role, content=m["content"]))
+        history.append(dict(role=role, content=m["content"]))
 
     from app import character as _character
 
     if getattr(_character, "storage", None) is not storage:  # pragma: no cover - test hook
         _character.storage = storage  # type: ignore
 
-    system_prompt = _character.get_system_prompt_for_chat(chat_id)
-    res = [dict(role="system", content=system_prompt)] + res
+    system_prompt = await _aio().run(_character.get_system_prompt_for_chat, chat_id)
+    res = [dict(role="system", content=system_prompt)]
+    if cp:
+        res.append(dict(role="system", content=cp["summary"]))
+    res += history
 
     threshold = int(settings.limits.context_threshold_tokens or 0)
     total_tokens = sum(_approx_tokens(m["content"]) for m in res)
     if threshold and total_tokens > threshold:
         summary = await summarize_chat(chat_id, model=model)
 
-        storage.compress_history(
+        await _aio().compress_history(
             chat_id,
             summary.text,
             usage_in=summary.usage_in,
             usage_out=summary.usage_out,
         )
-        _apply_billing(
+        await _apply_billing(
             user_id,
             chat_id,
             model,
@@ -135,13 +153,13 @@ async def _collect_context(
         )
 
 
-        tail = res[1:][-20:]
+        tail = history[-20:]
         res = [
             dict(role="system", content=system_prompt),
             dict(role="system", content=summary.text),
         ] + tail
     if query:
-        for m in storage.search_messages(chat_id, query, limit=5):
+        for m in await _aio().search_messages(chat_id, query, limit=5):
             if m["id"] in seen_ids:
                 continue
             role = "user" if m["is_user"] else "assistant"
@@ -156,7 +174,7 @@ def _safe_trim(text: str, char_limit: int) -> str:
     cut = t[:char_limit]
     pos = max(cut.rfind("."), cut.rfind("!"), cut.rfind("?"))
     return (cut if pos < 40 else cut[:pos + 1]).rstrip()
-def _apply_billing(
+async def _apply_billing(
     user_id: int,
     chat_id: int,
     model: str,
@@ -167,16 +185,30 @@ def _apply_billing(
     cached_tokens: int = 0,
 ) -> tuple[int, int]:
     """Возвращает (billed, deficit)."""
-    billed = usage_to_toki(model, usage_in, usage_out, cached_tokens)
-    billed = int(math.ceil(billed * settings.toki_spend_coeff))
-    _spent_free, _spent_paid, deficit = storage.spend_tokens(user_id, billed)
+    billed = _billed_toki(model, usage_in, usage_out, cached_tokens)
+    _spent_free, _spent_paid, deficit = await _aio().spend_tokens(user_id, billed)
     return billed, deficit
 
 
+def _billed_toki(model: str, usage_in: int, usage_out: int, cached_tokens: int) -> int:
+    billed = usage_to_toki(model, usage_in, usage_out, cached_tokens)
+    return int(math.ceil(billed * settings.toki_spend_coeff))
+
+
+def _estimate_billing(model: str, text: str, max_tokens: int, cached_tokens: int) -> int:
+    """Expected cost of a turn to reserve: the new message plus a full reply."""
+    est = usage_to_toki(model, cached_tokens + _approx_tokens(text), max_tokens, cached_tokens)
+    return max(1, int(math.ceil(est * settings.toki_spend_coeff)))
+
+
 
 async def summarize_chat(chat_id: int, *, model: str, sentences: int = 4) -> ChatReply:
-    msgs = storage.list_messages(chat_id, limit=40)
-    parts: list[str] = []
+    cp = await _aio().latest_checkpoint(chat_id)
+    msgs = await _aio().list_messages(
+        chat_id, limit=40, after_id=cp["upto_message_id"] if cp else None
+    )
+    # новая сводка продолжает предыдущую
+    parts: list[str] = [f"Summary: {cp['summary']}"] if cp else []
     for m in msgs[-20:]:
         who = "User" if m["is_user"] else "Assistant"
         parts.append(f"{who}: {m['content']}")
@@ -202,18 +234,20 @@ async def summarize_chat(chat_id: int, *, model: str, sentences: int = 4) -> Cha
 async def _maybe_compress_history(user_id: int, chat_id: int, model: str) -> None:
     if not settings.limits.auto_compress_default:
         return
-    msgs = storage.list_messages(chat_id)
-    approx_tokens = sum(len(m["content"]) for m in msgs) // 4
+    cp = await _aio().latest_checkpoint(chat_id)
+    msgs = await _aio().list_messages(chat_id, after_id=cp["upto_message_id"] if cp else None)
+    approx_tokens = (len(cp["summary"]) if cp else 0) + sum(len(m["content"]) for m in msgs)
+    approx_tokens //= 4
     if approx_tokens <= int(settings.limits.context_threshold_tokens or 0):
         return
     summary = await summarize_chat(chat_id, model=model)
-    storage.compress_history(
+    await _aio().compress_history(
         chat_id,
         summary.text,
         usage_in=summary.usage_in,
         usage_out=summary.usage_out,
     )
-    _apply_billing(
+    await _apply_billing(
         user_id,
         chat_id,
         model,
@@ -224,39 +258,53 @@ async def _maybe_compress_history(user_id: int, chat_id: int, model: str) -> Non
 
 
 async def chat_turn(user_id: int, chat_id: int, text: str) -> ChatReply:
-    user = storage.get_user(user_id) or {}
-    storage.get_chat(chat_id)  # ensure chat exists
+    db = _aio()
+    user = await db.get_user(user_id) or {}
+    await db.get_chat(chat_id)  # ensure chat exists
     toks_limit, char_limit = DEFAULT_TOKENS_LIMIT, DEFAULT_CHAR_LIMIT
     model = (user.get("default_model") or settings.default_model)
-    cached_tokens = storage.get_cached_tokens(chat_id)
+    cached_tokens = await db.get_cached_tokens(chat_id)
 
-    balance = int(user.get("free_toki") or 0) + int(user.get("paid_tokens") or 0)
-    if balance <= 0:
+    # резерв вместо чтения баланса: параллельный ход не потратит его же
+    hold = await db.reserve(user_id, _estimate_billing(model, text, toks_limit, cached_tokens))
+    if hold is None:
         return ChatReply(
             text="⚠ Баланс токенов на нуле. Пополните баланс, чтобы продолжить комфортно.",
             deficit=1,
         )
 
-    await _maybe_compress_history(user_id, chat_id, model)
+    try:
+        await _maybe_compress_history(user_id, chat_id, model)
 
-    messages = await _collect_context(
-        chat_id, user_id=user_id, model=model, query=text
-    )
+        messages = await _collect_context(
+            chat_id, user_id=user_id, model=model, query=text
+        )
 
-    messages += [dict(role="user", content=text)]
-    r = await provider_chat(
-        model=model,
-        messages=messages,
-        temperature=0.7,
-        max_tokens=toks_limit,
-        timeout_s=settings.limits.request_timeout_seconds,
-    )
+        messages += [dict(role="user", content=text)]
+        r = await provider_chat(
+            model=model,
+            messages=messages,
+            temperature=0.7,
+            max_tokens=toks_limit,
+            timeout_s=settings.limits.request_timeout_seconds,
+        )
+    except BaseException:
+        await db.release(hold)
+        raise
     out_text = _safe_trim(r.text, char_limit)
 
     usage_in = int(r.usage_in or 0)
     usage_out = int(r.usage_out or 0)
-    billed, deficit = _apply_billing(
-        user_id, chat_id, model, usage_in, usage_out, cached_tokens=cached_tokens
+    billed = _billed_toki(model, usage_in, usage_out, cached_tokens)
+    # списание, ответ и cached_tokens — одной транзакцией
+    message_id, deficit = await db.turn_commit(
+        chat_id,
+        out_text,
+        usage_in=usage_in,
+        usage_out=usage_out,
+        billed=billed,
+        reservation=hold,
+        model=model,
     )
     if deficit > 0:
         return ChatReply(
@@ -267,14 +315,13 @@ async def chat_turn(user_id: int, chat_id: int, text: str) -> ChatReply:
             deficit=deficit,
         )
 
-    storage.set_cached_tokens(chat_id, usage_in + usage_out)
-
     return ChatReply(
         text=out_text,
         usage_in=usage_in,
         usage_out=usage_out,
         billed=billed,
         deficit=deficit,
+        message_id=message_id,
     )
 
 
@@ -282,18 +329,22 @@ async def chat_turn(user_id: int, chat_id: int, text: str) -> ChatReply:
 async def live_stream(user_id: int, chat_id: int, text: str) -> AsyncGenerator[dict[str, str], None]:
     """
     Live-режим: отдаём сырые дельты текста + финальные usage.
-    Хендлер агрегирует в буфер и нарезает на сообщения.
+    Хендлер агрегирует в буфер и нарезает на сообщения. Финал с
+    ``reservation`` передаёт хендлеру резерв хода: он сам фиксирует ход
+    через ``storage.turn_commit`` с итоговым текстом и суммой ``billed``.
     """
-    user = storage.get_user(user_id) or {}
-    ch = storage.get_chat(chat_id) or {}
+    db = _aio()
+    user = await db.get_user(user_id) or {}
+    ch = await db.get_chat(chat_id) or {}
     resp_size = (ch.get("resp_size") or "auto")
     toks_limit, _ = _size_caps(str(resp_size))
     model = (user.get("default_model") or settings.default_model)
 
-    cached_tokens = storage.get_cached_tokens(chat_id)
+    cached_tokens = await db.get_cached_tokens(chat_id)
 
-    balance = int(user.get("free_toki") or 0) + int(user.get("paid_tokens") or 0)
-    if balance <= 0:
+    # резерв вместо чтения баланса: параллельный ход не потратит его же
+    hold = await db.reserve(user_id, _estimate_billing(model, text, toks_limit, cached_tokens))
+    if hold is None:
         yield {
             "kind": "final",
             "text": "⚠ Баланс токенов на нуле. Пополните баланс, чтобы продолжить комфортно.",
@@ -304,66 +355,54 @@ async def live_stream(user_id: int, chat_id: int, text: str) -> AsyncGenerator[d
         }
         return
 
-
-    await _maybe_compress_history(user_id, chat_id, model)
+    settled = False
+    try:
+        await _maybe_compress_history(user_id, chat_id, model)
 
 
-    messages = await _collect_context(
-        chat_id, user_id=user_id, model=model, query=text
-    )
+        messages = await _collect_context(
+            chat_id, user_id=user_id, model=model, query=text
+        )
 
-    messages += [dict(role="user", content=text)]
-    try:
-        async for ev in provider_stream(
-            model=model,
-            messages=messages,
-            temperature=0.7,
-            max_tokens=toks_limit,
-            timeout_s=settings.limits.request_timeout_seconds,
-        ):
-            if ev.get("type") == "delta":
-                yield {"kind": "chunk", "text": ev.get("text") or ""}
-            elif ev.get("type") == "usage":
-                usage_in = int(ev.get("in") or 0)
-                usage_out = int(ev.get("out") or 0)
-                billed, deficit = _apply_billing(
-                    user_id,
-                    chat_id,
-                    model,
-                    usage_in,
-                    usage_out,
-                    cached_tokens=cached_tokens,
-                )
-                if deficit > 0:
-                    yield {
-                        "kind": "final",
-                        "text": "⚠ Баланс токенов на нуле. Пополните баланс, чтобы продолжить комфортно.",
-                        "usage_in": str(usage_in),
-                        "usage_out": str(usage_out),
-                        "billed": str(billed),
-                        "deficit": str(deficit),
-                    }
-                else:
-                    storage.set_cached_tokens(chat_id, usage_in + usage_out)
+        messages += [dict(role="user", content=text)]
+        try:
+            async for ev in provider_stream(
+                model=model,
+                messages=messages,
+                temperature=0.7,
+                max_tokens=toks_limit,
+                timeout_s=settings.limits.request_timeout_seconds,
+            ):
+                if ev.get("type") == "delta":
+                    yield {"kind": "chunk", "text": ev.get("text") or ""}
+                elif ev.get("type") == "usage" and not settled:
+                    usage_in = int(ev.get("in") or 0)
+                    usage_out = int(ev.get("out") or 0)
+                    settled = True  # резерв уходит хендлеру вместе с финалом
+                    billed = _billed_toki(model, usage_in, usage_out, cached_tokens)
                     yield {
                         "kind": "final",
                         "usage_in": str(usage_in),
                         "usage_out": str(usage_out),
                         "billed": str(billed),
-                        "deficit": str(deficit),
+                        "reservation": str(hold),
                     }
 
-    except Exception:
-        logger.exception("live_stream failed")
-        storage.set_user_chatting(user_id, False)
-        yield {
-            "kind": "final",
-            "text": "⚠ Что-то пошло не так. Попробуйте ещё раз.",
-            "usage_in": "0",
-            "usage_out": "0",
-            "billed": "0",
-            "deficit": "0",
-        }
+        except Exception:
+            logger.exception("live_stream failed")
+            await db.set_user_chatting(user_id, False)
+            yield {
+                "kind": "final",
+                "text": "⚠ Что-то пошло не так. Попробуйте ещё раз.",
+                "usage_in": "0",
+                "usage_out": "0",
+                "billed": "0",
+                "deficit": "0",
+            }
+    finally:
+        # ход без usage (ошибка, обрыв стрима) ничего не списывает
+        if not settled:
+            await db.release(hold)
 
 
 async def chat_stream(user_id: int, chat_id: int, text: str):
@@ -154,5 +154,33 @@ async def cmd_stats(msg: Message):
             uname = r.get('username') or str(r['user_id'])
             lines.append(f"{uname}: {r['cnt']}")
 
+    taken = storage.snapshot_taken_at()
+    if taken:
+        lines.append(f"\n<i>Данные на {taken:%Y-%m-%d %H:%M} UTC (копия)</i>")
+
     await msg.answer("\n".join(lines))
 
+
+@router.message(Command("backup"))
+async def cmd_backup(msg: Message):
+    if not await _require_admin(msg):
+        return
+    path = await storage.aio.backup()
+    await msg.answer(f"Копия сохранена: <code>{path.name}</code>")
+
+
+@router.message(Command("rebuild_counters"))
+async def cmd_rebuild_counters(msg: Message):
+    if not await _require_admin(msg):
+        return
+    parts = (msg.text or "").split()
+    uid = None
+    if len(parts) > 1:
+        try:
+            uid = int(parts[1])
+        except ValueError:
+            return await msg.answer("Использование: /rebuild_counters [user_id]")
+    n = await storage.aio.rebuild_user_counters(uid)
+    await storage.aio.rebuild_user_char_stats(uid)
+    await msg.answer(f"Счётчики пересчитаны: {n}")
+
@@ -32,7 +32,7 @@ def _balance_text(user_id: int) -> str:
             amt = int(r["amount"])
             sign = "+" if amt > 0 else ""
             meta = r.get("meta") or ""
-            dt_str = str(r.get("created_at"))[:16]
+            dt_str = storage.ts_text(r.get("created_at"), "%Y-%m-%d %H:%M")
             lines.append(f"{dt_str} {sign}{amt} {meta}")
     lines.append("")
     lines.append("Доступно: /promo CODE — активировать промокод")
@@ -12,6 +12,7 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from app import storage
 from app.config import BASE_DIR
+from app.utils.paging import page_nav_data, parse_page_data, total_pages
 from app.utils.telegram import safe_edit_text
 
 router = Router(name="characters")
@@ -48,9 +49,10 @@ def _photo_input_for_char(ch: dict):
 
 
 
-def _char_card_kb(user_id: int, char_id: int) -> InlineKeyboardBuilder:
-    has_chats = bool(storage.list_user_chats_by_char(user_id, char_id, limit=1))
-    is_fav = storage.is_fav_char(user_id, char_id)
+async def _char_card_kb(user_id: int, char_id: int) -> InlineKeyboardBuilder:
+    st = await storage.aio.get_user_char_stats(user_id, char_id)
+    has_chats = int(st["chat_count"]) > 0
+    is_fav = bool(st["is_fav"])
 
     kb = InlineKeyboardBuilder()
     # 1 строка
@@ -113,7 +115,7 @@ async def open_character_card(
     as_new_message: bool = False,
 ):
     user_id = message_or_call.from_user.id
-    ch = storage.get_character(char_id)
+    ch = await storage.aio.get_character(char_id)
     if not ch:
         if isinstance(message_or_call, CallbackQuery):
             return await message_or_call.answer("Персонаж не найден", show_alert=True)
@@ -125,11 +127,11 @@ async def open_character_card(
             for ext in ("jpg", "png"):
                 fp = media_dir / f"{slug}.{ext}"
                 if fp.exists():
-                    storage.set_character_photo_path(char_id, fp.as_posix())
+                    await storage.aio.set_character_photo_path(char_id, fp.as_posix())
                     ch["photo_path"] = fp.as_posix()
                     break
 
-    kb = _char_card_kb(user_id, char_id)
+    kb = await _char_card_kb(user_id, char_id)
     caption = _char_card_caption(ch)
     media = _photo_input_for_char(ch)
 
@@ -147,15 +149,21 @@ async def characters_menu(msg: Message):
     await show_characters_page(msg, page=1)
 
 
-def _chars_page_kb(user_id: int, page: int):
+async def _chars_page_kb(user_id: int, page: int, direction: str | None = None, key=None):
     from app.config import settings
 
-    u = storage.get_user(user_id) or {}
+    u = await storage.aio.get_user(user_id) or {}
     sub = (u.get("subscription") or "free").lower()
     limits = getattr(settings.subs, sub, settings.subs.free)
-    rows = storage.list_characters_for_user(
-        user_id, page=page, page_size=limits.chars_page_size
-    )
+    size = limits.chars_page_size
+    pages = total_pages(await storage.aio.count_characters(), size, limits.chars_pages_max)
+    page = min(page, pages)
+    if direction == "n":
+        rows = await storage.aio.list_characters_for_user(user_id, page_size=size, after=key)
+    elif direction == "p":
+        rows = await storage.aio.list_characters_for_user(user_id, page_size=size, before=key)
+    else:
+        rows = await storage.aio.list_characters_for_user(user_id, page=page, page_size=size)
 
     kb = InlineKeyboardBuilder()
     for row in rows:
@@ -163,22 +171,24 @@ def _chars_page_kb(user_id: int, page: int):
         # В тексте кнопки HTML не парсится — экранировать не обязательно
         kb.button(text=f"{mark}{row['name']}", callback_data=f"char:open:{row['id']}")
 
-    # пагинация снизу (макс pages_max)
+    # пагинация снизу: реальное число страниц, но не больше pages_max
     nav = InlineKeyboardBuilder()
-    if page > 1:
-        nav.button(text="←", callback_data=f"chars:page:{page-1}")
-    nav.button(text=f"{page}/{limits.chars_pages_max}", callback_data="chars:noop")
-    if page < limits.chars_pages_max:
-        nav.button(text="→", callback_data=f"chars:page:{page+1}")
+    if page > 1 and rows:
+        nav.button(text="←", callback_data=page_nav_data("chars", page - 1, "p", storage.character_key(rows[0])))
+    nav.button(text=f"{page}/{pages}", callback_data="chars:noop")
+    if page < pages and len(rows) == size:
+        nav.button(text="→", callback_data=page_nav_data("chars", page + 1, "n", storage.character_key(rows[-1])))
 
     kb.row(*nav.buttons)
     kb.adjust(1)
     return kb
 
 
-async def show_characters_page(msg_or_call: Message | CallbackQuery, page: int):
+async def show_characters_page(
+    msg_or_call: Message | CallbackQuery, page: int, direction: str | None = None, key=None
+):
     user_id = msg_or_call.from_user.id
-    kb = _chars_page_kb(user_id, page)
+    kb = await _chars_page_kb(user_id, page, direction, key)
     text = "Выберите персонажа:"
     if isinstance(msg_or_call, CallbackQuery):
         await safe_edit_text(msg_or_call.message, text, callback=msg_or_call, reply_markup=kb.as_markup())
@@ -197,11 +207,11 @@ async def cb_chars_menu(call: CallbackQuery):
 
 @router.callback_query(F.data.startswith("chars:page:"))
 async def cb_chars_page(call: CallbackQuery):
-    parts = call.data.split(":")
-    if len(parts) < 3 or not parts[2].isdigit():
+    parsed = parse_page_data(call.data)
+    if parsed is None:
         return await call.answer("Некорректные данные", show_alert=True)
-    page = int(parts[2])
-    await show_characters_page(call, page=page)
+    page, direction, key = parsed
+    await show_characters_page(call, page=page, direction=direction, key=key)
 
 
 @router.callback_query(F.data.startswith("char:open:"))
@@ -221,14 +231,14 @@ async def cb_char_fav(call: CallbackQuery):
     if len(parts) < 3 or not parts[2].isdigit():
         return await call.answer("Некорректные данные", show_alert=True)
     char_id = int(parts[2])
-    u = storage.get_user(call.from_user.id) or {}
+    u = await storage.aio.get_user(call.from_user.id) or {}
     sub = (u.get("subscription") or "free").lower()
     limits = getattr(settings.subs, sub, settings.subs.free)
 
-    ok = storage.toggle_fav_char(
+    ok = await storage.aio.toggle_fav_char(
         call.from_user.id, char_id, allow_max=limits.fav_chars_max
     )
-    if not ok and not storage.is_fav_char(call.from_user.id, char_id):
+    if not ok and not await storage.aio.is_fav_char(call.from_user.id, char_id):
         await call.answer("Достигнут лимит избранных персонажей", show_alert=True)
 
     await open_character_card(call, char_id=char_id)
@@ -241,7 +251,7 @@ async def cb_char_new(call: CallbackQuery):
         return await call.answer("Некорректные данные", show_alert=True)
     char_id = int(parts[2])
     await call.answer("Создаю чат…")
-    chat_id = storage.create_chat(call.from_user.id, char_id)
+    chat_id = await storage.aio.create_chat(call.from_user.id, char_id)
     from app.handlers.chats import open_chat_inline
 
     asyncio.create_task(open_chat_inline(call, chat_id=chat_id))
@@ -254,7 +264,7 @@ async def cb_char_cont(call: CallbackQuery):
     if len(parts) < 3 or not parts[2].isdigit():
         return await call.answer("Некорректные данные", show_alert=True)
     char_id = int(parts[2])
-    rows = storage.list_user_chats_by_char(call.from_user.id, char_id, limit=1)
+    rows = await storage.aio.list_user_chats_by_char(call.from_user.id, char_id, limit=1)
     if not rows:
         await call.answer("Нет чатов с персонажем", show_alert=True)
         return
@@ -269,7 +279,7 @@ async def cb_char_chats(call: CallbackQuery):
     if len(parts) < 3 or not parts[2].isdigit():
         return await call.answer("Некорректные данные", show_alert=True)
     char_id = int(parts[2])
-    rows = storage.list_user_chats_by_char(call.from_user.id, char_id, limit=10)
+    rows = await storage.aio.list_user_chats_by_char(call.from_user.id, char_id, limit=10)
     if not rows:
         await call.answer("Чатов пока нет.", show_alert=True)
         return await open_character_card(call, char_id=char_id)
@@ -283,7 +293,7 @@ async def cb_char_chats(call: CallbackQuery):
     kb.button(text="⬅ Назад", callback_data=f"char:open:{char_id}")
     kb.adjust(1)
 
-    ch = storage.get_character(char_id)
+    ch = await storage.aio.get_character(char_id)
     title = _esc(ch["name"]) if ch else "персонажем"
     await safe_edit_text(call.message, f"Чаты с {title}:", callback=call, reply_markup=kb.as_markup())
     await call.answer()
@@ -295,21 +305,12 @@ async def cb_char_settings(call: CallbackQuery):
     if len(parts) < 3 or not parts[2].isdigit():
         return await call.answer("Некорректные данные", show_alert=True)
     char_id = int(parts[2])
-    ch = storage.get_character(char_id)
+    ch = await storage.aio.get_character(char_id)
     if not ch:
         return await call.answer("Персонаж не найден", show_alert=True)
 
-    rows = storage.query(
-        """
-        SELECT COUNT(*) AS c
-          FROM messages m
-          JOIN chats c ON c.id=m.chat_id
-         WHERE c.user_id=? AND c.char_id=?
-        """,
-        (call.from_user.id, char_id),
-    )
-    r = rows[0] if rows else None
-    cnt = int(r["c"] or 0)
+    st = await storage.aio.get_user_char_stats(call.from_user.id, char_id)
+    cnt = int(st["message_count"])
 
 
     kb = InlineKeyboardBuilder()
@@ -317,7 +318,7 @@ async def cb_char_settings(call: CallbackQuery):
         text=f"📊 Сообщений с { _esc(ch['name']) }: {cnt}", callback_data="char:noop"
     )
     # «Убрать персонажа из сохранённых» — это «снять из избранного»
-    if storage.is_fav_char(call.from_user.id, char_id):
+    if st["is_fav"]:
         kb.button(text="🗑 Убрать из избранных", callback_data=f"char:fav:{char_id}")
     kb.button(text="⬅ Назад", callback_data=f"char:open:{char_id}")
     kb.adjust(1)
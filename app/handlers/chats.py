@@ -104,6 +104,7 @@ except Exception:  # pragma: no cover
 from app.config import settings
 from app.domain.chats import chat_turn, chat_stream, summarize_chat
 from app.scheduler import schedule_silence_check
+from app.utils.paging import page_nav_data, parse_page_data, total_pages
 from app.utils.telegram import safe_edit_text
 
 logger = logging.getLogger(__name__)
@@ -129,39 +130,63 @@ def _storage() -> "storage_module":
         storage = storage_module
     return storage
 
+
+def _aio():
+    """Async view of :func:`_storage` (wraps a substituted storage object too)."""
+    st = _storage()
+    aio = getattr(st, "aio", None)
+    if aio is None:
+        from app.storage import AsyncStorage
+
+        aio = AsyncStorage(st)
+    return aio
+
 class ChatSG(StatesGroup):
     chatting = State()
     importing = State()
 
-def _limits_for(user_id: int):
-    u = _storage().get_user(user_id) or {}
+async def _limits_for(user_id: int):
+    u = await _aio().get_user(user_id) or {}
     sub = (u.get("subscription") or "free").lower()
     limits = getattr(settings.subs, sub, settings.subs.free)
     return limits
 
 
-def chats_page_kb(user_id: int, page: int):
-    lim = _limits_for(user_id)
-    rows = _storage().list_user_chats(user_id, page=page, page_size=lim.chats_page_size)
+async def chats_page_kb(user_id: int, page: int, direction: str | None = None, key=None):
+    st = _storage()
+    aio = _aio()
+    lim = await _limits_for(user_id)
+    size = lim.chats_page_size
+    pages = total_pages(await aio.count_user_chats(user_id), size, lim.chats_pages_max)
+    page = min(page, pages)
+    # курсор из callback: страница — один проход по индексу от ключа
+    if direction == "n":
+        rows = await aio.list_user_chats(user_id, page_size=size, after=key)
+    elif direction == "p":
+        rows = await aio.list_user_chats(user_id, page_size=size, before=key)
+    else:
+        rows = await aio.list_user_chats(user_id, page=page, page_size=size)
     kb = InlineKeyboardBuilder()
     for r in rows:
         label = f"{r['seq_no']} — {r['char_name']}"
         kb.button(text=label, callback_data=f"chat:open:{r['id']}")
-    # пагинация (макс pages_max)
+    # пагинация: реальное число страниц, но не больше pages_max
     nav = InlineKeyboardBuilder()
-    if page > 1:
-        nav.button(text="←", callback_data=f"chats:page:{page-1}")
-    nav.button(text=f"{page}/{lim.chats_pages_max}", callback_data="chats:noop")
-    if page < lim.chats_pages_max:
-        nav.button(text="→", callback_data=f"chats:page:{page+1}")
+    if page > 1 and rows:
+        nav.button(text="←", callback_data=page_nav_data("chats", page - 1, "p", st.chat_key(rows[0])))
+    nav.button(text=f"{page}/{pages}", callback_data="chats:noop")
+    if page < pages and len(rows) == size:
+        nav.button(text="→", callback_data=page_nav_data("chats", page + 1, "n", st.chat_key(rows[-1])))
     kb.row(*nav.buttons)
     kb.adjust(1)
     return kb
 
 
-async def list_chats(msg_or_call: Message | CallbackQuery, page: int = 1):
+async def list_chats(
+    msg_or_call: Message | CallbackQuery, page: int = 1, direction: str | None = None, key=None
+):
     user_id = msg_or_call.from_user.id if isinstance(msg_or_call, CallbackQuery) else msg_or_call.from_user.id
-    kb = chats_page_kb(user_id, page)
+    kb = await chats_page_kb(user_id, page, direction, key)
     text = "Ваши чаты:"
     if isinstance(msg_or_call, CallbackQuery):
         await safe_edit_text(msg_or_call.message, text, callback=msg_or_call, reply_markup=kb.as_markup())
@@ -177,15 +202,15 @@ async def cmd_chats(msg: Message):
 
 @router.callback_query(F.data.startswith("chats:page:"))
 async def cb_chats_page(call: CallbackQuery):
-    parts = call.data.split(":")
-    if len(parts) < 3 or not parts[2].isdigit():
+    parsed = parse_page_data(call.data)
+    if parsed is None:
         return await call.answer("Некорректные данные", show_alert=True)
-    page = int(parts[2])
-    await list_chats(call, page=page)
+    page, direction, key = parsed
+    await list_chats(call, page=page, direction=direction, key=key)
 
 
-def chat_inline_kb(chat_id: int, user_id: int):
-    ch = _storage().get_chat(chat_id) or {}
+async def chat_inline_kb(chat_id: int, user_id: int):
+    ch = await _aio().get_chat(chat_id) or {}
     # 1: Продолжить, Что тут было
     kb = InlineKeyboardBuilder()
     kb.button(text="▶ Продолжить", callback_data=f"chat:cont:{chat_id}")
@@ -205,13 +230,16 @@ def chat_inline_kb(chat_id: int, user_id: int):
 
 
 async def open_chat_inline(msg_or_call: Message | CallbackQuery, *, chat_id: int):
-    ch = _storage().get_chat(chat_id)
+    ch = await _aio().get_chat(chat_id)
     if not ch:
         if isinstance(msg_or_call, CallbackQuery):
             return await msg_or_call.answer("Чат не найден", show_alert=True)
         return await msg_or_call.answer("Чат не найден")
+    if int(ch["user_id"]) == msg_or_call.from_user.id:
+        # открытый чат становится активным: следующие сообщения пойдут в него
+        await _aio().set_active_chat(ch["user_id"], chat_id)
     text = f"Чат #{ch['seq_no']} — {ch['char_name']}\nРежим: {ch['mode']}"
-    kb = chat_inline_kb(chat_id, ch["user_id"])
+    kb = await chat_inline_kb(chat_id, ch["user_id"])
     if isinstance(msg_or_call, CallbackQuery):
         await safe_edit_text(msg_or_call.message, text, callback=msg_or_call, reply_markup=kb.as_markup())
         await msg_or_call.answer()
@@ -243,7 +271,7 @@ async def cb_what(call: CallbackQuery):
     try:
         await call.answer("Думаю…")
         await call.message.bot.send_chat_action(call.message.chat.id, ChatAction.TYPING)
-        u = _storage().get_user(call.from_user.id) or {}
+        u = await _aio().get_user(call.from_user.id) or {}
         model = (u.get("default_model") or settings.default_model)
 
         s = await summarize_chat(chat_id, model=model)
@@ -251,7 +279,7 @@ async def cb_what(call: CallbackQuery):
             call.message,
             f"Кратко о чате:\n\n{s.text}",
             callback=call,
-            reply_markup=chat_inline_kb(chat_id, call.from_user.id).as_markup(),
+            reply_markup=(await chat_inline_kb(chat_id, call.from_user.id)).as_markup(),
         )
     except Exception:
         await call.answer("Не удалось получить краткое содержание", show_alert=True)
@@ -263,8 +291,8 @@ async def cb_fav(call: CallbackQuery):
     if len(parts) < 3 or not parts[2].isdigit():
         return await call.answer("Некорректные данные", show_alert=True)
     chat_id = int(parts[2])
-    lim = _limits_for(call.from_user.id)
-    ok = _storage().toggle_fav_chat(call.from_user.id, chat_id, allow_max=lim.fav_chats_max)
+    lim = await _limits_for(call.from_user.id)
+    ok = await _aio().toggle_fav_chat(call.from_user.id, chat_id, allow_max=lim.fav_chats_max)
     if not ok:
         await call.answer("Лимит избранных чатов исчерпан", show_alert=True)
     await open_chat_inline(call, chat_id=chat_id)
@@ -276,12 +304,12 @@ async def cb_export(call: CallbackQuery):
     if len(parts) < 3 or not parts[2].isdigit():
         return await call.answer("Некорректные данные", show_alert=True)
     chat_id = int(parts[2])
-    txt = _storage().export_chat_txt(chat_id)
+    txt = await _aio().export_chat_txt(chat_id)
     await safe_edit_text(
         call.message,
         "Экспорт чата (txt): отправляю файлом…",
         callback=call,
-        reply_markup=chat_inline_kb(chat_id, call.from_user.id).as_markup(),
+        reply_markup=(await chat_inline_kb(chat_id, call.from_user.id)).as_markup(),
     )
     try:
         from aiogram.types import BufferedInputFile  # type: ignore
@@ -304,7 +332,7 @@ async def cb_import(call: CallbackQuery, state: FSMContext):
         call.message,
         "Пришлите один файл TXT/DOCX/PDF (до 5 МБ) для пополнения контекста.",
         callback=call,
-        reply_markup=chat_inline_kb(chat_id, call.from_user.id).as_markup(),
+        reply_markup=(await chat_inline_kb(chat_id, call.from_user.id)).as_markup(),
     )
     await call.answer()
 
@@ -344,8 +372,8 @@ async def import_doc(msg: Message, state: FSMContext):
         else:
             text = "(формат не поддержан)"
         if text.strip():
-            _storage().add_message(chat_id, is_user=True, content=f"[Импортированный контент]\n{text[:4000]}")
-            await msg.answer("Импортировано в контекст.", reply_markup=chat_inline_kb(chat_id, msg.from_user.id).as_markup())
+            await _aio().add_message(chat_id, is_user=True, content=f"[Импортированный контент]\n{text[:4000]}")
+            await msg.answer("Импортировано в контекст.", reply_markup=(await chat_inline_kb(chat_id, msg.from_user.id)).as_markup())
         else:
             await msg.answer("Не удалось извлечь текст из файла.")
     except Exception:
@@ -375,7 +403,7 @@ async def cb_delok(call: CallbackQuery):
     if len(parts) < 3 or not parts[2].isdigit():
         return await call.answer("Некорректные данные", show_alert=True)
     chat_id = int(parts[2])
-    if _storage().delete_chat(chat_id, call.from_user.id):
+    if await _aio().delete_chat(chat_id, call.from_user.id):
         kb = InlineKeyboardBuilder()
         kb.button(text="⬅ Назад", callback_data="chars:menu")
         kb.adjust(1)
@@ -385,7 +413,7 @@ async def cb_delok(call: CallbackQuery):
             call.message,
             "Не удалось удалить чат.",
             callback=call,
-            reply_markup=chat_inline_kb(chat_id, call.from_user.id).as_markup(),
+            reply_markup=(await chat_inline_kb(chat_id, call.from_user.id)).as_markup(),
         )
     await call.answer()
 
@@ -489,18 +517,20 @@ def _fallback_segments(text: str) -> list[str]:
 @router.message(F.text & ~F.text.startswith("/"))
 async def chatting_text(msg: Message):
     # Определяем активный чат (последний «открытый»)
-    last = _storage().get_last_chat(msg.from_user.id)
+    last = await _aio().get_last_chat(msg.from_user.id)
     if not last:
         await msg.answer("Нет активного чата. Откройте персонажа и начните новый чат.")
         return
     chat_id = int(last["id"])
-    _storage().touch_activity(msg.from_user.id)
+    await _aio().touch_activity(msg.from_user.id)
     user_text = re.sub(r"(?<!\w)/(?:s|n)/|/(?:s|n)/(?!\w)", "", msg.text)
-    _storage().add_message(chat_id, is_user=True, content=user_text)
-    _storage().set_user_chatting(msg.from_user.id, True)  # <-- флаг «диалог начался»
+    await _aio().add_message(chat_id, is_user=True, content=user_text)
+    await _aio().set_user_chatting(msg.from_user.id, True)  # <-- флаг «диалог начался»
     # Индикатор «печатает…»
     stop = asyncio.Event()
     typer = asyncio.create_task(_typing_loop(msg, stop))
+    committed = False  # turn_commit сам сбрасывает флаг «в диалоге»
+    reservation = None  # резерв, переданный финалом live; снимаем, если ход не зафиксирован
 
     try:
         mode = (last.get("mode") or "rp").lower()
@@ -540,6 +570,8 @@ async def chatting_text(msg: Message):
                             last_flush = now
 
                 elif ev["kind"] == "final":
+                    if ev.get("reservation"):
+                        reservation = int(ev["reservation"])
                     # provider may deliver remaining text either in ``buf`` or
                     # directly within the final event
                     final_text = ev.get("text") or ""
@@ -557,27 +589,34 @@ async def chatting_text(msg: Message):
                         else:
                             pieces = [p for p in parts if p and p.strip()]
 
+                    usage_in = int(ev.get("usage_in") or 0)
+                    usage_out = int(ev.get("usage_out") or 0)
+                    deficit = int(ev.get("deficit") or 0)
+                    if reservation is not None:
+                        # списание, ответ и cached_tokens — одной транзакцией,
+                        # до отправки хвоста: резерв не повиснет при ошибке Telegram
+                        reply = "\n".join(p for p in (full, *pieces) if p)
+                        _msg_id, deficit = await _aio().turn_commit(
+                            chat_id,
+                            reply,
+                            usage_in=usage_in,
+                            usage_out=usage_out,
+                            billed=int(ev.get("billed") or 0),
+                            reservation=reservation,
+                        )
+                        committed = True
+
                     for idx, piece in enumerate(pieces):
                         await msg.answer(piece)
                         full += (("\n" if full else "") + piece)
                         if len(pieces) > 1 and idx < len(pieces) - 1:
                             await asyncio.sleep(FALLBACK_FLUSH_SECONDS)
-                    usage_in = int(ev.get("usage_in") or 0)
-                    usage_out = int(ev.get("usage_out") or 0)
-                    if int(ev.get("deficit") or 0) > 0:
+                    if deficit > 0:
                         await msg.answer("⚠ Баланс токенов на нуле. Пополните баланс, чтобы продолжить комфортно.")
-                    else:
-                        _storage().add_message(
-                            chat_id,
-                            is_user=False,
-                            content=full,
-                            usage_in=usage_in,
-                            usage_out=usage_out,
+                    elif FEATURE_USAGE_MSG:
+                        await msg.answer(
+                            f"usage_in: {usage_in}, usage_out: {usage_out}"
                         )
-                        if FEATURE_USAGE_MSG:
-                            await msg.answer(
-                                f"usage_in: {usage_in}, usage_out: {usage_out}"
-                            )
                                 # ответ в live завершён — теперь стартуем таймер «10 минут тишины»
 
                     schedule_silence_check(msg.from_user.id, chat_id, delay_sec=600)
@@ -586,22 +625,13 @@ async def chatting_text(msg: Message):
             # RP: один ответ
 
             r = await chat_turn(msg.from_user.id, chat_id, user_text)
+            committed = bool(r.message_id)  # ответ уже сохранён в turn_commit
 
-            if r.deficit > 0:
-                await msg.answer(r.text)
-            else:
-                _storage().add_message(
-                    chat_id,
-                    is_user=False,
-                    content=r.text,
-                    usage_in=r.usage_in,
-                    usage_out=r.usage_out,
+            await msg.answer(r.text)
+            if r.deficit <= 0 and FEATURE_USAGE_MSG:
+                await msg.answer(
+                    f"usage_in: {r.usage_in}, usage_out: {r.usage_out}"
                 )
-                await msg.answer(r.text)
-                if FEATURE_USAGE_MSG:
-                    await msg.answer(
-                        f"usage_in: {r.usage_in}, usage_out: {r.usage_out}"
-                    )
             schedule_silence_check(msg.from_user.id, chat_id, delay_sec=600)
 
     finally:
@@ -612,4 +642,7 @@ async def chatting_text(msg: Message):
             typer.cancel()
             with contextlib.suppress(asyncio.CancelledError):
                 await typer
-        _storage().set_user_chatting(msg.from_user.id, False)  # <-- диалог завершился
+        if not committed:
+            if reservation is not None:
+                await _aio().release(reservation)
+            await _aio().set_user_chatting(msg.from_user.id, False)  # <-- диалог завершился
@@ -35,6 +35,7 @@ def _profile_text(u: dict) -> str:
             "ai_msgs": 0,
             "in_tokens": 0,
             "out_tokens": 0,
+            "chats": 0,
             "top_character": None,
             "top_count": 0,
         }
@@ -43,9 +44,7 @@ def _profile_text(u: dict) -> str:
     if totals["top_character"]:
         top_line = f"{totals['top_character']} ({totals['top_count']} сооб.)"
     sub = (u.get("subscription") or "free").lower()
-    chats_total = (
-        len(storage.list_user_chats(uid, page=1, page_size=9999)) if uid else 0
-    )
+    chats_total = totals["chats"]
 
     s = _settings()
     model = (u.get("default_model") or s.default_model)
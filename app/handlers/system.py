@@ -61,10 +61,28 @@ async def cmd_diag(msg: Message):
     gate_state = "ON" if settings.sub_channel_id else "OFF"
     err_counts = runtime.get_error_counts()
     err_text = ", ".join(f"{k}={v}" for k, v in err_counts.items()) or "—"
+    queue_text = "—"
+    limiter = runtime.get_rate_limiter()
+    if limiter:
+        st = limiter.stats()
+        queue_text = (
+            f"{st['queued']} queued, {st['busy']}/{st['workers']} busy, "
+            f"wait avg {st['wait_avg']:.1f}s max {st['wait_max']:.1f}s"
+        )
+    wb = storage.write_behind_stats()
+    wb_text = (
+        f"{wb['pending']} pending, {wb['flushes']} flushes, "
+        f"last {wb['last_ms']:.1f}ms avg {wb['avg_ms']:.1f}ms max {wb['max_ms']:.1f}ms"
+    )
+    uc = storage.user_cache_stats()
+    uc_text = f"{uc['size']} rows, {uc['hits']} hits / {uc['misses']} misses"
     text = (
         f"Config v{settings.config_version}\n"
         f"Jobs ({len(job_ids)}): {', '.join(job_ids) if job_ids else '—'}\n"
         f"Sub gate: {gate_state}\n"
+        f"LLM queue: {queue_text}\n"
+        f"DB write-behind: {wb_text}\n"
+        f"User cache: {uc_text}\n"
         f"Errors: {err_text}"
 
 
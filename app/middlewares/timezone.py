@@ -40,7 +40,8 @@ class TimezoneMiddleware(BaseMiddleware):
         if test_mod and hasattr(test_mod, "storage_stub"):
             storage = test_mod.storage_stub
 
-        u = storage.get_user(user_id) or {}
+        aio = getattr(storage, "aio", None)
+        u = (await aio.get_user(user_id) if aio else storage.get_user(user_id)) or {}
         if u.get("tz_offset_min") is None:
             tz_mod = sys.modules.get("app.utils.tz")
             if tz_mod is None:
@@ -53,7 +54,10 @@ class TimezoneMiddleware(BaseMiddleware):
             if isinstance(event, Message):
                 offset = parse_tz_offset(event.text or "")
                 if offset is not None:
-                    storage.set_user_field(user_id, "tz_offset_min", offset)
+                    if aio:
+                        await aio.set_user_field(user_id, "tz_offset_min", offset)
+                    else:
+                        storage.set_user_field(user_id, "tz_offset_min", offset)
                     await event.answer("Часовой пояс сохранён.")
                     return
                 kb = tz_keyboard("tz")
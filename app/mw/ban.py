@@ -17,7 +17,7 @@ class BanMiddleware(BaseMiddleware):
     ) -> Any:
         from_user = data.get("event_from_user") or getattr(event, "from_user", None)
         if from_user:
-            u = storage.get_user(from_user.id)
+            u = await storage.aio.get_user(from_user.id)
             if u and u.get("banned"):
                 answer = getattr(event, "answer", None)
                 if callable(answer):
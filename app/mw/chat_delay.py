@@ -51,11 +51,11 @@ class ChatDelayMiddleware(BaseMiddleware):
         user_id = getattr(from_user, "id", None)
         if not user_id:
             return await handler(event, data)
-        last = storage.get_last_chat(user_id)
+        last = await storage.aio.get_last_chat(user_id)
         if not last:
             return await handler(event, data)
         chat_id = int(last["id"])
-        chat = storage.get_chat(chat_id) or {}
+        chat = await storage.aio.get_chat(chat_id) or {}
         delay_ms = int(chat.get("min_delay_ms") or 0)
         if delay_ms <= 0:
             return await handler(event, data)
@@ -13,13 +13,26 @@ logger = logging.getLogger(__name__)
 
 
 class RateLimitLLM(BaseMiddleware):
-    """Queue incoming messages and process them sequentially."""
+    """Queue incoming messages per user and process them on a worker pool.
 
-    def __init__(self, rate_seconds: int = 3):
-        self.rate = max(0, int(rate_seconds))
+    Updates of a single user are handled strictly one after another with a
+    ``rate_seconds`` cooldown between them, while different users are served
+    in parallel by up to ``workers`` tasks.
+    """
+
+    def __init__(self, rate_seconds: float = 3, workers: int = 10):
+        self.rate = max(0.0, float(rate_seconds))
+        self.workers = max(1, int(workers))
         self._queues: dict[int, asyncio.Queue] = {}
-        self._pending: asyncio.Queue[int] = asyncio.Queue()
-        self._worker_task: asyncio.Task | None = None
+        # users queued in ``_ready``, being processed or cooling down
+        self._scheduled: set[int] = set()
+        self._ready: asyncio.Queue[int] = asyncio.Queue()
+        self._worker_tasks: list[asyncio.Task] = []
+        self._cooldowns: dict[int, asyncio.TimerHandle] = {}
+        self._busy = 0
+        self._processed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
 
     async def __call__(
         self,
@@ -36,47 +49,85 @@ class RateLimitLLM(BaseMiddleware):
         from_user = data.get("event_from_user") or getattr(event, "from_user", None)
         uid = getattr(from_user, "id", 0)
 
-        if self._worker_task is None:
-            self._worker_task = asyncio.create_task(self._worker())
+        if not self._worker_tasks:
+            self._worker_tasks = [
+                asyncio.create_task(self._worker()) for _ in range(self.workers)
+            ]
 
+        loop = asyncio.get_running_loop()
         queue = self._queues.setdefault(uid, asyncio.Queue())
-        await queue.put((handler, event, data))
-        if queue.qsize() == 1:
-            await self._pending.put(uid)
+        queue.put_nowait((handler, event, data, loop.time()))
+        if uid not in self._scheduled:
+            self._scheduled.add(uid)
+            self._ready.put_nowait(uid)
         return
 
+    def stats(self) -> Dict[str, Any]:
+        """Return queue depth and wait-time counters of the pool."""
+        return {
+            "workers": self.workers,
+            "busy": self._busy,
+            "users": len(self._queues),
+            "queued": sum(q.qsize() for q in self._queues.values()),
+            "processed": self._processed,
+            "wait_avg": (self._wait_total / self._processed) if self._processed else 0.0,
+            "wait_max": self._wait_max,
+        }
+
     async def shutdown(self) -> None:
-        """Cancel worker task and clear all queues."""
-        if self._worker_task is not None:
-            self._worker_task.cancel()
+        """Cancel worker tasks and clear all queues."""
+        for task in self._worker_tasks:
+            task.cancel()
+        for task in self._worker_tasks:
             with suppress(asyncio.CancelledError):
-                await self._worker_task
-            self._worker_task = None
+                await task
+        self._worker_tasks = []
+        for h in self._cooldowns.values():
+            h.cancel()
+        self._cooldowns.clear()
         for q in self._queues.values():
             while not q.empty():
                 with suppress(asyncio.QueueEmpty):
                     q.get_nowait()
         self._queues.clear()
-        while not self._pending.empty():
+        self._scheduled.clear()
+        while not self._ready.empty():
             with suppress(asyncio.QueueEmpty):
-                self._pending.get_nowait()
+                self._ready.get_nowait()
 
+    def _release(self, uid: int) -> None:
+        """End the user's cooldown and put them back in line if needed."""
+        self._cooldowns.pop(uid, None)
+        queue = self._queues.get(uid)
+        if queue is not None and not queue.empty():
+            self._ready.put_nowait(uid)
+            return
+        self._queues.pop(uid, None)
+        self._scheduled.discard(uid)
 
     async def _worker(self) -> None:
+        loop = asyncio.get_running_loop()
         while True:
-            uid = await self._pending.get()
+            uid = await self._ready.get()
             queue = self._queues.get(uid)
-            if queue is None:
+            if queue is None or queue.empty():
+                self._release(uid)
                 continue
-            handler, event, data = await queue.get()
+            handler, event, data, queued_at = queue.get_nowait()
+            waited = loop.time() - queued_at
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+            self._busy += 1
             try:
                 await handler(event, data)
             except Exception:
                 logging.exception("RateLimitLLM handler error")
+            finally:
+                self._busy -= 1
+                self._processed += 1
 
-            if queue.empty():
-                self._queues.pop(uid, None)
-            else:
-                await self._pending.put(uid)
+            # кулдаун держим только для этого пользователя, воркер свободен
             if self.rate:
-                await asyncio.sleep(self.rate)
+                self._cooldowns[uid] = loop.call_later(self.rate, self._release, uid)
+            else:
+                self._release(uid)
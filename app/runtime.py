@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from typing import Optional, Dict
+from typing import Any, Optional, Dict
 import logging
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
@@ -8,6 +8,7 @@ from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from app.config import settings
 
 _scheduler: Optional[AsyncIOScheduler] = None
+_rate_limiter: Optional[Any] = None
 _logger: Optional[logging.Logger] = None
 _error_counts: Dict[str, int] = {}
 
@@ -44,3 +45,12 @@ def set_scheduler(s: AsyncIOScheduler) -> None:
 def get_scheduler() -> Optional[AsyncIOScheduler]:
     return _scheduler
 
+
+
+def set_rate_limiter(mw: Any) -> None:
+    global _rate_limiter
+    _rate_limiter = mw
+
+
+def get_rate_limiter() -> Optional[Any]:
+    return _rate_limiter
@@ -79,6 +79,17 @@ def init(bot: Bot) -> None:
     _add_job("bonus:daily", "cron", hour=0, minute=5, func=_daily_bonus)
     _add_job("subs:expire", "cron", hour=0, minute=10, func=_subs_expire)
     _add_job("topups:expire", "cron", minute=0, func=_topups_expire)
+    _add_job("fts:backfill", "interval", seconds=10, func=_fts_backfill)
+    _add_job("fts:merge", "cron", minute=30, func=_fts_merge)
+    _add_job("fts:optimize", "cron", hour=4, minute=20, func=_fts_optimize)
+    _add_job("chats:archive", "cron", hour=3, minute=40, func=_archive_chats)
+    _add_job("storage:retention", "cron", hour=4, minute=40, func=_retention)
+    _add_job(
+        "storage:backup",
+        "interval",
+        hours=float(getattr(settings.storage, "backup_interval_h", 6)),
+        func=_backup,
+    )
 
 
 def shutdown() -> None:
@@ -170,8 +181,22 @@ def _add_job(job_id: str, trigger: str, **kw) -> None:
         logger.exception("Failed to add job %s", job_id)
 
 
+async def _bulk(fn: str) -> list[int]:
+    """Run a chunked storage job one chunk per writer-queue item.
+
+    Chat writes queued meanwhile are served between chunks.
+    """
+    chunk = int(getattr(getattr(settings, "storage", None), "bulk_chunk_rows", 1000))
+    uids: list[int] = []
+    while True:
+        part = await getattr(storage.aio, fn)(limit=chunk)
+        uids.extend(part)
+        if len(part) < chunk:
+            return uids
+
+
 async def _daily_bonus() -> None:
-    uids = storage.daily_bonus_free_users()
+    uids = await _bulk("daily_bonus_free_users")
     if not _bot or not uids:
         return
     amount = int(settings.subs.nightly_toki_bonus.get("free", 0))
@@ -183,7 +208,7 @@ async def _daily_bonus() -> None:
 
 
 async def _subs_expire() -> None:
-    uids = storage.expire_subscriptions()
+    uids = await _bulk("expire_subscriptions")
     if not _bot or not uids:
         return
     for uid in uids:
@@ -194,7 +219,7 @@ async def _subs_expire() -> None:
 
 
 async def _topups_expire() -> None:
-    uids = storage.expire_old_topups(getattr(settings, "topup_expire_hours", 48))
+    uids = await storage.aio.expire_old_topups(getattr(settings, "topup_expire_hours", 48))
     if not _bot or not uids:
         return
     for uid in uids:
@@ -204,6 +229,61 @@ async def _topups_expire() -> None:
             )
         except Exception:
             logger.exception("Failed to notify topup expiry to %s", uid)
+
+
+async def _fts_backfill() -> None:
+    # по шагу за раз через очередь писателя: между пачками проходят обычные записи
+    try:
+        while await storage.aio.fts_backfill_step():
+            pass
+    except Exception:
+        logger.exception("FTS backfill step failed")
+
+
+async def _archive_chats() -> None:
+    try:
+        ids = await _bulk("archive_idle_chats")
+    except Exception:
+        logger.exception("Chat archive job failed")
+        return
+    if ids:
+        logger.info("Archived %d idle chats", len(ids))
+
+
+async def _retention() -> None:
+    # окно за окном через очередь писателя, затем возврат страниц ОС
+    try:
+        while await storage.aio.retention_step():
+            pass
+        freed = await storage.aio.vacuum_step()
+    except Exception:
+        logger.exception("Retention job failed")
+        return
+    if freed:
+        logger.info("Incremental vacuum released %d pages", freed)
+
+
+async def _backup() -> None:
+    try:
+        path = await storage.aio.backup()
+    except Exception:
+        logger.exception("Backup failed")
+        return
+    logger.info("Backup written to %s", path)
+
+
+async def _fts_merge() -> None:
+    try:
+        await storage.aio.fts_optimize(500)
+    except Exception:
+        logger.exception("FTS merge failed")
+
+
+async def _fts_optimize() -> None:
+    try:
+        await storage.aio.fts_optimize()
+    except Exception:
+        logger.exception("FTS optimize failed")
 
 
 def _parse_hhmm(s: str) -> tuple[int, int]:
@@ -342,12 +422,9 @@ def _last_message_recent(chat_id: int, secs: int) -> bool:
 
 def _last_proactive_ts(user_id: int) -> Optional[int]:
     try:
-        rows = storage.query(
-            "SELECT strftime('%s', COALESCE(last_proactive_at, 0)) AS ts FROM users WHERE tg_id=?",
-            (user_id,),
-        )
-        r = rows[0] if rows else None
-        return int(r["ts"]) if r and r["ts"] else None
+        # unix time; строка пользователя видит и ещё не сброшенную запись
+        u = storage.get_user(user_id) or {}
+        return int(u.get("last_proactive_at") or 0) or None
     except Exception:
         logger.exception("Failed to get last proactive timestamp for user %s", user_id)
         return None
@@ -402,7 +479,7 @@ async def _tick_fill_plans():
     if not _scheduler:
         return
     now = _now_ts()
-    for uid in storage.select_proactive_candidates():
+    for uid in await storage.aio.select_proactive_candidates():
         # есть ли хотя бы одна наша джоба для пользователя в будущем?
         has_future = False
         for j in _scheduler.get_jobs():  # type: ignore
@@ -428,7 +505,7 @@ async def _on_silence(user_id: int, chat_id: int):
     if not _scheduler:
         return
     # подтверждение тишины
-    if _last_message_recent(chat_id, 9 * 60):
+    if await storage.aio.run(_last_message_recent, chat_id, 9 * 60):
         return
 
     # Уже есть будущее?
@@ -451,7 +528,7 @@ async def _on_nudge_due(user_id: int):
     Всегда шлём в АКТУАЛЬНЫЙ last_chat пользователя.
     При невозможности — переносим на случайное время в (now..+24h).
     """
-    last_chat = _get_last_chat_id(user_id)
+    last_chat = await storage.aio.run(_get_last_chat_id, user_id)
     if not last_chat:
         # нет чатов — перенести
         _schedule_next(user_id)
@@ -459,14 +536,14 @@ async def _on_nudge_due(user_id: int):
 
     now = _now_ts()
     # если была активность <5 минут назад — перенос
-    if _last_message_recent(last_chat, 5 * 60):
+    if await storage.aio.run(_last_message_recent, last_chat, 5 * 60):
         _schedule_next(user_id)
         return
 
 
     # min_gap
-    _, _, min_gap = _get_user_settings(user_id)
-    last_sent = _last_proactive_ts(user_id)
+    _, _, min_gap = await storage.aio.run(_get_user_settings, user_id)
+    last_sent = await storage.aio.run(_last_proactive_ts, user_id)
     if last_sent and (now - last_sent) < min_gap:
         wait = last_sent + min_gap + _rand_between(30, 300) - now
         _schedule_next(user_id, delay_sec=wait)
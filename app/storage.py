@@ -1,13 +1,25 @@
 from __future__ import annotations
 
+import asyncio
+import contextlib
+import contextvars
+import functools
 import logging
+import os
+import queue
 import sqlite3
 import threading
 import time
 import re
+import sys
+import json
+import zlib
+from collections import OrderedDict, deque
 from datetime import datetime, timezone, timedelta
+from itertools import count, groupby
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Callable, Dict, List, Optional, Tuple
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
 
 from app.config import BASE_DIR, settings
 
@@ -15,36 +27,427 @@ from app.config import BASE_DIR, settings
 sqlite3.register_adapter(bool, int)
 sqlite3.register_converter("BOOLEAN", lambda v: bool(int(v)))
 
-_conn: sqlite3.Connection | None = None
+# Writer connection: every write and billing transaction goes through it
+# under ``_conn_lock``.  Plain reads are served by ``_readers`` (WAL lets them
+# run alongside the writer and alongside each other).  With sharding enabled
+# both names refer to the file of the current shard (see "Shards" below).
 _conn_path: Path | None = None
 _stats_cache: Dict[str, Tuple[float, Any]] = {}
-_conn_lock = threading.RLock()
+_readers: "queue.LifoQueue[sqlite3.Connection] | None" = None
+_reader_conns: List[sqlite3.Connection] = []
 
 
+logger = logging.getLogger(__name__)
 topups_logger = logging.getLogger("topups")
 
 
+def _cfg(name: str, default: Any) -> Any:
+    """Read ``settings.storage.<name>`` tolerating partial settings objects."""
+    return getattr(getattr(settings, "storage", None), name, default)
+
+
+class _Rows:
+    """Fully fetched result of a read with the cursor interface callers use."""
+
+    __slots__ = ("_rows", "_pos")
+
+    def __init__(self, rows: List[sqlite3.Row]):
+        self._rows = rows
+        self._pos = 0
+
+    def fetchone(self) -> sqlite3.Row | None:
+        if self._pos >= len(self._rows):
+            return None
+        row = self._rows[self._pos]
+        self._pos += 1
+        return row
+
+    def fetchall(self) -> List[sqlite3.Row]:
+        rows = self._rows[self._pos:]
+        self._pos = len(self._rows)
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+
+# ------------- Shards -------------
+# При storage.shards > 1 пользовательские таблицы (users, chats, messages,
+# token_log, proactive_*, topups, сводки) раскладываются по N файлам
+# <db>.s<k><suffix>: пользователь — по хэшу tg_id, а чаты, заявки и планы
+# получают id с шагом N, так что файл виден по самому id. Персонажи живут
+# в общем файле db_path; каждый шард подключает его через ATTACH и видит
+# как TEMP VIEW characters, поэтому join-ы с персонажами не меняются.
+# У каждого файла свой писатель, свой пул читателей и свой поток
+# aio-писателя. Текущий файл задаёт контекст: функции с _sharded выставляют
+# его на время вызова, межшардовые задачи обходят файлы через _fan_out, а
+# _conn и _conn_lock — прокси к соединению и блокировке текущего файла.
+# Поток, держащий блокировку шарда, не берёт блокировку другого шарда.
+# При shards=1 (по умолчанию) файл один и всё работает как раньше.
+#
+# История сообщений (messages, messages_fts, chat_archive) при
+# storage.split_history лежит в отдельном файле <файл>.history<suffix> рядом
+# с каждым файлом данных, со своим писателем, блокировкой и читателями —
+# транзакции биллинга не ждут вставок и удалений сообщений. Основной файл
+# подключает историю через ATTACH и видит её как TEMP VIEW messages и
+# chat_archive, так что сводные запросы читают её как прежде. Порядок
+# блокировок: история, затем основной файл — никогда наоборот. Миграции
+# основного файла выполняются до переноса истории и видят её таблицы лишь
+# при первом включении; шаг, читающий messages, должен это учитывать.
+class _Shard:
+    """One database file: its writer, write lock and reader pool."""
+
+    __slots__ = (
+        "index", "path", "conn", "lock", "readers", "reader_conns",
+        "fts_pending", "snapshot", "snapshot_at", "history",
+    )
+
+    def __init__(self, index: int, path: Path):
+        self.index = index
+        self.path = path
+        self.conn: sqlite3.Connection | None = None
+        self.lock = threading.RLock()
+        self.readers: "queue.LifoQueue[sqlite3.Connection] | None" = None
+        self.reader_conns: List[sqlite3.Connection] = []
+        self.fts_pending: bool | None = None  # None — ещё не читали fts_backfill
+        self.snapshot: _Replica | None = None
+        self.snapshot_at: float | None = None
+        self.history: _Shard | None = None  # отдельный файл истории сообщений
+
+
+_idle = _Shard(-1, Path())  # до init(): соединения нет
+_shared: _Shard | None = None  # общий файл (db_path)
+_shards: List[_Shard] = [_idle]  # файлы с данными пользователей
+_ctx: "contextvars.ContextVar[_Shard | None]" = contextvars.ContextVar("storage_shard", default=None)
+
+
+def _cur() -> _Shard:
+    return _ctx.get() or _shared or _idle
+
+
+class _CurrentConn:
+    """Writer connection of the current shard."""
+
+    __slots__ = ()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(_cur().conn, name)
+
+    def __enter__(self) -> sqlite3.Connection:
+        return _cur().conn.__enter__()
+
+    def __exit__(self, *exc: Any) -> Any:
+        return _cur().conn.__exit__(*exc)
+
+
+class _CurrentLock:
+    """Write lock of the current shard."""
+
+    __slots__ = ()
+
+    def __enter__(self) -> bool:
+        return _cur().lock.acquire()
+
+    def __exit__(self, *exc: Any) -> None:
+        _cur().lock.release()
+
+
+_conn = _CurrentConn()
+_conn_lock = _CurrentLock()
+
+
+@contextlib.contextmanager
+def _on(sh: _Shard) -> Iterator[_Shard]:
+    """Make ``sh`` the current file for the block."""
+    token = _ctx.set(sh)
+    try:
+        yield sh
+    finally:
+        _ctx.reset(token)
+
+
+def _hist() -> _Shard:
+    """File holding the message history of the current shard."""
+    sh = _cur()
+    return sh.history or sh
+
+
+@contextlib.contextmanager
+def _history_tx() -> Iterator[sqlite3.Connection]:
+    """Transactions on the current file and on its history file.
+
+    Yields the history connection, ``_conn`` stays the main one. Without a
+    separate history file both are one connection and one transaction.
+    """
+    main = _cur()
+    hist = main.history
+    if hist is None:
+        with _conn_lock, _conn:
+            yield main.conn
+        return
+    with hist.lock, hist.conn, _conn_lock, _conn:
+        yield hist.conn
+
+
+def _user_shard(user_id: int) -> _Shard:
+    n = len(_shards)
+    if n == 1:
+        return _shards[0]
+    return _shards[zlib.crc32(int(user_id).to_bytes(8, "little", signed=True)) % n]
+
+
+def _row_shard(row_id: int) -> _Shard:
+    return _shards[(int(row_id) - 1) % len(_shards)]
+
+
+def _next_id(table: str) -> int | None:
+    """Next id of ``table`` on the current shard (``None`` — AUTOINCREMENT).
+
+    With N shards ids of chats, top-ups and plans go in steps of N, so that
+    ``(id - 1) % N`` is the shard holding the row.
+    """
+    n = len(_shards)
+    if n == 1:
+        return None
+    r = _conn.execute("SELECT seq FROM sqlite_sequence WHERE name=?", (table,)).fetchone()
+    seq = int(r[0]) if r else 0
+    return seq + 1 + (_cur().index - seq) % n
+
+
+def _sharded(*, user: str | None = None, row: str | None = None) -> Callable[[Callable], Callable]:
+    """Run the function on the shard of argument ``user`` (a tg_id) or ``row``."""
+    arg = user or row
+    assert arg
+    pick = _user_shard if user else _row_shard
+
+    def deco(fn: Callable) -> Callable:
+        pos = fn.__code__.co_varnames.index(arg)
+
+        def shard_of(*args: Any, **kwargs: Any) -> _Shard | None:
+            if len(_shards) < 2:
+                return None
+            try:
+                return pick(kwargs[arg] if arg in kwargs else args[pos])
+            except (IndexError, KeyError, TypeError, ValueError):
+                return None
+
+        @functools.wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            sh = shard_of(*args, **kwargs)
+            if sh is None:
+                return fn(*args, **kwargs)
+            token = _ctx.set(sh)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _ctx.reset(token)
+
+        wrapper.shard_of = shard_of  # type: ignore[attr-defined]
+        return wrapper
+
+    return deco
+
+
+def _fan_out(fn: Callable[[], Any]) -> List[Any]:
+    """Call ``fn`` on every shard with user data; results in shard order."""
+    if len(_shards) == 1:
+        return [fn()]
+    out = []
+    for sh in _shards:
+        token = _ctx.set(sh)
+        try:
+            out.append(fn())
+        finally:
+            _ctx.reset(token)
+    return out
+
+
+def _fan_out_limited(fn: Callable[[int | None], List[Any]], limit: int | None) -> List[Any]:
+    """Run a chunked job shard by shard, at most ``limit`` items in total."""
+    done: List[Any] = []
+
+    def run() -> None:
+        if not limit:
+            done.extend(fn(None))
+        elif len(done) < limit:
+            done.extend(fn(limit - len(done)))
+
+    _fan_out(run)
+    return done
+
 
 # ------------- Core -------------
-def init(path: str | Path) -> None:
-    global _conn, _conn_path
-    _conn_path = Path(path) if isinstance(path, str) else path
-    _conn_path.parent.mkdir(parents=True, exist_ok=True)
-    _conn = sqlite3.connect(
-        str(_conn_path),
+def _connect(path: Path, *, readonly: bool = False) -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        str(path),
         detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
         check_same_thread=False,
+        timeout=int(_cfg("busy_timeout_ms", 5000)) / 1000.0,
     )
-    _conn.row_factory = sqlite3.Row
-    _migrate()
+    conn.row_factory = sqlite3.Row
+    if readonly:
+        conn.execute("PRAGMA query_only=ON")
+    return conn
+
+
+# таблицы, которые при split_history живут в файле истории
+_HISTORY_TABLES = ("messages", "chat_archive", "chat_checkpoints")
+
+
+def _attach(conn: sqlite3.Connection, path: Path, schema: str, tables: Tuple[str, ...]) -> None:
+    """ATTACH ``path`` as ``schema`` and expose ``tables`` as TEMP VIEWs."""
+    readonly = conn.execute("PRAGMA query_only").fetchone()[0]
+    conn.execute("PRAGMA query_only=OFF")  # TEMP VIEW — тоже запись
+    conn.execute(f"ATTACH DATABASE ? AS {schema}", (str(path),))
+    for table in tables:
+        conn.execute(f"CREATE TEMP VIEW {table} AS SELECT * FROM {schema}.{table}")
+    conn.execute(f"PRAGMA query_only={int(readonly)}")
+
+
+def _history_path(path: Path) -> Path:
+    return path.with_name(f"{path.stem}.history{path.suffix}")
+
+
+def _open(sh: _Shard, in_memory: bool, *, shared: Path | None = None, split: bool = False) -> None:
+    """Connect, migrate and attach the reader pool of one file.
+
+    ``shared`` is the file with the characters (for shards), ``split`` puts
+    the message history of this file into its own file.
+    """
+    sh.conn = _connect(sh.path)
+    with _on(sh):
+        if not in_memory:
+            # действует только для новой (пустой) базы — до первой таблицы
+            _conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            _conn.execute("PRAGMA journal_mode=WAL")
+            _conn.execute("PRAGMA synchronous=NORMAL")
+        _migrate()
+        if sh is _shared:
+            _check_shards()
+        attach: List[Tuple[Path, str, Tuple[str, ...]]] = []
+        if shared is not None:
+            # после миграций: они работают с собственными таблицами файла
+            attach.append((shared, "shared", ("characters",)))
+        hist_path = _history_path(sh.path)
+        if split:
+            sh.history = _Shard(sh.index, hist_path)
+            _open(sh.history, in_memory)
+            attach.append((hist_path, "history", _HISTORY_TABLES))
+        elif not in_memory and hist_path.exists():
+            raise RuntimeError(f"message history of {sh.path} is kept in {hist_path}; set storage.split_history")
+        for args in attach:
+            _attach(sh.conn, *args)
+        if split:
+            _move_history()
+            if _q("SELECT 1 FROM schema_backfill WHERE name=?", (_CHAT_TOTALS_DEFERRED,)).fetchone():
+                _fill_chat_totals()
+                _exec("DELETE FROM schema_backfill WHERE name=?", (_CHAT_TOTALS_DEFERRED,))
+        if not in_memory:
+            _attach_snapshot(_latest_backup())
+        size = 0 if in_memory else max(0, int(_cfg("read_pool_size", 4)))
+        if size:
+            sh.readers = queue.LifoQueue()
+            for _ in range(size):
+                conn = _connect(sh.path, readonly=True)
+                for args in attach:
+                    _attach(conn, *args)
+                sh.reader_conns.append(conn)
+                _reader_conns.append(conn)
+                sh.readers.put(conn)
+
+
+def _move_history() -> None:
+    """Move history rows of the main file into the attached history file.
+
+    The copy ignores rows already there, so a move interrupted between the
+    commits of the two files is finished on the next start. The emptied
+    tables are dropped: nothing in the main file may refer to ``messages``
+    once the TEMP VIEW of that name hides it (ALTER TABLE re-checks them).
+    """
+    main = {r[0] for r in _conn.execute("SELECT name FROM main.sqlite_master WHERE type='table'")}
+    for table in _HISTORY_TABLES:
+        if table in main:
+            with _conn_lock, _conn:
+                _conn.execute(f"INSERT OR IGNORE INTO history.{table} SELECT * FROM main.{table}")
+                _conn.execute(f"DELETE FROM main.{table}")
+    for table in ("messages_fts", "fts_backfill", *_HISTORY_TABLES):
+        _exec(f"DROP TABLE IF EXISTS main.{table}")
+
+
+def _check_shards() -> None:
+    """Refuse to open a database split into a different number of shards."""
+    n = int(_cfg("shards", 1)) if str(_conn_path) != ":memory:" else 1
+    n = max(1, n)
+    stored = int(_conn.execute("PRAGMA user_version").fetchone()[0])
+    if stored == 0:
+        if n > 1 and _conn.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+            raise RuntimeError(f"{_conn_path} holds unsharded data; resharding is not supported")
+        _conn.execute(f"PRAGMA user_version={n}")
+    elif stored != n:
+        raise RuntimeError(
+            f"{_conn_path} is split into {stored} shard(s), storage.shards={n}: resharding is not supported"
+        )
+
+
+def init(path: str | Path) -> None:
+    global _conn_path, _readers, _shared, _shards
+    close()
+    _conn_path = Path(path) if isinstance(path, str) else path
+    _conn_path.parent.mkdir(parents=True, exist_ok=True)
+    in_memory = str(_conn_path) == ":memory:"
+    n = 1 if in_memory else max(1, int(_cfg("shards", 1)))
+    split = not in_memory and bool(_cfg("split_history", False))
+    _shared = _Shard(0 if n == 1 else -1, _conn_path)
+    _shards = [_shared]
+    _open(_shared, in_memory, split=split and n == 1)
+    if n > 1:
+        stem, suffix = _conn_path.stem, _conn_path.suffix
+        _shards = [_Shard(k, _conn_path.with_name(f"{stem}.s{k}{suffix}")) for k in range(n)]
+        for sh in _shards:
+            _open(sh, in_memory, shared=_conn_path, split=split)
+    _readers = _shared.readers
+
+
+def _files() -> List[_Shard]:
+    """Every open file: the shared one, the shards and their history files."""
+    if _shared is None:
+        return []
+    files = _shards if _shards[0] is _shared else [_shared, *_shards]
+    return [*files, *(sh.history for sh in files if sh.history is not None)]
 
 
 def close() -> None:
-    global _conn
-    with _conn_lock:
-        if _conn is not None:
-            _conn.close()
-            _conn = None
+    global _readers, _char_epoch, _shared, _shards
+    _aio_shutdown()
+    _wb_flush()
+    invalidate_user()
+    invalidate_chat()
+    drop_tail()
+    _stats_cache.clear()
+    _char_versions.clear()
+    _char_epoch = next(_char_seq)
+    for sh in _files():
+        token = _ctx.set(sh)
+        try:
+            _attach_snapshot(None)
+        finally:
+            _ctx.reset(token)
+        with sh.lock:
+            sh.readers = None
+            for conn in sh.reader_conns:
+                conn.close()
+            sh.reader_conns.clear()
+            if sh.conn is not None:
+                try:
+                    sh.conn.execute("PRAGMA optimize")
+                except sqlite3.Error:
+                    pass
+                sh.conn.close()
+                sh.conn = None
+    _readers = None
+    _reader_conns.clear()
+    _shared = None
+    _shards = [_idle]
 
 
 def _exec(sql: str, params: Tuple | Dict | None = None) -> sqlite3.Cursor:
@@ -57,20 +460,373 @@ def _exec(sql: str, params: Tuple | Dict | None = None) -> sqlite3.Cursor:
         return cur
 
 
-def _q(sql: str, params: Tuple | Dict | None = None) -> sqlite3.Cursor:
-    with _conn_lock:
-        assert _conn is not None
+def _q(sql: str, params: Tuple | Dict | None = None) -> _Rows:
+    """Run a read on a pooled reader (or on the writer before the pool is up)."""
+    pool = _cur().readers
+    if pool is None:
+        with _conn_lock:
+            assert _conn is not None
 
-        return _conn.execute(sql, params or ())
+            return _Rows(_conn.execute(sql, params or ()).fetchall())
+    conn = pool.get()
+    try:
+        return _Rows(conn.execute(sql, params or ()).fetchall())
+    finally:
+        pool.put(conn)
 
 
 def query(sql: str, params: Tuple | Dict | None = None) -> List[sqlite3.Row]:
     """Execute a SELECT query and return all rows.
 
     This is a public helper that wraps :func:`_q` and exposes the results as a
-    list of :class:`sqlite3.Row` objects instead of a cursor.
+    list of :class:`sqlite3.Row` objects instead of a cursor.  Deferred
+    write-behind rows are flushed first so ad-hoc SQL sees them.  With
+    several shards the query runs on each of them and the rows are
+    concatenated (aggregates come back once per shard).
+    """
+    if _wb_users or _wb_rows:
+        _wb_flush()
+    return [r for part in _fan_out(lambda: _q(sql, params).fetchall()) for r in part]
+
+# ------------- Async facade -------------
+# Корутины не должны ходить в SQLite напрямую: чтения уходят в пул потоков
+# (по одному на read-соединение), записи — в поток-писатель, который
+# забирает из очереди всё накопившееся и выполняет пачкой под одним
+# захватом ``_conn_lock``. При нескольких шардах у каждого свой писатель;
+# межшардовые и общие записи идут в отдельный общий поток.
+_AIO_READS = frozenset(
+    {
+        "query",
+        "get_user",
+        "get_user_settings",
+        "get_character",
+        "list_characters_for_user",
+        "is_fav_char",
+        "get_user_char_stats",
+        "get_chat",
+        "get_cached_tokens",
+        "latest_checkpoint",
+        "list_user_chats",
+        "count_user_chats",
+        "count_characters",
+        "list_user_chats_by_char",
+        "get_last_chat",
+        "list_messages",
+        "search_messages",
+        "last_message_ts",
+        "export_chat_txt",
+        "usage_by_day",
+        "usage_by_week",
+        "top_characters",
+        "active_users",
+        "user_totals",
+        "list_token_log",
+        "get_toki_log",
+        "select_proactive_candidates",
+        "proactive_count_today",
+        "get_topup",
+        "has_pending_topup",
+        "get_active_topup",
+        "is_user_chatting",
+        "get_delay_range",
+        "get_pending_plan",
+        "get_due_plans",
+        "snapshot_taken_at",
+        # копирует через собственное соединение и писателя не занимает
+        "backup",
+    }
+)
+# Записи истории сообщений: при split_history идут в отдельный поток-писатель
+# файла истории, чтобы биллинг в очереди основного писателя их не ждал.
+_AIO_HISTORY = frozenset(
+    {
+        "add_message",
+        "compress_history",
+        "turn_commit",
+        "delete_chat",
+        "archive_chat",
+        "restore_chat",
+        "archive_idle_chats",
+        "fts_backfill_step",
+        "fts_optimize",
+        "vacuum_step",
+    }
+)
+
+_aio_lock = threading.Lock()
+_aio_readers: ThreadPoolExecutor | None = None
+_aio_writes: "Dict[Any, queue.SimpleQueue[tuple | None]]" = {}
+_aio_writers: Dict[Any, threading.Thread] = {}
+
+
+def _writer_loop(jobs: "queue.SimpleQueue[tuple | None]", shard: _Shard | None, history: bool = False) -> None:
+    if shard is not None:
+        _ctx.set(shard)
+    lock = shard.history.lock if history and shard is not None and shard.history else _conn_lock
+    while True:
+        batch = [jobs.get()]
+        while True:
+            try:
+                batch.append(jobs.get_nowait())
+            except queue.Empty:
+                break
+        with lock:
+            for job in batch:
+                if job is None:
+                    continue
+                fut, fn, args, kwargs = job
+                if not fut.set_running_or_notify_cancel():
+                    continue
+                try:
+                    fut.set_result(fn(*args, **kwargs))
+                except BaseException as exc:  # noqa: BLE001 - передаём в await
+                    fut.set_exception(exc)
+        if None in batch:
+            return
+
+
+def _submit_read(fn: Callable, *args: Any, **kwargs: Any) -> Future:
+    global _aio_readers
+    with _aio_lock:
+        if _aio_readers is None:
+            _aio_readers = ThreadPoolExecutor(
+                max_workers=max(1, int(_cfg("read_pool_size", 4))),
+                thread_name_prefix="storage-read",
+            )
+        return _aio_readers.submit(fn, *args, **kwargs)
+
+
+def _submit_write(fn: Callable, *args: Any, **kwargs: Any) -> Future:
+    return _submit_to(False, fn, *args, **kwargs)
+
+
+def _submit_history(fn: Callable, *args: Any, **kwargs: Any) -> Future:
+    return _submit_to(True, fn, *args, **kwargs)
+
+
+def _submit_to(history: bool, fn: Callable, *args: Any, **kwargs: Any) -> Future:
+    fut: Future = Future()
+    shard_of = getattr(fn, "shard_of", None)
+    shard = shard_of(*args, **kwargs) if shard_of is not None else None
+    key: Any = -1 if shard is None else shard.index
+    name = "storage-writer" if shard is None else f"storage-writer-{key}"
+    if history:
+        owner = shard if shard is not None or len(_shards) > 1 else _shards[0]
+        # межшардовые задачи остаются в общем потоке: он берёт блокировки
+        # файлов по одной
+        if owner is not None and owner.history is not None:
+            shard, key = owner, ("history", owner.index)
+            name = name.replace("writer", "history")
+        else:
+            history = False
+    with _aio_lock:
+        jobs = _aio_writes.get(key)
+        if jobs is None:
+            jobs = _aio_writes[key] = queue.SimpleQueue()
+            writer = _aio_writers[key] = threading.Thread(
+                target=_writer_loop, args=(jobs, shard, history), name=name, daemon=True
+            )
+            writer.start()
+        jobs.put((fut, fn, args, kwargs))
+    return fut
+
+
+def _aio_shutdown() -> None:
+    """Finish queued async work and stop the executor threads."""
+    global _aio_readers
+    with _aio_lock:
+        readers = _aio_readers
+        writers = [(_aio_writes[k], w) for k, w in _aio_writers.items()]
+        _aio_readers = None
+        _aio_writes.clear()
+        _aio_writers.clear()
+    for jobs, writer in writers:
+        jobs.put(None)
+    for jobs, writer in writers:
+        if writer is not threading.current_thread():
+            writer.join()
+    if readers is not None:
+        readers.shutdown(wait=True)
+
+
+class AsyncStorage:
+    """Awaitable view of the storage API: ``await storage.aio.get_user(uid)``.
+
+    Functions are looked up on ``target`` at call time, so a replaced or
+    monkeypatched function is honoured.  Reads run on the reader executor,
+    everything else on the writer thread (of the shard, when sharded).
+    """
+
+    def __init__(self, target: Any):
+        self._target = target
+
+    def __getattr__(self, name: str) -> Callable[..., Awaitable[Any]]:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        write = name not in _AIO_READS
+
+        async def call(*args: Any, **kwargs: Any) -> Any:
+            fn = getattr(self._target, name)
+            if name in _AIO_HISTORY:
+                return await asyncio.wrap_future(_submit_history(fn, *args, **kwargs))
+            return await self.run(fn, *args, write=write, **kwargs)
+
+        call.__name__ = name
+        return call
+
+    async def run(self, fn: Callable, *args: Any, write: bool = False, **kwargs: Any) -> Any:
+        """Run an arbitrary blocking ``fn`` off the event loop."""
+        submit = _submit_write if write else _submit_read
+        return await asyncio.wrap_future(submit(fn, *args, **kwargs))
+
+
+aio = AsyncStorage(sys.modules[__name__])
+
+
+# ------------- Write-behind -------------
+# Малоценные записи (отметка активности, флаг «в диалоге», время последнего
+# нуджа, логи рассылок и проактива) не коммитим по одной: копим в памяти и
+# сбрасываем одной транзакцией раз в ``write_behind_ms`` или по
+# ``write_behind_rows`` строк. Чтения этих полей видят отложенные значения.
+_WB_USER_COLS = ("last_activity_at", "is_chatting", "last_proactive_at")
+
+_wb_lock = threading.Lock()
+_wb_users: Dict[Tuple[int, str], Any] = {}
+_wb_rows: List[Tuple[int, str, Tuple]] = []  # (шард, sql, параметры)
+_wb_timer: threading.Timer | None = None
+_wb_stats: Dict[str, float] = {"flushes": 0, "rows": 0, "last_ms": 0.0, "max_ms": 0.0, "total_ms": 0.0}
+
+
+def _utcnow_sql() -> str:
+    """Current UTC time in SQLite ``CURRENT_TIMESTAMP`` format."""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _utc_day(ts: int) -> str:
+    """``YYYY-MM-DD`` (UTC) of a unix timestamp."""
+    return time.strftime("%Y-%m-%d", time.gmtime(ts))
+
+
+def _epoch(value: Any) -> int | None:
+    """Unix time of a stored timestamp, including the legacy text form."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, datetime):
+        dt = value
+    else:
+        dt = datetime.fromisoformat(str(value))
+    return int((dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)).timestamp())
+
+
+def ts_text(value: Any, fmt: str = "%Y-%m-%d %H:%M:%S") -> str:
+    """Timestamp for display: unix time (or legacy text) as UTC ``fmt``.
+
+    Values that are not timestamps (``token_log_monthly`` months) are
+    returned as they are.
+    """
+    try:
+        ts = _epoch(value)
+    except ValueError:
+        return str(value)
+    return "" if ts is None else time.strftime(fmt, time.gmtime(ts))
+
+
+def _wb_enabled() -> bool:
+    return _shared is not None and int(_cfg("write_behind_ms", 200)) > 0
+
+
+def _wb_put(*, user: Tuple[int, str, Any] | None = None, row: Tuple[str, Tuple] | None = None) -> None:
+    global _wb_timer
+    with _wb_lock:
+        if user is not None:
+            uid, col, value = user
+            _wb_users[(uid, col)] = value
+        if row is not None:
+            _wb_rows.append((_cur().index, *row))
+        full = len(_wb_users) + len(_wb_rows) >= int(_cfg("write_behind_rows", 500))
+        if not full and _wb_timer is None:
+            _wb_timer = threading.Timer(int(_cfg("write_behind_ms", 200)) / 1000.0, _wb_flush)
+            _wb_timer.daemon = True
+            _wb_timer.start()
+    # кэш строк — после _wb_lock: get_user берёт эти блокировки по очереди, не вложенно
+    if user is not None:
+        _user_cache_set(uid, col, value)
+    if full:
+        _wb_flush()
+
+
+def _wb_pending_user(user_id: int, col: str, default: Any = None) -> Any:
+    with _wb_lock:
+        return _wb_users.get((user_id, col), default)
+
+
+def _wb_overlay(user_id: int, row: Dict[str, Any]) -> Dict[str, Any]:
+    if _wb_users:
+        with _wb_lock:
+            for col in _WB_USER_COLS:
+                if (user_id, col) in _wb_users:
+                    row[col] = _wb_users[(user_id, col)]
+    return row
+
+
+def _wb_flush() -> None:
+    """Write every deferred row, one transaction per shard.
+
+    Inside a shard's context only that shard is flushed, so no second shard
+    lock is taken while the first one is held.
     """
-    return _q(sql, params).fetchall()
+    cur = _ctx.get()
+    for sh in [cur] if cur is not None and len(_shards) > 1 else list(_shards):
+        _wb_flush_shard(sh)
+
+
+def _wb_flush_shard(sh: _Shard) -> None:
+    global _wb_timer
+    with sh.lock:
+        with _wb_lock:
+            if len(_shards) > 1:
+                users = [(k, v) for k, v in _wb_users.items() if _user_shard(k[0]) is sh]
+                for k, _v in users:
+                    del _wb_users[k]
+                rows = [r[1:] for r in _wb_rows if r[0] == sh.index]
+                _wb_rows[:] = [r for r in _wb_rows if r[0] != sh.index]
+            else:
+                users = list(_wb_users.items())
+                rows = [r[1:] for r in _wb_rows]
+                _wb_users.clear()
+                _wb_rows.clear()
+            if _wb_timer is not None and not _wb_users and not _wb_rows:
+                _wb_timer.cancel()
+                _wb_timer = None
+        if not users and not rows or sh.conn is None:
+            return
+        t0 = time.perf_counter()
+        conn = sh.conn
+        with conn:
+            for col in _WB_USER_COLS:
+                params = [(v, uid) for (uid, c), v in users if c == col]
+                if params:
+                    conn.executemany(f"UPDATE users SET {col}=? WHERE tg_id=?", params)
+            for sql, group in groupby(rows, key=lambda r: r[0]):
+                conn.executemany(sql, [p for _s, p in group])
+        ms = (time.perf_counter() - t0) * 1000.0
+    with _wb_lock:
+        _wb_stats["flushes"] += 1
+        _wb_stats["rows"] += len(users) + len(rows)
+        _wb_stats["last_ms"] = ms
+        _wb_stats["max_ms"] = max(_wb_stats["max_ms"], ms)
+        _wb_stats["total_ms"] += ms
+
+
+def write_behind_stats() -> Dict[str, Any]:
+    """Return write-behind queue depth and flush latency counters."""
+    with _wb_lock:
+        st: Dict[str, Any] = dict(_wb_stats)
+        st["pending"] = len(_wb_users) + len(_wb_rows)
+    st["avg_ms"] = st["total_ms"] / st["flushes"] if st["flushes"] else 0.0
+    return st
 
 
 # --- Simple cache for heavy stat queries ---
@@ -97,7 +853,78 @@ def _has_col(table: str, col: str) -> bool:
         return any(r[1] == col for r in cur.fetchall())
 
 
+# Схема ведётся нумерованными шагами (_MIGRATIONS); номер последнего
+# применённого шага лежит в schema_version. На актуальной базе init() делает
+# одно чтение версии. Шаги обязаны быть идемпотентными: версия фиксируется
+# после шага, и прерванный шаг при следующем старте выполнится заново.
+def _schema_version() -> int:
+    assert _conn is not None
+    try:
+        r = _conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return int(r[0] or 0)
+
+
 def _migrate() -> None:
+    """Apply the steps of :data:`_MIGRATIONS` newer than ``schema_version``."""
+    version = _schema_version()
+    if version >= len(_MIGRATIONS):
+        return
+    _exec(
+        """
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version     INTEGER PRIMARY KEY,
+        applied_at  DATETIME DEFAULT CURRENT_TIMESTAMP
+    )"""
+    )
+    for n, step in enumerate(_MIGRATIONS[version:], start=version + 1):
+        step()
+        _exec("INSERT OR IGNORE INTO schema_version(version) VALUES (?)", (n,))
+        logger.info("schema migrated to v%d (%s)", n, step.__name__)
+
+
+def _backfill(name: str, table: str, sql: str | Tuple[str, ...]) -> None:
+    """Run ``sql`` over ``table`` in rowid batches, resumable across restarts.
+
+    ``sql`` is an UPDATE/INSERT (or a tuple of them) restricted by
+    ``rowid > :lo AND rowid <= :hi``. The progress row in ``schema_backfill``
+    is committed with every batch.
+    """
+    stmts = (sql,) if isinstance(sql, str) else sql
+    _exec(
+        """
+    CREATE TABLE IF NOT EXISTS schema_backfill (
+        name    TEXT PRIMARY KEY,
+        cursor  INTEGER NOT NULL,
+        upto    INTEGER NOT NULL
+    )"""
+    )
+    batch = max(1, int(_cfg("migrate_batch", 5000)))
+    r = _q("SELECT cursor, upto FROM schema_backfill WHERE name=?", (name,)).fetchone()
+    if r is None:
+        lo, upto = 0, int(_q(f"SELECT COALESCE(MAX(rowid), 0) FROM {table}").fetchone()[0])
+        _exec("INSERT INTO schema_backfill(name, cursor, upto) VALUES (?,?,?)", (name, lo, upto))
+    else:
+        lo, upto = int(r["cursor"]), int(r["upto"])
+    assert _conn is not None
+    while lo < upto:
+        # ключи могут быть разреженными (users.tg_id) — границу берём по индексу
+        nxt = _q(
+            f"SELECT rowid FROM {table} WHERE rowid > ? AND rowid <= ? ORDER BY rowid LIMIT 1 OFFSET ?",
+            (lo, upto, batch - 1),
+        ).fetchone()
+        hi = upto if nxt is None else int(nxt[0])
+        with _conn_lock, _conn:
+            for s in stmts:
+                _conn.execute(s, {"lo": lo, "hi": hi})
+            _conn.execute("UPDATE schema_backfill SET cursor=? WHERE name=?", (hi, name))
+        lo = hi
+    _exec("DELETE FROM schema_backfill WHERE name=?", (name,))
+
+
+def _m001_baseline() -> None:
+    """Tables, legacy column fixes and indexes of the pre-versioned schema."""
     # users
     _exec(
         """
@@ -140,6 +967,8 @@ def _migrate() -> None:
         _exec("ALTER TABLE users ADD COLUMN last_bonus_date TEXT")
     if not _has_col("users", "last_daily_bonus_at"):
         _exec("ALTER TABLE users ADD COLUMN last_daily_bonus_at DATETIME")
+    if not _has_col("users", "active_chat_id"):
+        _exec("ALTER TABLE users ADD COLUMN active_chat_id INTEGER")
     if _has_col("users", "default_resp_size"):
         try:
             _exec("ALTER TABLE users DROP COLUMN default_resp_size")
@@ -245,22 +1074,7 @@ def _migrate() -> None:
     )"""
     )
 
-    # Full-text search mirror for messages
-    _exec(
-        """
-    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
-        content,
-        chat_id UNINDEXED,
-        is_user UNINDEXED
-    )"""
-    )
-    # Initial backfill if the FTS table is empty
-    r = _q("SELECT COUNT(*) AS c FROM messages_fts").fetchone()
-    if int(r["c"] or 0) == 0:
-        _exec(
-            "INSERT INTO messages_fts(rowid, content, chat_id, is_user) "
-            "SELECT id, content, chat_id, is_user FROM messages"
-        )
+    _migrate_fts()
 
     # favorites (characters)
     _exec(
@@ -357,32 +1171,506 @@ def _migrate() -> None:
     )"""
     )
 
-    # Rename legacy mode label
-    _exec("UPDATE users SET default_chat_mode = 'chat' WHERE default_chat_mode = 'live'")
-    _exec("UPDATE chats SET mode = 'chat' WHERE mode = 'live'")
+    _ensure_indexes()
+
+
+def _m002_live_mode_label() -> None:
+    """Rename the legacy 'live' chat mode to 'chat'."""
+    _backfill(
+        "users.live_mode",
+        "users",
+        "UPDATE users SET default_chat_mode='chat' "
+        "WHERE rowid > :lo AND rowid <= :hi AND default_chat_mode='live'",
+    )
+    _backfill(
+        "chats.live_mode",
+        "chats",
+        "UPDATE chats SET mode='chat' WHERE rowid > :lo AND rowid <= :hi AND mode='live'",
+    )
+
+
+def _m003_active_chat() -> None:
+    """Point ``users.active_chat_id`` at the most recent chat where unset."""
+    _backfill(
+        "users.active_chat_id",
+        "users",
+        """
+        UPDATE users SET active_chat_id = (
+            SELECT c.id FROM chats c
+             WHERE c.user_id = users.tg_id
+             ORDER BY c.updated_at DESC, c.id DESC
+             LIMIT 1
+        )
+        WHERE rowid > :lo AND rowid <= :hi AND active_chat_id IS NULL
+        """,
+    )
+
+
+# Managed secondary indexes: (name, table, columns). Every hot lookup in this
+# module must be served by one of them (see tests/test_query_plans.py).
+_INDEXES: Tuple[Tuple[str, str, str], ...] = (
+    ("idx_users_subscription", "users", "subscription, last_daily_bonus_at"),
+    ("idx_users_sub_end", "users", "sub_end"),
+    ("idx_characters_name", "characters", "name"),
+    ("idx_chats_user_updated", "chats", "user_id, updated_at"),
+    ("idx_chats_user_fav_updated", "chats", "user_id, is_favorite, updated_at"),
+    ("idx_chats_user_char", "chats", "user_id, char_id, updated_at"),
+    ("idx_chats_archive", "chats", "archived, updated_at"),
+    ("idx_messages_chat", "messages", "chat_id, id"),
+    ("idx_proactive_plan_due", "proactive_plan", "status, fire_at"),
+    ("idx_proactive_plan_user", "proactive_plan", "user_id, status, fire_at"),
+    ("idx_proactive_plan_chat", "proactive_plan", "chat_id"),
+    ("idx_proactive_log_user", "proactive_log", "user_id, sent_at"),
+    ("idx_proactive_log_chat", "proactive_log", "chat_id"),
+    ("idx_token_log_user", "token_log", "user_id, id"),
+    ("idx_toki_log_user", "toki_log", "user_id, id"),
+    ("idx_topups_user_status", "topups", "user_id, status"),
+    ("idx_topups_status_created", "topups", "status, created_at"),
+    ("idx_usage_daily_user", "usage_daily", "user_id, char_id"),
+    ("idx_token_holds_user", "token_holds", "user_id, expires_at"),
+    ("idx_token_holds_expires", "token_holds", "expires_at"),
+)
+
+
+def _m004_usage_daily() -> None:
+    """Create the ``usage_daily`` rollup and fill it from existing messages."""
+    _exec(
+        """
+    CREATE TABLE IF NOT EXISTS usage_daily (
+        day         TEXT NOT NULL,          -- YYYY-MM-DD (UTC)
+        user_id     INTEGER NOT NULL,
+        char_id     INTEGER NOT NULL,
+        model       TEXT NOT NULL DEFAULT '',
+        user_msgs   INTEGER NOT NULL DEFAULT 0,
+        ai_msgs     INTEGER NOT NULL DEFAULT 0,
+        in_tokens   INTEGER NOT NULL DEFAULT 0,
+        out_tokens  INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, user_id, char_id, model)
+    ) WITHOUT ROWID"""
+    )
+    _ensure_indexes()
+    # модель старых сообщений не сохранялась — берём текущую модель пользователя
+    _backfill(
+        "usage_daily",
+        "messages",
+        """
+        INSERT INTO usage_daily(day, user_id, char_id, model, user_msgs, ai_msgs, in_tokens, out_tokens)
+        SELECT CASE typeof(m.created_at) WHEN 'integer' THEN date(m.created_at, 'unixepoch')
+                                          ELSE date(m.created_at) END,
+               c.user_id, c.char_id, COALESCE(u.default_model, ''),
+               SUM(m.is_user=1), SUM(m.is_user=0),
+               SUM(COALESCE(m.usage_in, 0)), SUM(COALESCE(m.usage_out, 0))
+          FROM messages m
+          JOIN chats c ON c.id = m.chat_id
+          LEFT JOIN users u ON u.tg_id = c.user_id
+         WHERE m.rowid > :lo AND m.rowid <= :hi
+         GROUP BY 1, 2, 3, 4
+        ON CONFLICT(day, user_id, char_id, model) DO UPDATE SET
+            user_msgs  = user_msgs  + excluded.user_msgs,
+            ai_msgs    = ai_msgs    + excluded.ai_msgs,
+            in_tokens  = in_tokens  + excluded.in_tokens,
+            out_tokens = out_tokens + excluded.out_tokens
+        """,
+    )
+
+
+def _m005_user_counters() -> None:
+    """Create ``user_counters``; :func:`_m012_chat_totals` fills it."""
+    _exec(
+        """
+    CREATE TABLE IF NOT EXISTS user_counters (
+        user_id     INTEGER PRIMARY KEY,
+        user_msgs   INTEGER NOT NULL DEFAULT 0,
+        ai_msgs     INTEGER NOT NULL DEFAULT 0,
+        in_tokens   INTEGER NOT NULL DEFAULT 0,
+        out_tokens  INTEGER NOT NULL DEFAULT 0,
+        chat_count  INTEGER NOT NULL DEFAULT 0,
+        top_char_id INTEGER,
+        top_count   INTEGER NOT NULL DEFAULT 0
+    )"""
+    )
+
+
+def _m006_user_char_stats() -> None:
+    """Create ``user_char_stats`` and fill it from chats, messages and favourites."""
+    _exec(
+        """
+    CREATE TABLE IF NOT EXISTS user_char_stats (
+        user_id       INTEGER NOT NULL,
+        char_id       INTEGER NOT NULL,
+        last_use      DATETIME,
+        chat_count    INTEGER NOT NULL DEFAULT 0,
+        message_count INTEGER NOT NULL DEFAULT 0,
+        is_fav        INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, char_id)
+    ) WITHOUT ROWID"""
+    )
+    _backfill("user_char_stats", "users", _CHAR_STATS_REBUILD_SQL)
+
+
+def _m007_chat_archive() -> None:
+    """Archive tier for idle chats (``chats.archived`` + ``chat_archive``)."""
+    if not _has_col("chats", "archived"):
+        _exec("ALTER TABLE chats ADD COLUMN archived INTEGER NOT NULL DEFAULT 0")
+    _exec(
+        """
+    CREATE TABLE IF NOT EXISTS chat_archive (
+        chat_id     INTEGER NOT NULL,
+        seg         INTEGER NOT NULL,
+        msg_count   INTEGER NOT NULL,
+        raw_bytes   INTEGER NOT NULL,
+        last_at     DATETIME,
+        data        BLOB NOT NULL,          -- zlib(JSON [[id, is_user, content, in, out, created_at], ...])
+        PRIMARY KEY (chat_id, seg)
+    )"""
+    )
+    # восстановленные из архива строки в диапазоне доиндексации не должны
+    # попасть в FTS дважды — триггер вставки теперь тоже их пропускает
+    _exec("DROP TRIGGER IF EXISTS messages_fts_ai")
+    _exec(_FTS_TRIGGERS[0])
+    _ensure_indexes()
+
+
+def _m008_token_log_monthly() -> None:
+    """Monthly per-user totals that replace pruned ``token_log`` rows."""
+    _exec(
+        """
+    CREATE TABLE IF NOT EXISTS token_log_monthly (
+        user_id     INTEGER NOT NULL,
+        month       TEXT NOT NULL,          -- 'YYYY-MM'
+        credit      INTEGER NOT NULL DEFAULT 0,
+        debit       INTEGER NOT NULL DEFAULT 0,   -- <= 0
+        entries     INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, month)
+    ) WITHOUT ROWID"""
+    )
+
+
+def _m009_token_holds() -> None:
+    """Balance holds of turns in flight (see :func:`reserve`)."""
+    _exec(
+        """
+    CREATE TABLE IF NOT EXISTS token_holds (
+        id          INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id     INTEGER NOT NULL,
+        amount      INTEGER NOT NULL,
+        expires_at  INTEGER NOT NULL        -- unix time
+    )"""
+    )
+    _ensure_indexes()
+
+
+def _m010_chat_checkpoints() -> None:
+    """Summaries that replace the start of a chat in the model context."""
+    _exec(
+        """
+    CREATE TABLE IF NOT EXISTS chat_checkpoints (
+        chat_id          INTEGER NOT NULL,
+        upto_message_id  INTEGER NOT NULL,  -- сводка покрывает сообщения с id <= этого
+        summary          TEXT NOT NULL,
+        usage_in         INTEGER,
+        usage_out        INTEGER,
+        created_at       DATETIME DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (chat_id, upto_message_id)
+    ) WITHOUT ROWID"""
+    )
+
+
+# Горячие отметки времени хранятся как unix time (INTEGER, секунды UTC):
+# «сегодня» и «за неделю» — диапазоны по индексу, а не date()/strftime()
+# над каждой строкой. Объявленные типы и DEFAULT CURRENT_TIMESTAMP в схеме
+# прежние (менять их — перестраивать таблицы), поэтому каждая вставка в эти
+# таблицы передаёт время явно. Текст остался в журналах, которые только
+# чистятся по сроку, и в полях анкеты пользователя.
+# (таблица, колонка, пачки миграции: (таблица-драйвер, ключ) или None — одним UPDATE)
+_EPOCH_COLUMNS: Tuple[Tuple[str, str, Tuple[str, str] | None], ...] = (
+    ("messages", "created_at", ("messages", "rowid")),
+    ("chat_archive", "last_at", ("chat_archive", "rowid")),
+    ("chat_checkpoints", "created_at", None),  # строка на сжатие — единицы на чат
+    ("token_log", "created_at", ("token_log", "rowid")),
+    ("proactive_log", "sent_at", ("proactive_log", "rowid")),
+    ("chats", "updated_at", ("chats", "rowid")),
+    ("users", "last_proactive_at", ("users", "rowid")),
+    ("user_char_stats", "last_use", ("users", "user_id")),  # WITHOUT ROWID
+)
+
+
+def _m011_epoch_timestamps() -> None:
+    """Store the timestamps of :data:`_EPOCH_COLUMNS` as unix time."""
+    tables = {r[0] for r in _conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    for table, col, batch in _EPOCH_COLUMNS:
+        if table not in tables:
+            continue  # история уже перенесена в свой файл
+        sql = f"UPDATE {table} SET {col} = CAST(strftime('%s', {col}) AS INTEGER) WHERE typeof({col}) = 'text'"
+        if batch is None:
+            _exec(sql)
+            continue
+        driver, key = batch
+        _backfill(f"{table}.{col}.epoch", driver, f"{sql} AND {key} > :lo AND {key} <= :hi")
+
+
+def _m012_chat_totals() -> None:
+    """Per-chat message and token totals; ``user_counters`` is rebuilt from them."""
+    for col in _CHAT_TOTAL_COLS:
+        if not _has_col("chats", col):
+            _exec(f"ALTER TABLE chats ADD COLUMN {col} INTEGER NOT NULL DEFAULT 0")
+    tables = {r[0] for r in _conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    if "messages" in tables:
+        _fill_chat_totals()
+        return
+    # история уже в своём файле: считаем после ATTACH (_open), отметка переживёт
+    # рестарт; schema_backfill создан пачками прошлых шагов
+    _exec("INSERT OR IGNORE INTO schema_backfill(name, cursor, upto) VALUES (?, 0, 0)", (_CHAT_TOTALS_DEFERRED,))
+
+
+_MIGRATIONS: Tuple[Callable[[], None], ...] = (
+    _m001_baseline,
+    _m002_live_mode_label,
+    _m003_active_chat,
+    _m004_usage_daily,
+    _m005_user_counters,
+    _m006_user_char_stats,
+    _m007_chat_archive,
+    _m008_token_log_monthly,
+    _m009_token_holds,
+    _m010_chat_checkpoints,
+    _m011_epoch_timestamps,
+    _m012_chat_totals,
+)
+
+
+def _ensure_indexes() -> None:
+    """Bring ``idx_*`` indexes in line with :data:`_INDEXES`.
+
+    Missing indexes are created, indexes whose definition changed are rebuilt
+    and ``idx_*`` indexes no longer listed are dropped. Indexes of tables or
+    columns that a later migration step creates are skipped until that step runs.
+    """
+    tables = {r["name"] for r in _q("SELECT name FROM sqlite_master WHERE type='table'").fetchall()}
+    existing = {
+        r["name"]: " ".join((r["sql"] or "").split())
+        for r in _q(
+            "SELECT name, sql FROM sqlite_master WHERE type='index' AND name LIKE 'idx\\_%' ESCAPE '\\'"
+        ).fetchall()
+    }
+    # TEMP VIEW messages (split_history) перекрывает таблицу — индексы строим в main
+    wanted = {
+        name: f"CREATE INDEX {name} ON {table}({cols})"
+        for name, table, cols in _INDEXES
+        if table in tables and all(_has_col(table, c.split()[0]) for c in cols.split(","))
+    }
+    for name, sql in existing.items():
+        if wanted.get(name) != sql:
+            _exec(f"DROP INDEX IF EXISTS main.{name}")
+    for name, sql in wanted.items():
+        if existing.get(name) != sql:
+            _exec(sql.replace("CREATE INDEX ", "CREATE INDEX main.", 1))
+
+
+# ------------- Full-text search -------------
+# messages_fts — external-content индекс поверх messages: тексты хранятся
+# один раз, индекс поддерживают триггеры. Строки, существовавшие до создания
+# индекса (id в (cursor, upto] из fts_backfill), доиндексируются фоновыми
+# пачками; пока строка в этом диапазоне, триггеры её не трогают.
+_FTS_SQL = (
+    "CREATE VIRTUAL TABLE messages_fts USING fts5("
+    "content, chat_id UNINDEXED, is_user UNINDEXED, "
+    "content='messages', content_rowid='id')"
+)
+_FTS_PENDING = "EXISTS (SELECT 1 FROM fts_backfill WHERE {0}.id > cursor AND {0}.id <= upto)"
+_FTS_TRIGGERS = (
+    f"""
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages
+    WHEN NOT {_FTS_PENDING.format("new")} BEGIN
+        INSERT INTO messages_fts(rowid, content, chat_id, is_user)
+        VALUES (new.id, new.content, new.chat_id, new.is_user);
+    END""",
+    f"""
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages
+    WHEN NOT {_FTS_PENDING.format("old")} BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content, chat_id, is_user)
+        VALUES ('delete', old.id, old.content, old.chat_id, old.is_user);
+    END""",
+    f"""
+    CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content, chat_id, is_user ON messages
+    WHEN NOT {_FTS_PENDING.format("old")} BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content, chat_id, is_user)
+        VALUES ('delete', old.id, old.content, old.chat_id, old.is_user);
+        INSERT INTO messages_fts(rowid, content, chat_id, is_user)
+        VALUES (new.id, new.content, new.chat_id, new.is_user);
+    END""",
+)
+
+
+def _migrate_fts() -> None:
+    """Create the external-content index; replaces the old full-copy table."""
+    _exec(
+        """
+    CREATE TABLE IF NOT EXISTS fts_backfill (
+        id      INTEGER PRIMARY KEY CHECK (id = 1),
+        cursor  INTEGER NOT NULL,
+        upto    INTEGER NOT NULL
+    )"""
+    )
+    r = _q("SELECT sql FROM sqlite_master WHERE name='messages_fts'").fetchone()
+    if r is None or "content='messages'" not in (r["sql"] or ""):
+        assert _conn is not None
+        with _conn_lock, _conn:
+            # DML первым: открывает транзакцию, и DDL ниже попадает в неё же
+            _conn.execute(
+                "INSERT OR REPLACE INTO fts_backfill(id, cursor, upto) "
+                "SELECT 1, 0, COALESCE(MAX(id), 0) FROM messages"
+            )
+            _conn.execute("DELETE FROM fts_backfill WHERE cursor >= upto")
+            for name in ("messages_fts_ai", "messages_fts_ad", "messages_fts_au"):
+                _conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+            _conn.execute("DROP TABLE IF EXISTS messages_fts")
+            _conn.execute(_FTS_SQL)
+    for sql in _FTS_TRIGGERS:
+        _exec(sql)
+    _cur().fts_pending = None
+
+
+def fts_backfill_step(batch: int | None = None) -> bool:
+    """Index the next batch of pre-existing messages; ``False`` once done.
+
+    Progress is committed together with the batch, so an interrupted
+    backfill resumes where it stopped after a restart.
+    """
+    return any(_fan_out(lambda: _fts_backfill_step(batch)))
+
+
+def _fts_backfill_step(batch: int | None) -> bool:
+    with _on(_hist()):
+        return _fts_backfill_file(batch)
+
+
+def _fts_backfill_file(batch: int | None) -> bool:
+    sh = _cur()
+    if sh.fts_pending is None:
+        sh.fts_pending = _q("SELECT 1 FROM fts_backfill").fetchone() is not None
+    if not sh.fts_pending:
+        return False
+    batch = max(1, int(batch or _cfg("fts_backfill_batch", 2000)))
+    assert _conn is not None
+    with _conn_lock, _conn:
+        st = _conn.execute("SELECT cursor, upto FROM fts_backfill WHERE id=1").fetchone()
+        if st is None:
+            sh.fts_pending = False
+            return False
+        last = _conn.execute(
+            "SELECT MAX(id) FROM (SELECT id FROM messages WHERE id > ? AND id <= ? ORDER BY id LIMIT ?)",
+            (st["cursor"], st["upto"], batch),
+        ).fetchone()[0]
+        last = int(st["upto"] if last is None else last)
+        _conn.execute(
+            "INSERT INTO messages_fts(rowid, content, chat_id, is_user) "
+            "SELECT id, content, chat_id, is_user FROM messages WHERE id > ? AND id <= ?",
+            (st["cursor"], last),
+        )
+        if last >= int(st["upto"]):
+            _conn.execute("DELETE FROM fts_backfill")
+            sh.fts_pending = False
+        else:
+            _conn.execute("UPDATE fts_backfill SET cursor=? WHERE id=1", (last,))
+    return sh.fts_pending
+
+
+def fts_optimize(merge_pages: int | None = None) -> None:
+    """Merge FTS segments: a bounded ``merge`` step, or a full ``optimize``."""
+    if merge_pages:
+        sql, params = "INSERT INTO messages_fts(messages_fts, rank) VALUES ('merge', ?)", (int(merge_pages),)
+    else:
+        sql, params = "INSERT INTO messages_fts(messages_fts) VALUES ('optimize')", ()
+
+    def step() -> None:
+        with _on(_hist()):
+            _exec(sql, params)
+
+    _fan_out(step)
 
 
 # ------------- Users -------------
+# LRU+TTL кэш строк users. Все записи в users из этого модуля сбрасывают или
+# обновляют запись; ``_user_cache_gen`` защищает от того, чтобы читатель
+# положил в кэш строку, прочитанную до параллельной записи.
+_user_cache: "OrderedDict[int, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+_user_cache_lock = threading.Lock()
+_user_cache_gen = 0
+_user_cache_stats = {"hits": 0, "misses": 0}
+
+
+def invalidate_user(user_id: int | None = None) -> None:
+    """Drop one cached user row (or all of them)."""
+    global _user_cache_gen
+    with _user_cache_lock:
+        _user_cache_gen += 1
+        if user_id is None:
+            _user_cache.clear()
+        else:
+            _user_cache.pop(user_id, None)
+
+
+def _user_cache_set(user_id: int, col: str, value: Any) -> None:
+    with _user_cache_lock:
+        hit = _user_cache.get(user_id)
+        if hit is not None:
+            hit[1][col] = value
 
+
+def user_cache_stats() -> Dict[str, int]:
+    """Return hit/miss counters and the current size of the user cache."""
+    with _user_cache_lock:
+        return {**_user_cache_stats, "size": len(_user_cache)}
+
+
+@_sharded(user="user_id")
 def ensure_user(user_id: int, username: Optional[str] = None) -> None:
     row = _q("SELECT tg_id FROM users WHERE tg_id=?", (user_id,)).fetchone()
     if row:
         if username:
             _exec("UPDATE users SET username=? WHERE tg_id=?", (username, user_id))
+            invalidate_user(user_id)
         return
     _exec(
         "INSERT INTO users(tg_id, username) VALUES (?,?)",
         (user_id, username),
     )
+    invalidate_user(user_id)
 
 
 
 
+@_sharded(user="user_id")
 def get_user(user_id: int) -> Dict[str, Any] | None:
+    now = time.monotonic()
+    with _user_cache_lock:
+        hit = _user_cache.get(user_id)
+        if hit is not None and hit[0] > now:
+            _user_cache.move_to_end(user_id)
+            _user_cache_stats["hits"] += 1
+            row = dict(hit[1])
+        else:
+            _user_cache_stats["misses"] += 1
+            row, gen = None, _user_cache_gen
+    if row is not None:
+        # отложенные значения — уже без _user_cache_lock (_wb_put держит их в обратном порядке)
+        return _wb_overlay(user_id, row)
     r = _q("SELECT * FROM users WHERE tg_id=?", (user_id,)).fetchone()
-    return dict(r) if r else None
-
-
+    if not r:
+        return None
+    row = dict(r)
+    size = int(_cfg("user_cache_size", 10000))
+    with _user_cache_lock:
+        if size > 0 and gen == _user_cache_gen:
+            _user_cache[user_id] = (now + float(_cfg("user_cache_ttl_s", 30.0)), row)
+            _user_cache.move_to_end(user_id)
+            while len(_user_cache) > size:
+                _user_cache.popitem(last=False)
+    return _wb_overlay(user_id, dict(row))
+
+
+@_sharded(user="user_id")
 def set_user_field(user_id: int, field: str, value: Any) -> None:
     allowed = {
         "username",
@@ -404,17 +1692,41 @@ def set_user_field(user_id: int, field: str, value: Any) -> None:
     if field not in allowed:
         raise ValueError("invalid field")
     _exec(f"UPDATE users SET {field}=? WHERE tg_id=?", (value, user_id))
+    invalidate_user(user_id)
 
 
+@_sharded(user="user_id")
 def touch_activity(user_id: int) -> None:
+    if _wb_enabled():
+        _wb_put(user=(user_id, "last_activity_at", _utcnow_sql()))
+        return
     _exec(
         "UPDATE users SET last_activity_at=CURRENT_TIMESTAMP WHERE tg_id=?",
         (user_id,),
     )
+    invalidate_user(user_id)
 
 
     
 # ------------- Characters -------------
+# Версии персонажей для кэша system-подсказок (app/character.py): любое
+# изменение карточки выдаёт новый номер; номера не повторяются даже после
+# переинициализации базы.
+_char_seq = count(1)
+_char_epoch = next(_char_seq)
+_char_versions: Dict[int, int] = {}
+
+
+def character_version(char_id: int) -> int:
+    """Return a number that changes whenever the character card changes."""
+    return _char_versions.get(char_id, _char_epoch)
+
+
+def _bump_character(char_id: int) -> None:
+    _char_versions[char_id] = next(_char_seq)
+    invalidate_chat(char_id=char_id)
+
+
 def ensure_character(
     name: str,
     *,
@@ -462,11 +1774,13 @@ def ensure_character(
                 f"UPDATE characters SET {', '.join(fields)} WHERE id=?",
                 tuple(params),
             )
+            _bump_character(int(r["id"]))
         return int(r["id"])
     cur = _exec(
         "INSERT INTO characters(name, slug, fandom, info_short, photo_id, photo_path) VALUES (?,?,?,?,?,?)",
         (name, slug, fandom, info_short, photo_id, photo_path),
     )
+    _stats_cache.pop("char_count", None)
     return int(cur.lastrowid)
 
   
@@ -477,25 +1791,87 @@ def get_character(char_id: int) -> Dict[str, Any] | None:
     return dict(r) if r else None
 
 
+def count_characters(ttl: int = 60) -> int:
+    n = _cache_get("char_count", ttl)
+    if n is None:
+        n = int(_q("SELECT COUNT(*) FROM characters").fetchone()[0])
+        _cache_set("char_count", n)
+    return n
+
+
+def character_key(row: Dict[str, Any]) -> Tuple[int, int, int]:
+    """Position of a :func:`list_characters_for_user` row in catalog order."""
+    return (int(row.get("is_fav") or 0), int(row.get("last_use") or 0), int(row["id"]))
+
+
+_CATALOG_TAIL_SQL = """
+    SELECT c.*, 0 AS is_fav, NULL AS last_use
+      FROM characters c
+     WHERE {where} NOT EXISTS (
+            SELECT 1 FROM user_char_stats s
+             WHERE s.user_id=? AND s.char_id=c.id
+               AND (s.is_fav=1 OR s.last_use IS NOT NULL))
+     ORDER BY c.id {order}
+     LIMIT ? OFFSET ?
+"""
+
+
+@_sharded(user="user_id")
 def list_characters_for_user(
-    user_id: int, *, page: int, page_size: int
+    user_id: int,
+    *,
+    page: int = 1,
+    page_size: int,
+    after: Tuple[int, int, int] | None = None,
+    before: Tuple[int, int, int] | None = None,
 ) -> List[Dict[str, Any]]:
-    offset = max(0, (page - 1) * page_size)
-    rows = _q(
-        """
-        SELECT c.*,
-               CASE WHEN f.user_id IS NULL THEN 0 ELSE 1 END AS is_fav,
-               MAX(ch.updated_at) AS last_use
-          FROM characters c
-          LEFT JOIN fav_chars f ON f.char_id=c.id AND f.user_id=?
-          LEFT JOIN chats ch ON ch.char_id=c.id AND ch.user_id=?
-         GROUP BY c.id
-         ORDER BY is_fav DESC, COALESCE(last_use, 0) DESC, c.id DESC
-         LIMIT ? OFFSET ?
-    """,
-        (user_id, user_id, page_size, offset),
-    ).fetchall()
-    return [dict(r) for r in rows]
+    """Catalog page: favourites, then recently used, then the rest by id.
+
+    ``after``/``before`` are :func:`character_key` values of the last/first
+    row of the neighbouring page; without them ``page`` is used as an offset.
+    """
+    # «свои» персонажи пользователя — короткий список по ключу user_char_stats
+    head = [
+        dict(r)
+        for r in _q(
+            """
+            SELECT c.*, s.is_fav AS is_fav, s.last_use AS last_use
+              FROM user_char_stats s
+              JOIN characters c ON c.id=s.char_id
+             WHERE s.user_id=? AND (s.is_fav=1 OR s.last_use IS NOT NULL)
+             ORDER BY s.is_fav DESC, COALESCE(s.last_use, 0) DESC, c.id DESC
+        """,
+            (user_id,),
+        ).fetchall()
+    ]
+    # ключи «хвоста» — (0, 0, id) — всегда меньше ключей head
+    if before is not None:
+        res: List[Dict[str, Any]] = []
+        if before[0] == 0 and before[1] == 0:
+            rows = _q(
+                _CATALOG_TAIL_SQL.format(where="c.id > ? AND", order="ASC"),
+                (before[2], user_id, page_size, 0),
+            ).fetchall()
+            res = [dict(r) for r in rows]
+        if len(res) < page_size:
+            newer = [r for r in head if character_key(r) > tuple(before)]
+            res += newer[::-1][: page_size - len(res)]
+        return res[::-1]
+    if after is not None:
+        res = [r for r in head if character_key(r) < tuple(after)][:page_size]
+        tail_from = after[2] if after[0] == 0 and after[1] == 0 else None
+        offset = 0
+    else:
+        offset = max(0, (page - 1) * page_size)
+        res = head[offset:offset + page_size]
+        tail_from, offset = None, max(0, offset - len(head))
+    if len(res) < page_size:
+        where, params = "", [user_id, page_size - len(res), offset]
+        if tail_from is not None:
+            where, params = "c.id < ? AND", [tail_from, *params]
+        rows = _q(_CATALOG_TAIL_SQL.format(where=where, order="DESC"), tuple(params)).fetchall()
+        res.extend(dict(r) for r in rows)
+    return res
 
 
 def set_character_prompt(
@@ -513,18 +1889,22 @@ def set_character_prompt(
         "UPDATE characters SET prompt=?, keywords=? WHERE id=?",
         (prompt, keywords, row["id"]),
     )
+    _bump_character(int(row["id"]))
 
 
 def set_character_photo_path(char_id: int, file_path: str) -> None:
     _exec("UPDATE characters SET photo_path=? WHERE id=?", (file_path, char_id))
+    _bump_character(char_id)
 
 
 def set_character_photo(char_id: int, file_id: str | None) -> None:
     """Store Telegram file ID for a character photo."""
     _exec("UPDATE characters SET photo_id=? WHERE id=?", (file_id, char_id))
+    _bump_character(char_id)
 
 
 
+@_sharded(user="user_id")
 def toggle_fav_char(
     user_id: int, char_id: int, *, allow_max: int | None = None
 ) -> bool:
@@ -532,8 +1912,11 @@ def toggle_fav_char(
         "SELECT 1 FROM fav_chars WHERE user_id=? AND char_id=?",
         (user_id, char_id),
     ).fetchone()
+    assert _conn is not None
     if r:
-        _exec("DELETE FROM fav_chars WHERE user_id=? AND char_id=?", (user_id, char_id))
+        with _conn_lock, _conn:
+            _conn.execute("DELETE FROM fav_chars WHERE user_id=? AND char_id=?", (user_id, char_id))
+            _char_stats(_conn, user_id, char_id, is_fav=False)
         return False
     if allow_max is not None:
         cnt = (
@@ -544,13 +1927,16 @@ def toggle_fav_char(
         )
         if int(cnt) >= int(allow_max):
             return False
-    _exec(
-        "INSERT OR IGNORE INTO fav_chars(user_id, char_id) VALUES (?,?)",
-        (user_id, char_id),
-    )
+    with _conn_lock, _conn:
+        _conn.execute(
+            "INSERT OR IGNORE INTO fav_chars(user_id, char_id) VALUES (?,?)",
+            (user_id, char_id),
+        )
+        _char_stats(_conn, user_id, char_id, is_fav=True)
     return True
 
 
+@_sharded(user="user_id")
 def is_fav_char(user_id: int, char_id: int) -> bool:
     r = _q(
         "SELECT 1 FROM fav_chars WHERE user_id=? AND char_id=?",
@@ -559,11 +1945,140 @@ def is_fav_char(user_id: int, char_id: int) -> bool:
     return bool(r)
 
 
+# user_char_stats — сводка по паре (пользователь, персонаж) для каталога и
+# карточки персонажа. Обновляется в транзакциях create_chat, add_message,
+# turn_commit, delete_chat и toggle_fav_char.
+_CHAR_STATS_REBUILD_SQL = (
+    "DELETE FROM user_char_stats WHERE user_id > :lo AND user_id <= :hi",
+    """
+    INSERT OR REPLACE INTO user_char_stats(user_id, char_id, last_use, chat_count, message_count, is_fav)
+    SELECT k.user_id, k.char_id,
+           (SELECT MAX(c.updated_at) FROM chats c
+             WHERE c.user_id=k.user_id AND c.char_id=k.char_id),
+           (SELECT COUNT(*) FROM chats c
+             WHERE c.user_id=k.user_id AND c.char_id=k.char_id),
+           (SELECT COUNT(*) FROM chats c JOIN messages m ON m.chat_id=c.id
+             WHERE c.user_id=k.user_id AND c.char_id=k.char_id),
+           EXISTS (SELECT 1 FROM fav_chars f
+                    WHERE f.user_id=k.user_id AND f.char_id=k.char_id)
+      FROM (SELECT user_id, char_id FROM chats WHERE user_id > :lo AND user_id <= :hi
+            UNION
+            SELECT user_id, char_id FROM fav_chars WHERE user_id > :lo AND user_id <= :hi) k
+""",
+)
+
+
+def _char_stats(
+    conn: sqlite3.Connection,
+    user_id: int,
+    char_id: int,
+    *,
+    chats: int = 0,
+    messages: int = 0,
+    last_use: int | None = None,
+    is_fav: bool | None = None,
+) -> None:
+    conn.execute(
+        """
+        INSERT INTO user_char_stats(user_id, char_id, last_use, chat_count, message_count, is_fav)
+        VALUES (:u, :c, :t, MAX(:dc, 0), MAX(:dm, 0), COALESCE(:f, 0))
+        ON CONFLICT(user_id, char_id) DO UPDATE SET
+            chat_count    = MAX(chat_count + :dc, 0),
+            message_count = MAX(message_count + :dm, 0),
+            last_use      = COALESCE(:t, last_use),
+            is_fav        = COALESCE(:f, is_fav)
+        """,
+        {
+            "u": user_id,
+            "c": char_id,
+            "t": last_use,
+            "dc": chats,
+            "dm": messages,
+            "f": None if is_fav is None else int(is_fav),
+        },
+    )
+
+
+@_sharded(user="user_id")
+def rebuild_user_char_stats(user_id: int | None = None) -> None:
+    """Recompute ``user_char_stats`` from chats, messages and favourites."""
+    assert _conn is not None
+    if user_id is None:
+        _fan_out(lambda: _backfill("user_char_stats", "users", _CHAR_STATS_REBUILD_SQL))
+        return
+    with _conn_lock, _conn:
+        for sql in _CHAR_STATS_REBUILD_SQL:
+            _conn.execute(sql, {"lo": int(user_id) - 1, "hi": int(user_id)})
+
+
+@_sharded(user="user_id")
+def get_user_char_stats(user_id: int, char_id: int) -> Dict[str, Any]:
+    r = _q(
+        "SELECT last_use, chat_count, message_count, is_fav FROM user_char_stats WHERE user_id=? AND char_id=?",
+        (user_id, char_id),
+    ).fetchone()
+    if not r:
+        return {"last_use": None, "chat_count": 0, "message_count": 0, "is_fav": 0}
+    return dict(r)
+
+
 # ------------- Chats & Messages -------------
+# LRU-кэш строк get_chat (чат + имя/фото персонажа). Записи обновляются на
+# месте (updated_at, cached_tokens) или сбрасываются при смене режима,
+# избранного, удалении чата и правке персонажа.
+_chat_cache: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+_chat_cache_lock = threading.Lock()
+_chat_cache_gen = 0
+
+
+def invalidate_chat(
+    chat_id: int | None = None, *, user_id: int | None = None, char_id: int | None = None
+) -> None:
+    """Drop cached chat rows by id, owner or character (all when no filter)."""
+    global _chat_cache_gen
+    with _chat_cache_lock:
+        _chat_cache_gen += 1
+        if chat_id is None and user_id is None and char_id is None:
+            _chat_cache.clear()
+            return
+        if chat_id is not None:
+            _chat_cache.pop(chat_id, None)
+        if user_id is not None or char_id is not None:
+            for cid, row in list(_chat_cache.items()):
+                if row["user_id"] == user_id or row["char_id"] == char_id:
+                    del _chat_cache[cid]
+
+
+def _chat_cache_set(chat_id: int, col: str, value: Any) -> None:
+    with _chat_cache_lock:
+        row = _chat_cache.get(chat_id)
+        if row is not None:
+            row[col] = value
+
+
+@_sharded(user="user_id")
+def set_active_chat(user_id: int, chat_id: int) -> None:
+    """Make ``chat_id`` the chat that plain text messages of the user go to."""
+    u = get_user(user_id) or {}
+    if u.get("active_chat_id") == chat_id:
+        return
+    _exec(
+        """
+        UPDATE users SET active_chat_id=?
+         WHERE tg_id=? AND EXISTS (SELECT 1 FROM chats WHERE id=? AND user_id=?)
+        """,
+        (chat_id, user_id, chat_id, user_id),
+    )
+    invalidate_user(user_id)
+
+
+@_sharded(user="user_id")
 def update_user_chats_mode(user_id: int, new_mode: str) -> None:
     _exec("UPDATE chats SET mode=? WHERE user_id=?", (new_mode, user_id))
+    invalidate_chat(user_id=user_id)
 
 
+@_sharded(user="user_id")
 def create_chat(
     user_id: int,
     char_id: int,
@@ -580,20 +2095,38 @@ def create_chat(
         (user_id, char_id),
     ).fetchone()
     seq_no = int((r["c"] or 0) + 1)
-    params = (user_id, char_id, mode, seq_no)
-    assert len(params) == 4
-    cur = _exec(
-        "INSERT INTO chats(user_id,char_id,mode,seq_no) VALUES (?,?,?,?)",
-        params,
-    )
-    return int(cur.lastrowid)
+    now = int(time.time())
+    params = (user_id, char_id, mode, seq_no, now)
+    assert len(params) == 5
+    assert _conn is not None
+    with _conn_lock:
+        with _conn:
+            cur = _conn.execute(
+                "INSERT INTO chats(id,user_id,char_id,mode,seq_no,updated_at) VALUES (?,?,?,?,?,?)",
+                (_next_id("chats"), *params),
+            )
+            chat_id = int(cur.lastrowid)
+            _conn.execute(
+                "UPDATE users SET active_chat_id=? WHERE tg_id=?", (chat_id, user_id)
+            )
+            _count_chat(_conn, user_id, 1)
+            _char_stats(_conn, user_id, char_id, chats=1, last_use=now)
+    _user_cache_set(user_id, "active_chat_id", chat_id)
+    return chat_id
 
 
+@_sharded(row="chat_id")
 def get_chat(chat_id: int) -> Dict[str, Any] | None:
+    with _chat_cache_lock:
+        row = _chat_cache.get(chat_id)
+        if row is not None:
+            _chat_cache.move_to_end(chat_id)
+            return dict(row)
+        gen = _chat_cache_gen
     r = _q(
         """
         SELECT c.id, c.user_id, c.char_id, c.mode, c.min_delay_ms, c.seq_no,
-               c.is_favorite, c.cached_tokens, c.created_at, c.updated_at,
+               c.is_favorite, c.cached_tokens, c.created_at, c.updated_at, c.archived,
                ch.name as char_name, ch.photo_id as char_photo, ch.fandom as char_fandom
           FROM chats c
           JOIN characters ch ON ch.id=c.char_id
@@ -601,38 +2134,87 @@ def get_chat(chat_id: int) -> Dict[str, Any] | None:
     """,
         (chat_id,),
     ).fetchone()
-    return dict(r) if r else None
+    if not r:
+        return None
+    row = dict(r)
+    size = int(_cfg("chat_cache_size", 5000))
+    with _chat_cache_lock:
+        if size > 0 and gen == _chat_cache_gen:
+            _chat_cache[chat_id] = row
+            while len(_chat_cache) > size:
+                _chat_cache.popitem(last=False)
+    return dict(row)
 
 
+@_sharded(row="chat_id")
 def get_cached_tokens(chat_id: int) -> int:
     """Return previously cached total tokens for the chat."""
+    with _chat_cache_lock:
+        cached = _chat_cache.get(chat_id)
+        if cached is not None:
+            return int(cached["cached_tokens"] or 0)
     row = _q("SELECT cached_tokens FROM chats WHERE id=?", (chat_id,)).fetchone()
     return int(row["cached_tokens"] if row and row["cached_tokens"] is not None else 0)
 
 
+@_sharded(row="chat_id")
 def set_cached_tokens(chat_id: int, amount: int) -> None:
     """Store total token usage for the chat."""
     _exec("UPDATE chats SET cached_tokens=? WHERE id=?", (int(amount), chat_id))
+    _chat_cache_set(chat_id, "cached_tokens", int(amount))
+
+
+@_sharded(user="user_id")
+def count_user_chats(user_id: int) -> int:
+    """Number of the user's chats (kept in ``user_counters``)."""
+    r = _q("SELECT chat_count FROM user_counters WHERE user_id=?", (user_id,)).fetchone()
+    return int(r["chat_count"]) if r else 0
+
+
+def chat_key(row: Dict[str, Any]) -> Tuple[int, int, int]:
+    """Position of a :func:`list_user_chats` row in list order."""
+    return (int(row.get("is_favorite") or 0), int(row.get("updated_at") or 0), int(row["id"]))
 
 
-def list_user_chats(user_id: int, *, page: int, page_size: int) -> List[Dict[str, Any]]:
-    offset = max(0, (page - 1) * page_size)
+@_sharded(user="user_id")
+def list_user_chats(
+    user_id: int,
+    *,
+    page: int = 1,
+    page_size: int,
+    after: Tuple[int, int, int] | None = None,
+    before: Tuple[int, int, int] | None = None,
+) -> List[Dict[str, Any]]:
+    """User's chats, favourites first, then by ``updated_at`` (newest first).
+
+    ``after``/``before`` are :func:`chat_key` values of the last/first row of
+    the neighbouring page (a range scan); without them ``page`` is an offset.
+    """
+    where, order, params = "", "DESC", [user_id]
+    if after is not None:
+        where, params = "AND (c.is_favorite, c.updated_at, c.id) < (?,?,?)", [user_id, *after]
+    elif before is not None:
+        where, order = "AND (c.is_favorite, c.updated_at, c.id) > (?,?,?)", "ASC"
+        params = [user_id, *before]
+    offset = 0 if after is not None or before is not None else max(0, (page - 1) * page_size)
     rows = _q(
-        """
+        f"""
         SELECT c.id, c.user_id, c.char_id, c.mode, c.min_delay_ms, c.seq_no,
                c.is_favorite, c.cached_tokens, c.created_at, c.updated_at,
                ch.name as char_name
           FROM chats c
           JOIN characters ch ON ch.id=c.char_id
-         WHERE c.user_id=?
-         ORDER BY c.is_favorite DESC, c.updated_at DESC
+         WHERE c.user_id=? {where}
+         ORDER BY c.is_favorite {order}, c.updated_at {order}, c.id {order}
          LIMIT ? OFFSET ?
     """,
-        (user_id, page_size, offset),
+        (*params, page_size, offset),
     ).fetchall()
-    return [dict(r) for r in rows]
+    res = [dict(r) for r in rows]
+    return res[::-1] if before is not None else res
 
 
+@_sharded(user="user_id")
 def list_user_chats_by_char(
     user_id: int, char_id: int, *, limit: int = 10
 ) -> List[Dict[str, Any]]:
@@ -652,7 +2234,17 @@ def list_user_chats_by_char(
     return [dict(r) for r in rows]
 
 
+@_sharded(user="user_id")
 def get_last_chat(user_id: int) -> Dict[str, Any] | None:
+    """Return the user's active chat (see :func:`set_active_chat`)."""
+    u = get_user(user_id)
+    if not u:
+        return None
+    if u.get("active_chat_id"):
+        ch = get_chat(int(u["active_chat_id"]))
+        if ch and int(ch["user_id"]) == user_id:
+            return ch
+    # указатель пуст или устарел — по старинке берём самый свежий чат
     r = _q(
         """
         SELECT c.id, c.user_id, c.char_id, c.mode, c.min_delay_ms, c.seq_no,
@@ -661,7 +2253,7 @@ def get_last_chat(user_id: int) -> Dict[str, Any] | None:
           FROM chats c
           JOIN characters ch ON ch.id=c.char_id
          WHERE c.user_id=?
-         ORDER BY c.updated_at DESC
+         ORDER BY c.updated_at DESC, c.id DESC
          LIMIT 1
     """,
         (user_id,),
@@ -669,12 +2261,14 @@ def get_last_chat(user_id: int) -> Dict[str, Any] | None:
     return dict(r) if r else None
 
 
+@_sharded(user="user_id")
 def toggle_fav_chat(user_id: int, chat_id: int, *, allow_max: int) -> bool:
     ch = get_chat(chat_id) or {}
     if not ch or int(ch["user_id"]) != user_id:
         return False
     if ch["is_favorite"]:
         _exec("UPDATE chats SET is_favorite=0 WHERE id=?", (chat_id,))
+        invalidate_chat(chat_id)
         return False
     r = _q(
         "SELECT COUNT(*) AS c FROM chats WHERE user_id=? AND is_favorite=1",
@@ -683,9 +2277,112 @@ def toggle_fav_chat(user_id: int, chat_id: int, *, allow_max: int) -> bool:
     if int(r["c"] or 0) >= int(allow_max):
         return False
     _exec("UPDATE chats SET is_favorite=1 WHERE id=?", (chat_id,))
+    invalidate_chat(chat_id)
     return True
 
 
+# Хвосты чатов: последние ``tail_size`` сообщений активных чатов в памяти,
+# чтобы сборка контекста не читала messages. ``complete`` — в хвосте весь чат.
+# Неактивные чаты вытесняются по LRU, суммарный объём текста ограничен
+# ``tail_cache_bytes``.
+class _Tail:
+    __slots__ = ("rows", "complete", "size")
+
+    def __init__(self, rows: List[Dict[str, Any]], maxlen: int, complete: bool):
+        self.rows: "deque[Dict[str, Any]]" = deque(rows, maxlen=maxlen)
+        self.complete = complete
+        self.size = sum(len(r["content"]) for r in self.rows)
+
+
+_tails: "OrderedDict[int, _Tail]" = OrderedDict()
+_tails_lock = threading.Lock()
+_tails_gen = 0
+_tails_bytes = 0
+
+
+def drop_tail(chat_id: int | None = None) -> None:
+    """Forget the cached message tail of a chat (of every chat when ``None``)."""
+    global _tails_gen, _tails_bytes
+    with _tails_lock:
+        _tails_gen += 1
+        if chat_id is None:
+            _tails.clear()
+            _tails_bytes = 0
+            return
+        tail = _tails.pop(chat_id, None)
+        if tail is not None:
+            _tails_bytes -= tail.size
+
+
+def _tail_trim() -> None:
+    global _tails_bytes
+    cap = int(_cfg("tail_cache_bytes", 8 * 1024 * 1024))
+    while _tails and _tails_bytes > cap:
+        _cid, tail = _tails.popitem(last=False)
+        _tails_bytes -= tail.size
+
+
+def _tail_append(chat_id: int, row: Dict[str, Any]) -> None:
+    global _tails_gen, _tails_bytes
+    with _tails_lock:
+        _tails_gen += 1
+        tail = _tails.get(chat_id)
+        if tail is None:
+            return
+        if len(tail.rows) == tail.rows.maxlen:
+            tail.size -= len(tail.rows[0]["content"])
+            _tails_bytes -= len(tail.rows[0]["content"])
+            tail.complete = False
+        tail.rows.append(row)
+        tail.size += len(row["content"])
+        _tails_bytes += len(row["content"])
+        _tails.move_to_end(chat_id)
+        _tail_trim()
+
+
+def _tail_get(chat_id: int, limit: int | None) -> List[Dict[str, Any]] | None:
+    with _tails_lock:
+        tail = _tails.get(chat_id)
+        if tail is None:
+            return None
+        if limit is None or limit > len(tail.rows):
+            if not tail.complete:
+                return None
+            limit = len(tail.rows)
+        _tails.move_to_end(chat_id)
+        rows = list(tail.rows)[len(tail.rows) - limit:] if limit else []
+    return [dict(r) for r in rows]
+
+
+def _tail_after(chat_id: int, after_id: int) -> List[Dict[str, Any]] | None:
+    """Cached rows newer than ``after_id``, if the tail reaches back that far."""
+    with _tails_lock:
+        tail = _tails.get(chat_id)
+        if tail is None or not (tail.complete or (tail.rows and tail.rows[0]["id"] <= after_id)):
+            return None
+        _tails.move_to_end(chat_id)
+        rows = [r for r in tail.rows if r["id"] > after_id]
+    return [dict(r) for r in rows]
+
+
+def _tail_fill(chat_id: int, gen: int, rows: List[Dict[str, Any]], complete: bool) -> None:
+    global _tails_bytes
+    size = int(_cfg("tail_size", 50))
+    with _tails_lock:
+        if size <= 0 or gen != _tails_gen or chat_id in _tails:
+            return
+        tail = _Tail(rows[-size:], size, complete and len(rows) <= size)
+        _tails[chat_id] = tail
+        _tails_bytes += tail.size
+        _tail_trim()
+
+
+_INSERT_MESSAGE_SQL = (
+    "INSERT INTO messages(chat_id,is_user,content,usage_in,usage_out,created_at) VALUES (?,?,?,?,?,?)"
+)
+
+
+@_sharded(row="chat_id")
 def add_message(
     chat_id: int,
     *,
@@ -693,6 +2390,7 @@ def add_message(
     content: str,
     usage_in: int | None = None,
     usage_out: int | None = None,
+    model: str | None = None,
     commit: bool = True,
 ) -> int:
 
@@ -700,110 +2398,252 @@ def add_message(
 
     All DB statements are executed within a transaction. By default the
     transaction is committed, but callers may disable auto-commit and manage
-    the transaction themselves by passing ``commit=False``.
+    the transaction themselves by passing ``commit=False``. With a separate
+    history file the message is committed there first, without the main
+    write lock, and removed again if the main transaction fails.
     """
 
+    ch = _unarchived(chat_id)
+    now = int(time.time())
+    if ch and model is None:
+        u = get_user(int(ch["user_id"])) or {}
+        model = u.get("default_model") or getattr(settings, "default_model", None)
     assert _conn is not None
-    with _conn_lock:
-        try:
-            cur = _conn.execute(
-                "INSERT INTO messages(chat_id,is_user,content,usage_in,usage_out) VALUES (?,?,?,?,?)",
-                (chat_id, 1 if is_user else 0, content, usage_in, usage_out),
-            )
-            msg_id = int(cur.lastrowid)
-            _conn.execute(
-                "INSERT INTO messages_fts(rowid, content, chat_id, is_user) VALUES (?,?,?,?)",
-                (msg_id, content, chat_id, 1 if is_user else 0),
-            )
-            _conn.execute(
-                "UPDATE chats SET updated_at=CURRENT_TIMESTAMP WHERE id=?",
-                (chat_id,),
-            )
-        except Exception:
-            if commit:
-                _conn.rollback()
-            raise
-        else:
+    row = (chat_id, 1 if is_user else 0, content, usage_in, usage_out, now)
+    hist = _hist()
+    split = hist is not _cur()
+    msg_id = 0
+    if split:
+        with _on(hist), _conn_lock:
+            msg_id = int(_conn.execute(_INSERT_MESSAGE_SQL, row).lastrowid)
             if commit:
                 _conn.commit()
-        return msg_id
+    try:
+        with _conn_lock:
+            try:
+                if not split:
+                    msg_id = int(_conn.execute(_INSERT_MESSAGE_SQL, row).lastrowid)
+                _book_message(_conn, ch, chat_id, now, model, is_user, usage_in, usage_out)
+            except Exception:
+                if commit:
+                    _conn.rollback()
+                raise
+            else:
+                if commit:
+                    _conn.commit()
+    except Exception:
+        if split and commit:
+            with _on(hist), _conn_lock, _conn:
+                _conn.execute("DELETE FROM messages WHERE id=?", (msg_id,))
+        raise
+    if commit:
+        _message_cached(ch, msg_id, row)
+    else:
+        invalidate_chat(chat_id)
+        drop_tail(chat_id)
+        if ch and ch["user_id"] is not None:
+            _user_cache_set(int(ch["user_id"]), "active_chat_id", chat_id)
+    return msg_id
 
 
-def compress_history(
+def _book_message(
+    conn: sqlite3.Connection,
+    ch: Dict[str, Any] | None,
+    chat_id: int,
+    now: int,
+    model: str | None,
+    is_user: bool,
+    usage_in: int | None,
+    usage_out: int | None,
+) -> None:
+    """Main-file bookkeeping of a new message inside the caller's transaction."""
+    # итоги чата — до _count_message: топ-персонаж считается по ним
+    conn.execute(
+        """
+        UPDATE chats SET updated_at=?,
+               user_msgs = user_msgs + ?, ai_msgs = ai_msgs + ?,
+               in_tokens = in_tokens + ?, out_tokens = out_tokens + ?
+         WHERE id=?
+        """,
+        (now, 1 if is_user else 0, 0 if is_user else 1, int(usage_in or 0), int(usage_out or 0), chat_id),
+    )
+    if ch:
+        _rollup_usage(
+            conn, _utc_day(now), int(ch["user_id"]), int(ch["char_id"]), model or "",
+            is_user, int(usage_in or 0), int(usage_out or 0),
+        )
+        _count_message(
+            conn, int(ch["user_id"]), int(ch["char_id"]),
+            is_user, int(usage_in or 0), int(usage_out or 0),
+        )
+        _char_stats(conn, int(ch["user_id"]), int(ch["char_id"]), messages=1, last_use=now)
+    if ch and ch["user_id"] is not None:
+        conn.execute(
+            """
+            UPDATE users SET active_chat_id=?
+             WHERE tg_id=? AND active_chat_id IS NOT ?
+            """,
+            (chat_id, ch["user_id"], chat_id),
+        )
+
+
+def _message_cached(ch: Dict[str, Any] | None, msg_id: int, row: Tuple) -> None:
+    """Reflect a committed message (an ``_INSERT_MESSAGE_SQL`` row) in the caches."""
+    chat_id, is_user, content, usage_in, usage_out, now = row
+    _chat_cache_set(chat_id, "updated_at", now)
+    _tail_append(
+        chat_id,
+        {
+            "id": msg_id,
+            "chat_id": chat_id,
+            "is_user": is_user,
+            "content": content,
+            "usage_in": usage_in,
+            "usage_out": usage_out,
+            "created_at": now,
+        },
+    )
+    if ch and ch["user_id"] is not None:
+        _user_cache_set(int(ch["user_id"]), "active_chat_id", chat_id)
 
+
+@_sharded(row="chat_id")
+def compress_history(
     chat_id: int,
     summary: str,
     *,
     usage_in: int | None = None,
     usage_out: int | None = None,
 ) -> None:
-    """Удаляет сообщения чата и сохраняет краткое содержание."""
+    """Записывает контрольную точку: сводку сообщений чата по последнее.
 
-    assert _conn is not None
-    with _conn_lock:
-        with _conn:
-            _conn.execute("DELETE FROM messages WHERE chat_id=?", (chat_id,))
-            _conn.execute("DELETE FROM messages_fts WHERE chat_id=?", (chat_id,))
-            add_message(
-                chat_id,
-                is_user=False,
-                content=summary,
-                usage_in=usage_in,
-                usage_out=usage_out,
-                commit=False,
-            )
+    Сами сообщения остаются (экспорт и поиск видят всю историю); контекст
+    модели дальше собирается из сводки и сообщений после неё. Сводка — не
+    ответ модели: счётчики сообщений и статистика расхода не меняются, расход
+    хранится в самой контрольной точке.
+    """
+
+    _unarchived(chat_id)
+    now = int(time.time())
+    # только файл истории: блокировку основного файла (биллинг) не берём
+    hist = _hist()
+    with hist.lock, hist.conn:
+        upto = hist.conn.execute(
+            "SELECT MAX(id) FROM messages WHERE chat_id=?", (chat_id,)
+        ).fetchone()[0]
+        hist.conn.execute(
+            "INSERT OR REPLACE INTO chat_checkpoints"
+            "(chat_id, upto_message_id, summary, usage_in, usage_out, created_at) VALUES (?,?,?,?,?,?)",
+            (chat_id, int(upto or 0), summary, usage_in, usage_out, now),
+        )
+
+
+@_sharded(row="chat_id")
+def latest_checkpoint(chat_id: int) -> Dict[str, Any] | None:
+    """The newest checkpoint of a chat (see :func:`compress_history`)."""
+    with _on(_hist()):
+        r = _q(
+            "SELECT * FROM chat_checkpoints WHERE chat_id=? ORDER BY upto_message_id DESC LIMIT 1",
+            (chat_id,),
+        ).fetchone()
+    return dict(r) if r else None
 
 
-def list_messages(chat_id: int, *, limit: int | None = None) -> List[Dict[str, Any]]:
+@_sharded(row="chat_id")
+def list_messages(
+    chat_id: int, *, limit: int | None = None, after_id: int | None = None
+) -> List[Dict[str, Any]]:
+    """Messages of a chat, oldest first; ``after_id`` keeps only newer ones."""
+    if after_id is not None:
+        return _messages_after(chat_id, int(after_id), limit)
+    cached = _tail_get(chat_id, limit or None)
+    if cached is not None:
+        return cached
+    _unarchived(chat_id)
+    with _tails_lock:
+        gen = _tails_gen
+    size = int(_cfg("tail_size", 50))
     if limit:
-        rows = _q(
-            "SELECT * FROM messages WHERE chat_id=? ORDER BY id DESC LIMIT ?",
-            (chat_id, limit),
-        ).fetchall()
-        rows = list(reversed(rows))
-    else:
+        fetch = max(int(limit), size)
+        with _on(_hist()):
+            rows = _q(
+                "SELECT * FROM messages WHERE chat_id=? ORDER BY id DESC LIMIT ?",
+                (chat_id, fetch),
+            ).fetchall()
+        res = [dict(r) for r in reversed(rows)]
+        _tail_fill(chat_id, gen, res, complete=len(rows) < fetch)
+        return [dict(r) for r in res[-int(limit):]]
+    with _on(_hist()):
         rows = _q(
             "SELECT * FROM messages WHERE chat_id=? ORDER BY id", (chat_id,)
         ).fetchall()
+    res = [dict(r) for r in rows]
+    _tail_fill(chat_id, gen, res, complete=True)
+    return [dict(r) for r in res]
+
+
+def _messages_after(chat_id: int, after_id: int, limit: int | None) -> List[Dict[str, Any]]:
+    """Range read ``id > after_id`` over ``idx_messages_chat`` (or the tail)."""
+    cached = _tail_after(chat_id, after_id)
+    if cached is not None:
+        return cached[-int(limit):] if limit else cached
+    _unarchived(chat_id)
+    with _on(_hist()):
+        if limit:
+            rows = _q(
+                "SELECT * FROM messages WHERE chat_id=? AND id > ? ORDER BY id DESC LIMIT ?",
+                (chat_id, after_id, int(limit)),
+            ).fetchall()[::-1]
+        else:
+            rows = _q(
+                "SELECT * FROM messages WHERE chat_id=? AND id > ? ORDER BY id",
+                (chat_id, after_id),
+            ).fetchall()
     return [dict(r) for r in rows]
 
 
+@_sharded(row="chat_id")
 def search_messages(chat_id: int, query: str, limit: int = 20) -> List[Dict[str, Any]]:
     """Search messages of a chat using full-text search."""
     # Strip characters that commonly break FTS queries
     query = re.sub(r'["*]', '', query).strip()
     if not query:
         return []
+    _unarchived(chat_id)
     try:
-        rows = _q(
-            """
-            SELECT rowid AS id, content, chat_id, is_user
-              FROM messages_fts
-             WHERE messages_fts MATCH ? AND chat_id=?
-             ORDER BY bm25(messages_fts)
-             LIMIT ?
-        """,
-            (query, chat_id, limit),
-        ).fetchall()
+        with _on(_hist()):
+            rows = _q(
+                """
+                SELECT rowid AS id, content, chat_id, is_user
+                  FROM messages_fts
+                 WHERE messages_fts MATCH ? AND chat_id=?
+                 ORDER BY bm25(messages_fts)
+                 LIMIT ?
+            """,
+                (query, chat_id, limit),
+            ).fetchall()
     except sqlite3.OperationalError:
         return []
     return [dict(r) for r in rows]
 
 
+@_sharded(row="chat_id")
 def last_message_ts(chat_id: int) -> Optional[datetime]:
-    r = _q(
-        "SELECT created_at FROM messages WHERE chat_id=? ORDER BY id DESC LIMIT 1",
-        (chat_id,),
-    ).fetchone()
-    if not r:
-        return None
-    try:
-        # SQLite returns string; assume UTC naive -> as UTC
-        return datetime.fromisoformat(r["created_at"]).replace(tzinfo=timezone.utc)
-    except Exception:
+    with _on(_hist()):
+        r = _q(
+            "SELECT created_at FROM messages WHERE chat_id=? ORDER BY id DESC LIMIT 1",
+            (chat_id,),
+        ).fetchone()
+        if not r:
+            r = _q(
+                "SELECT MAX(last_at) AS created_at FROM chat_archive WHERE chat_id=?", (chat_id,)
+            ).fetchone()
+    if not r or not r["created_at"]:
         return None
+    return datetime.fromtimestamp(int(r["created_at"]), timezone.utc)
 
 
+@_sharded(row="chat_id")
 def export_chat_txt(chat_id: int) -> str:
     msgs = list_messages(chat_id)
     ch = get_chat(chat_id)
@@ -815,19 +2655,176 @@ def export_chat_txt(chat_id: int) -> str:
     return "\n".join(lines)
 
 
+@_sharded(row="chat_id")
 def delete_chat(chat_id: int, user_id: int) -> bool:
     ch = get_chat(chat_id)
     if not ch or int(ch["user_id"]) != user_id:
         return False
-    _exec("DELETE FROM messages WHERE chat_id=?", (chat_id,))
-    _exec("DELETE FROM messages_fts WHERE chat_id=?", (chat_id,))
-    _exec("DELETE FROM proactive_plan WHERE chat_id=?", (chat_id,))
-    _exec("DELETE FROM proactive_log WHERE chat_id=?", (chat_id,))
-    _exec("DELETE FROM chats WHERE id=?", (chat_id,))
+    _wb_flush()  # отложенные строки proactive_log этого чата должны удалиться тоже
+    assert _conn is not None
+    char_id = int(ch["char_id"])
+    with _history_tx() as hconn:
+        n = hconn.execute("DELETE FROM messages WHERE chat_id=?", (chat_id,)).rowcount
+        n += int(
+            hconn.execute(
+                "SELECT COALESCE(SUM(msg_count), 0) FROM chat_archive WHERE chat_id=?", (chat_id,)
+            ).fetchone()[0]
+        )
+        hconn.execute("DELETE FROM chat_archive WHERE chat_id=?", (chat_id,))
+        hconn.execute("DELETE FROM chat_checkpoints WHERE chat_id=?", (chat_id,))
+        _conn.execute("DELETE FROM proactive_plan WHERE chat_id=?", (chat_id,))
+        _conn.execute("DELETE FROM proactive_log WHERE chat_id=?", (chat_id,))
+        totals = _conn.execute(
+            "SELECT user_msgs, ai_msgs, in_tokens, out_tokens FROM chats WHERE id=?", (chat_id,)
+        ).fetchone()
+        if _conn.execute("DELETE FROM chats WHERE id=?", (chat_id,)).rowcount:
+            _uncount_chat(_conn, user_id, totals)
+            _char_stats(_conn, user_id, char_id, chats=-1, messages=-n)
+            _conn.execute(
+                """
+                UPDATE user_char_stats SET last_use = (
+                    SELECT MAX(updated_at) FROM chats WHERE user_id=:u AND char_id=:c
+                ) WHERE user_id=:u AND char_id=:c
+                """,
+                {"u": user_id, "c": char_id},
+            )
+        _conn.execute(
+            "UPDATE users SET active_chat_id=NULL WHERE tg_id=? AND active_chat_id=?",
+            (user_id, chat_id),
+        )
+    invalidate_chat(chat_id)
+    drop_tail(chat_id)
+    invalidate_user(user_id)
+    return True
+
+
+# ------------- Archive -------------
+# Холодные чаты: сообщения чата, простаивающего дольше archive_after_days,
+# переносятся в chat_archive сегментами по archive_segment_rows строк
+# (JSON, сжатый zlib), а строки messages и их FTS-индекс удаляются.
+# chats.archived=1 помечает такой чат; любое обращение к его сообщениям
+# через add_message/list_messages/search_messages/compress_history сначала
+# возвращает их на место одной транзакцией. Сводки (usage_daily, счётчики)
+# архивирование не меняет.
+@_sharded(row="chat_id")
+def archive_chat(chat_id: int) -> bool:
+    """Move the chat's messages into ``chat_archive``; ``False`` if nothing to do."""
+    seg_rows = max(1, int(_cfg("archive_segment_rows", 500)))
+    assert _conn is not None
+    with _history_tx() as hconn:
+        r = _conn.execute("SELECT archived FROM chats WHERE id=?", (chat_id,)).fetchone()
+        if not r or r["archived"]:
+            return False
+        rows = hconn.execute(
+            "SELECT id, is_user, content, usage_in, usage_out, created_at "
+            "FROM messages WHERE chat_id=? ORDER BY id",
+            (chat_id,),
+        ).fetchall()
+        for seg, i in enumerate(range(0, len(rows), seg_rows)):
+            part = [list(m) for m in rows[i:i + seg_rows]]
+            raw = json.dumps(part, ensure_ascii=False).encode()
+            hconn.execute(
+                "INSERT INTO chat_archive(chat_id, seg, msg_count, raw_bytes, last_at, data) VALUES (?,?,?,?,?,?)",
+                (chat_id, seg, len(part), len(raw), part[-1][5], zlib.compress(raw, 6)),
+            )
+        hconn.execute("DELETE FROM messages WHERE chat_id=?", (chat_id,))
+        _conn.execute("UPDATE chats SET archived=1 WHERE id=?", (chat_id,))
+    invalidate_chat(chat_id)
+    drop_tail(chat_id)
     return True
 
 
+@_sharded(row="chat_id")
+def restore_chat(chat_id: int) -> int:
+    """Bring archived messages back into ``messages``; returns their number."""
+    assert _conn is not None
+    with _history_tx() as hconn:
+        segs = hconn.execute(
+            "SELECT data FROM chat_archive WHERE chat_id=? ORDER BY seg", (chat_id,)
+        ).fetchall()
+        # сегменты, сжатые до перехода на unix time, хранят время текстом
+        rows = [
+            (m[0], chat_id, *m[1:5], _epoch(m[5]))
+            for s in segs
+            for m in json.loads(zlib.decompress(s["data"]))
+        ]
+        hconn.executemany(
+            "INSERT INTO messages(id, chat_id, is_user, content, usage_in, usage_out, created_at) "
+            "VALUES (?,?,?,?,?,?,?)",
+            rows,
+        )
+        hconn.execute("DELETE FROM chat_archive WHERE chat_id=?", (chat_id,))
+        _conn.execute("UPDATE chats SET archived=0 WHERE id=? AND archived=1", (chat_id,))
+    invalidate_chat(chat_id)
+    drop_tail(chat_id)
+    return len(rows)
+
+
+def _unarchived(chat_id: int) -> Dict[str, Any] | None:
+    """``get_chat`` that first restores an archived chat."""
+    ch = get_chat(chat_id)
+    if ch and ch.get("archived"):
+        restore_chat(chat_id)
+        ch = get_chat(chat_id)
+    return ch
+
+
+def archive_idle_chats(max_age_days: float | None = None, limit: int | None = None) -> List[int]:
+    """Archive chats idle for longer than ``max_age_days``; returns their ids.
+
+    With ``limit`` at most that many chats are handled in one call.
+    """
+    days = float(_cfg("archive_after_days", 30) if max_age_days is None else max_age_days)
+    cutoff = int(time.time() - days * 86400)
+    return _fan_out_limited(lambda n: _archive_idle(cutoff, n), limit)
+
+
+def _archive_idle(cutoff: int, limit: int | None) -> List[int]:
+    chunk = max(1, int(limit or _cfg("bulk_chunk_rows", 1000)))
+    done: List[int] = []
+    while True:
+        ids = [
+            int(r["id"])
+            for r in _q(
+                "SELECT id FROM chats WHERE archived=0 AND updated_at < ? ORDER BY updated_at LIMIT ?",
+                (cutoff, chunk),
+            ).fetchall()
+        ]
+        for chat_id in ids:
+            archive_chat(chat_id)  # каждый чат — своя короткая транзакция
+        done.extend(ids)
+        if limit or len(ids) < chunk:
+            return done
+
+
 # ------------- Stats -------------
+# usage_daily — накопительная сводка по (день, пользователь, персонаж, модель).
+# Пополняется в той же транзакции, что и add_message; удаление и сжатие
+# истории её не уменьшают — статистика отражает фактический расход.
+def _rollup_usage(
+    conn: sqlite3.Connection,
+    day: str,
+    user_id: int,
+    char_id: int,
+    model: str,
+    is_user: bool,
+    usage_in: int,
+    usage_out: int,
+) -> None:
+    conn.execute(
+        """
+        INSERT INTO usage_daily(day, user_id, char_id, model, user_msgs, ai_msgs, in_tokens, out_tokens)
+        VALUES (?,?,?,?,?,?,?,?)
+        ON CONFLICT(day, user_id, char_id, model) DO UPDATE SET
+            user_msgs  = user_msgs  + excluded.user_msgs,
+            ai_msgs    = ai_msgs    + excluded.ai_msgs,
+            in_tokens  = in_tokens  + excluded.in_tokens,
+            out_tokens = out_tokens + excluded.out_tokens
+        """,
+        (day, user_id, char_id, model, 1 if is_user else 0, 0 if is_user else 1, usage_in, usage_out),
+    )
+
+
 def _cached_stat(key: str, ttl: int, fn: Callable[[], Any]) -> Any:
     now = time.time()
     cached = _stats_cache.get(key)
@@ -838,16 +2835,34 @@ def _cached_stat(key: str, ttl: int, fn: Callable[[], Any]) -> Any:
     return val
 
 
+def _merge_sums(parts: List[List[Dict[str, Any]]], key: str) -> Dict[Any, Dict[str, Any]]:
+    """Add up per-shard aggregates that share ``key``."""
+    out: Dict[Any, Dict[str, Any]] = {}
+    for rows in parts:
+        for r in rows:
+            acc = out.get(r[key])
+            if acc is None:
+                out[r[key]] = dict(r)
+            else:
+                for k, v in r.items():
+                    if k != key and isinstance(v, (int, float)):
+                        acc[k] = (acc[k] or 0) + v
+    return out
+
+
 def usage_by_day(days: int = 7, ttl: int = 60) -> List[Dict[str, Any]]:
     def _calc():
+        return sorted(_merge_sums(_fan_out(_shard_calc), "day").values(), key=lambda r: r["day"])
+
+    def _shard_calc():
         start = (datetime.utcnow() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
-        rows = _q(
+        rows = _snap_q(
             """
-            SELECT date(created_at) AS day,
-                   SUM(COALESCE(usage_in,0)) AS in_tokens,
-                   SUM(COALESCE(usage_out,0)) AS out_tokens
-              FROM messages
-             WHERE created_at >= ?
+            SELECT day,
+                   SUM(in_tokens) AS in_tokens,
+                   SUM(out_tokens) AS out_tokens
+              FROM usage_daily
+             WHERE day >= ?
              GROUP BY day
              ORDER BY day
             """,
@@ -860,14 +2875,19 @@ def usage_by_day(days: int = 7, ttl: int = 60) -> List[Dict[str, Any]]:
 
 def usage_by_week(weeks: int = 4, ttl: int = 60) -> List[Dict[str, Any]]:
     def _calc():
-        start = (datetime.utcnow() - timedelta(weeks=weeks - 1)).strftime("%Y-%m-%d")
-        rows = _q(
+        return sorted(_merge_sums(_fan_out(_shard_calc), "week").values(), key=lambda r: r["week"])
+
+    def _shard_calc():
+        # с понедельника: первая неделя в выборке полная, как и в %W
+        today = datetime.utcnow().date()
+        start = (today - timedelta(days=today.weekday(), weeks=weeks - 1)).strftime("%Y-%m-%d")
+        rows = _snap_q(
             """
-            SELECT strftime('%Y-%W', created_at) AS week,
-                   SUM(COALESCE(usage_in,0)) AS in_tokens,
-                   SUM(COALESCE(usage_out,0)) AS out_tokens
-              FROM messages
-             WHERE created_at >= ?
+            SELECT strftime('%Y-%W', day) AS week,
+                   SUM(in_tokens) AS in_tokens,
+                   SUM(out_tokens) AS out_tokens
+              FROM usage_daily
+             WHERE day >= ?
              GROUP BY week
              ORDER BY week
             """,
@@ -880,19 +2900,28 @@ def usage_by_week(weeks: int = 4, ttl: int = 60) -> List[Dict[str, Any]]:
 
 def top_characters(limit: int = 5, ttl: int = 60) -> List[Dict[str, Any]]:
     def _calc():
-        rows = _q(
-            """
-            SELECT ch.name AS name, COUNT(*) AS cnt
-              FROM messages m
-              JOIN chats c ON c.id=m.chat_id
-              JOIN characters ch ON ch.id=c.char_id
-             WHERE m.is_user=0
-             GROUP BY ch.id
-             ORDER BY cnt DESC
-             LIMIT ?
-            """,
-            (int(limit),),
-        ).fetchall()
+        if len(_shards) == 1:
+            rows = _snap_q(
+                """
+                SELECT ch.name AS name, SUM(r.ai_msgs) AS cnt
+                  FROM usage_daily r
+                  JOIN characters ch ON ch.id=r.char_id
+                 GROUP BY ch.id
+                 HAVING cnt > 0
+                 ORDER BY cnt DESC
+                 LIMIT ?
+                """,
+                (int(limit),),
+            ).fetchall()
+            return [dict(r) for r in rows]
+        # у реплики шарда нет characters: суммы по char_id, имена — из общего файла
+        sums = _merge_sums(_fan_out(_shard_sums), "char_id")
+        top = sorted((r for r in sums.values() if r["cnt"] > 0), key=lambda r: -r["cnt"])[: int(limit)]
+        names = {r["id"]: r["name"] for r in _q("SELECT id, name FROM characters").fetchall()}
+        return [{"name": names.get(r["char_id"]), "cnt": r["cnt"]} for r in top if r["char_id"] in names]
+
+    def _shard_sums():
+        rows = _snap_q("SELECT char_id, SUM(ai_msgs) AS cnt FROM usage_daily GROUP BY char_id").fetchall()
         return [dict(r) for r in rows]
 
     return _cached_stat(f"top_chars:{limit}", ttl, _calc)
@@ -900,14 +2929,18 @@ def top_characters(limit: int = 5, ttl: int = 60) -> List[Dict[str, Any]]:
 
 def active_users(limit: int = 5, ttl: int = 60) -> List[Dict[str, Any]]:
     def _calc():
-        rows = _q(
+        # пользователь целиком в одном шарде — достаточно топа каждого шарда
+        rows = [r for part in _fan_out(_shard_top) for r in part]
+        return sorted(rows, key=lambda r: -r["cnt"])[: int(limit)]
+
+    def _shard_top():
+        rows = _snap_q(
             """
             SELECT u.tg_id AS user_id,
                    u.username AS username,
-                   COUNT(*) AS cnt
-              FROM messages m
-              JOIN chats c ON c.id=m.chat_id
-              JOIN users u ON u.tg_id=c.user_id
+                   SUM(r.user_msgs + r.ai_msgs) AS cnt
+              FROM usage_daily r
+              JOIN users u ON u.tg_id=r.user_id
              GROUP BY u.tg_id, u.username
              ORDER BY cnt DESC
              LIMIT ?
@@ -919,59 +2952,250 @@ def active_users(limit: int = 5, ttl: int = 60) -> List[Dict[str, Any]]:
     return _cached_stat(f"active_users:{limit}", ttl, _calc)
 
 
+@_sharded(user="user_id")
 def user_totals(user_id: int) -> Dict[str, Any]:
-    msgs = _q(
+    r = _q(
         """
-        SELECT
-          SUM(CASE WHEN is_user=1 THEN 1 ELSE 0 END) AS user_msgs,
-          SUM(CASE WHEN is_user=0 THEN 1 ELSE 0 END) AS ai_msgs,
-          SUM(COALESCE(usage_in,0)) AS in_tokens,
-          SUM(COALESCE(usage_out,0)) AS out_tokens
-        FROM messages m JOIN chats c ON c.id=m.chat_id
-        WHERE c.user_id=?
+        SELECT uc.*, ch.name AS top_name
+          FROM user_counters uc
+          LEFT JOIN characters ch ON ch.id=uc.top_char_id
+         WHERE uc.user_id=?
     """,
         (user_id,),
     ).fetchone()
-    top = _q(
+    r = dict(r) if r else {}
+    return dict(
+        user_msgs=int(r.get("user_msgs") or 0),
+        ai_msgs=int(r.get("ai_msgs") or 0),
+        in_tokens=int(r.get("in_tokens") or 0),
+        out_tokens=int(r.get("out_tokens") or 0),
+        chats=int(r.get("chat_count") or 0),
+        top_character=r.get("top_name") if r.get("top_count") else None,
+        top_count=int(r.get("top_count") or 0),
+    )
+
+
+# user_counters — итоги пользователя для профиля по существующим чатам:
+# удалённый чат уходит из них целиком (в отличие от usage_daily). Каждый чат
+# держит свои итоги (chats.user_msgs, ai_msgs, in_tokens, out_tokens), их
+# не меняют ни архив, ни сжатие; счётчики пользователя — их сумма, топ-персонаж —
+# персонаж с наибольшим числом ответов. Все правки идут в транзакции
+# вызывающей функции.
+_CHAT_TOTAL_COLS = ("user_msgs", "ai_msgs", "in_tokens", "out_tokens")
+_CHAT_TOTALS_DEFERRED = "chats.totals.after_attach"
+
+# итоги чатов пользователей lo < user_id <= hi по их сообщениям;
+# архивные чаты считает _archived_totals
+_CHAT_TOTALS_SQL = """
+    UPDATE chats SET
+        user_msgs  = (SELECT COUNT(*) FROM messages m WHERE m.chat_id = chats.id AND m.is_user = 1),
+        ai_msgs    = (SELECT COUNT(*) FROM messages m WHERE m.chat_id = chats.id AND m.is_user = 0),
+        in_tokens  = (SELECT COALESCE(SUM(m.usage_in), 0) FROM messages m WHERE m.chat_id = chats.id),
+        out_tokens = (SELECT COALESCE(SUM(m.usage_out), 0) FROM messages m WHERE m.chat_id = chats.id)
+     WHERE archived = 0 AND user_id > :lo AND user_id <= :hi
+"""
+_ARCHIVED_TOTALS_SQL = "UPDATE chats SET user_msgs=?, ai_msgs=?, in_tokens=?, out_tokens=? WHERE id=?"
+
+_COUNTERS_REBUILD_SQL = """
+    INSERT OR REPLACE INTO user_counters(
+        user_id, user_msgs, ai_msgs, in_tokens, out_tokens, chat_count, top_char_id, top_count)
+    SELECT u.tg_id,
+           COALESCE(s.user_msgs, 0), COALESCE(s.ai_msgs, 0),
+           COALESCE(s.in_tokens, 0), COALESCE(s.out_tokens, 0),
+           COALESCE(s.chats, 0),
+           t.char_id, COALESCE(t.cnt, 0)
+      FROM users u
+      LEFT JOIN (
+            SELECT user_id, SUM(user_msgs) AS user_msgs, SUM(ai_msgs) AS ai_msgs,
+                   SUM(in_tokens) AS in_tokens, SUM(out_tokens) AS out_tokens, COUNT(*) AS chats
+              FROM chats WHERE user_id > :lo AND user_id <= :hi GROUP BY user_id
+      ) s ON s.user_id = u.tg_id
+      LEFT JOIN (
+            SELECT user_id, char_id, cnt,
+                   ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY cnt DESC, char_id) AS rn
+              FROM (SELECT user_id, char_id, SUM(ai_msgs) AS cnt
+                      FROM chats WHERE user_id > :lo AND user_id <= :hi
+                     GROUP BY user_id, char_id HAVING cnt > 0)
+      ) t ON t.user_id = u.tg_id AND t.rn = 1
+     WHERE u.rowid > :lo AND u.rowid <= :hi
+"""
+
+
+def _archived_totals(lo: int, hi: int) -> List[Tuple[int, int, int, int, int]]:
+    """``(user_msgs, ai_msgs, in_tokens, out_tokens, chat_id)`` of archived chats."""
+    out = []
+    for r in _q(
+        "SELECT id FROM chats WHERE archived=1 AND user_id > ? AND user_id <= ?", (lo, hi)
+    ).fetchall():
+        t = [0, 0, 0, 0]
+        for s in _q("SELECT data FROM chat_archive WHERE chat_id=?", (r["id"],)).fetchall():
+            for m in json.loads(zlib.decompress(s["data"])):
+                t[0 if m[1] else 1] += 1
+                t[2] += int(m[3] or 0)
+                t[3] += int(m[4] or 0)
+        out.append((*t, int(r["id"])))
+    return out
+
+
+def _refresh_chat_totals(lo: int, hi: int) -> None:
+    """Recount the totals of the chats of users ``lo < user_id <= hi``."""
+    archived = _archived_totals(lo, hi)
+    with _conn_lock, _conn:
+        _conn.execute(_CHAT_TOTALS_SQL, {"lo": lo, "hi": hi})
+        _conn.executemany(_ARCHIVED_TOTALS_SQL, archived)
+
+
+def _fill_chat_totals() -> None:
+    """Chat totals and ``user_counters`` of all users, in resumable batches."""
+    _backfill("chats.totals", "users", _CHAT_TOTALS_SQL)
+    # сегменты архивных чатов разбираются в Python; пересчёт идемпотентен
+    upto = int(_q("SELECT COALESCE(MAX(rowid), 0) FROM users").fetchone()[0])
+    archived = _archived_totals(0, upto)
+    with _conn_lock, _conn:
+        _conn.executemany(_ARCHIVED_TOTALS_SQL, archived)
+    _backfill("user_counters.chats", "users", _COUNTERS_REBUILD_SQL)
+
+
+def _count_message(
+    conn: sqlite3.Connection,
+    user_id: int,
+    char_id: int,
+    is_user: bool,
+    usage_in: int,
+    usage_out: int,
+) -> None:
+    conn.execute(
         """
-        SELECT ch.name AS name, COUNT(*) AS cnt
-          FROM messages m
-          JOIN chats c ON c.id=m.chat_id
-          JOIN characters ch ON ch.id=c.char_id
-         WHERE c.user_id=? AND m.is_user=0
-         GROUP BY ch.name
-         ORDER BY cnt DESC
-         LIMIT 1
-    """,
+        INSERT INTO user_counters(user_id, user_msgs, ai_msgs, in_tokens, out_tokens)
+        VALUES (?,?,?,?,?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            user_msgs  = user_msgs  + excluded.user_msgs,
+            ai_msgs    = ai_msgs    + excluded.ai_msgs,
+            in_tokens  = in_tokens  + excluded.in_tokens,
+            out_tokens = out_tokens + excluded.out_tokens
+        """,
+        (user_id, 1 if is_user else 0, 0 if is_user else 1, usage_in, usage_out),
+    )
+    if is_user:
+        return
+    # топ-персонаж: при равенстве остаётся прежний
+    cnt = conn.execute(
+        "SELECT SUM(ai_msgs) FROM chats WHERE user_id=? AND char_id=?",
+        (user_id, char_id),
+    ).fetchone()[0]
+    conn.execute(
+        """
+        UPDATE user_counters SET top_char_id = :c, top_count = :n
+         WHERE user_id = :u AND (top_char_id = :c OR top_char_id IS NULL OR top_count < :n)
+        """,
+        {"u": user_id, "c": char_id, "n": int(cnt or 0)},
+    )
+
+
+def _count_chat(conn: sqlite3.Connection, user_id: int, delta: int) -> None:
+    conn.execute(
+        """
+        INSERT INTO user_counters(user_id, chat_count) VALUES (?, MAX(?, 0))
+        ON CONFLICT(user_id) DO UPDATE SET chat_count = MAX(chat_count + ?, 0)
+        """,
+        (user_id, delta, delta),
+    )
+
+
+def _uncount_chat(conn: sqlite3.Connection, user_id: int, totals: sqlite3.Row) -> None:
+    """Take a deleted chat (its row already gone) out of ``user_counters``."""
+    conn.execute(
+        """
+        UPDATE user_counters SET
+            chat_count = MAX(chat_count - 1, 0),
+            user_msgs  = MAX(user_msgs  - :um, 0),
+            ai_msgs    = MAX(ai_msgs    - :am, 0),
+            in_tokens  = MAX(in_tokens  - :ti, 0),
+            out_tokens = MAX(out_tokens - :to, 0)
+         WHERE user_id = :u
+        """,
+        {
+            "u": user_id,
+            "um": int(totals["user_msgs"]),
+            "am": int(totals["ai_msgs"]),
+            "ti": int(totals["in_tokens"]),
+            "to": int(totals["out_tokens"]),
+        },
+    )
+    # топ мог уйти вместе с чатом — выбираем заново по оставшимся
+    top = conn.execute(
+        """
+        SELECT char_id, SUM(ai_msgs) AS cnt FROM chats WHERE user_id=?
+         GROUP BY char_id HAVING cnt > 0 ORDER BY cnt DESC, char_id LIMIT 1
+        """,
         (user_id,),
     ).fetchone()
-    return dict(
-        user_msgs=int(msgs["user_msgs"] or 0),
-        ai_msgs=int(msgs["ai_msgs"] or 0),
-        in_tokens=int(msgs["in_tokens"] or 0),
-        out_tokens=int(msgs["out_tokens"] or 0),
-        top_character=(top["name"] if top else None),
-        top_count=int(top["cnt"] or 0) if top else 0,
+    conn.execute(
+        "UPDATE user_counters SET top_char_id=?, top_count=? WHERE user_id=?",
+        (top["char_id"] if top else None, int(top["cnt"]) if top else 0, user_id),
     )
 
 
+@_sharded(user="user_id")
+def rebuild_user_counters(user_id: int | None = None) -> int:
+    """Recount chat totals from the messages and ``user_counters`` from them.
+
+    Returns the number of rebuilt rows. Without ``user_id`` all users are
+    rebuilt in resumable batches.
+    """
+    assert _conn is not None
+    if user_id is not None:
+        lo, hi = int(user_id) - 1, int(user_id)
+        _refresh_chat_totals(lo, hi)
+        with _conn_lock, _conn:
+            cur = _conn.execute(_COUNTERS_REBUILD_SQL, {"lo": lo, "hi": hi})
+        return max(cur.rowcount, 0)
+    _fan_out(_fill_chat_totals)
+    return sum(_fan_out(lambda: int(_q("SELECT COUNT(*) FROM user_counters").fetchone()[0])))
+
+
 # ------------- Billing (toki/tokens) -------------
+def _begin_write(cur: sqlite3.Cursor) -> None:
+    """Start a write transaction that locks the main file only.
+
+    BEGIN IMMEDIATE also locks every attached file (history, shared), so the
+    write lock is taken by a no-op write to a main table instead.
+    """
+    cur.execute("BEGIN")
+    cur.execute("UPDATE main.users SET tg_id = tg_id WHERE tg_id = 0")
+
+
 def _log_token(cur: sqlite3.Cursor, user_id: int, amount: int, meta: str) -> None:
     """Persist a token balance change inside an open transaction."""
     cur.execute(
-        "INSERT INTO token_log(user_id, amount, meta) VALUES (?,?,?)",
-        (user_id, int(amount), meta),
+        "INSERT INTO token_log(user_id, amount, meta, created_at) VALUES (?,?,?,?)",
+        (user_id, int(amount), meta, int(time.time())),
     )
 
 
+@_sharded(user="user_id")
 def list_token_log(user_id: int, limit: int = 10) -> List[Dict[str, Any]]:
-    rows = _q(
-        "SELECT amount, meta, created_at FROM token_log WHERE user_id=? ORDER BY id DESC LIMIT ?",
-        (user_id, int(limit)),
-    ).fetchall()
-    return [dict(r) for r in rows]
-
-
+    """Latest balance changes; pruned history continues as monthly totals."""
+    rows = [
+        dict(r)
+        for r in _q(
+            "SELECT amount, meta, created_at FROM token_log WHERE user_id=? ORDER BY id DESC LIMIT ?",
+            (user_id, int(limit)),
+        ).fetchall()
+    ]
+    if len(rows) < int(limit):
+        rows += [
+            dict(r)
+            for r in _q(
+                "SELECT credit + debit AS amount, 'monthly' AS meta, month AS created_at "
+                "FROM token_log_monthly WHERE user_id=? ORDER BY month DESC LIMIT ?",
+                (user_id, int(limit) - len(rows)),
+            ).fetchall()
+        ]
+    return rows
+
+
+@_sharded(user="user_id")
 def add_toki(user_id: int, amount: int, meta: str = "bonus") -> None:
     """Increase user's free_toki balance."""
     if amount < 0:
@@ -979,15 +3203,17 @@ def add_toki(user_id: int, amount: int, meta: str = "bonus") -> None:
     assert _conn is not None
     with _conn_lock:
         cur = _conn.cursor()
-        cur.execute("BEGIN IMMEDIATE")
+        _begin_write(cur)
         cur.execute(
             "UPDATE users SET free_toki = free_toki + ? WHERE tg_id=?",
             (int(amount), user_id),
         )
         _log_token(cur, user_id, int(amount), meta)
         _conn.commit()
+    invalidate_user(user_id)
 
 
+@_sharded(user="user_id")
 def add_paid_tokens(user_id: int, amount: int, meta: str = "topup") -> None:
     """Increase user's paid_tokens balance."""
     if amount < 0:
@@ -995,61 +3221,214 @@ def add_paid_tokens(user_id: int, amount: int, meta: str = "topup") -> None:
     assert _conn is not None
     with _conn_lock:
         cur = _conn.cursor()
-        cur.execute("BEGIN IMMEDIATE")
+        _begin_write(cur)
         cur.execute(
             "UPDATE users SET paid_tokens = paid_tokens + ? WHERE tg_id=?",
             (int(amount), user_id),
         )
         _log_token(cur, user_id, int(amount), meta)
         _conn.commit()
+    invalidate_user(user_id)
+
+
+def _charge(cur: sqlite3.Cursor, user_id: int, amount: int, held: int = 0) -> Tuple[int, int, int]:
+    """Debit ``amount`` free-first inside an open transaction.
+
+    ``held`` tokens of the balance belong to other holds and stay untouched.
+    Returns ``(spent_free, spent_paid, deficit)``.
+    """
+    row = cur.execute(
+        "SELECT free_toki, paid_tokens FROM users WHERE tg_id=?",
+        (user_id,),
+    ).fetchone()
+    ft = int(row["free_toki"] if row else 0)
+    pt = int(row["paid_tokens"] if row else 0)
+
+    need = int(max(0, amount))
+    can = max(0, min(need, ft + pt - int(held)))
+    use_free = min(ft, can)
+    use_paid = can - use_free
+
+    if use_free:
+        cur.execute(
+            "UPDATE users SET free_toki = free_toki - ? WHERE tg_id=?",
+            (use_free, user_id),
+        )
+        _log_token(cur, user_id, -use_free, "spend_free")
+    if use_paid:
+        cur.execute(
+            "UPDATE users SET paid_tokens = paid_tokens - ? WHERE tg_id=?",
+            (use_paid, user_id),
+        )
+        _log_token(cur, user_id, -use_paid, "spend_paid")
+    return use_free, use_paid, need - can  # need - can == deficit
 
 
+@_sharded(user="user_id")
 def spend_tokens(user_id: int, amount: int) -> Tuple[int, int, int]:
     """
     Списать amount биллинговых токенов: сначала free_toki, затем paid_tokens.
     Возвращает (spent_free, spent_paid, deficit). Если не хватило — deficit > 0 (ответ всё равно отправляется).
+    Зарезервированное ходами в процессе (token_holds) не трогает.
     """
     assert _conn is not None
     with _conn_lock:
         cur = _conn.cursor()
-        cur.execute("BEGIN IMMEDIATE")
+        _begin_write(cur)
+        spent = _charge(cur, user_id, amount, _held(cur, user_id, int(time.time())))
+        _conn.commit()
+        invalidate_user(user_id)
+        return spent
+
+
+# ----- Balance holds -----
+# Ход диалога резервирует оценку стоимости до вызова модели (reserve), а по
+# окончании списывает фактическую сумму (settle) или снимает резерв
+# (release). Резерв — строка token_holds, баланс он не меняет: доступно
+# free_toki + paid_tokens минус живые резервы, поэтому параллельные ходы
+# одного пользователя не тратят одно и то же дважды. Резерв упавшего процесса
+# перестаёт учитываться после expires_at (hold_ttl_s); такие строки удаляют
+# следующий reserve пользователя и retention_step.
+def _held(cur: sqlite3.Cursor, user_id: int, now: int) -> int:
+    r = cur.execute(
+        "SELECT COALESCE(SUM(amount), 0) FROM token_holds WHERE user_id=? AND expires_at > ?",
+        (user_id, now),
+    ).fetchone()
+    return int(r[0])
+
+
+@_sharded(user="user_id")
+def reserve(user_id: int, estimate: int) -> int | None:
+    """Hold up to ``estimate`` tokens; the hold id, ``None`` if nothing is free.
 
+    When less than ``estimate`` is free the hold takes what is left.
+    """
+    now = int(time.time())
+    assert _conn is not None
+    with _conn_lock, _conn:
+        cur = _conn.cursor()
+        _begin_write(cur)
+        cur.execute("DELETE FROM token_holds WHERE user_id=? AND expires_at <= ?", (user_id, now))
         row = cur.execute(
-            "SELECT free_toki, paid_tokens FROM users WHERE tg_id=?",
-            (user_id,),
+            "SELECT free_toki + paid_tokens FROM users WHERE tg_id=?", (user_id,)
         ).fetchone()
-        ft = int(row["free_toki"] if row else 0)
-        pt = int(row["paid_tokens"] if row else 0)
-
-        need = int(max(0, amount))
-        use_free = min(ft, need)
-        need -= use_free
-        use_paid = min(pt, need)
-        need -= use_paid
-
-        if use_free:
-            cur.execute(
-                "UPDATE users SET free_toki = free_toki - ? WHERE tg_id=?",
-                (use_free, user_id),
-            )
-            _log_token(cur, user_id, -use_free, "spend_free")
-        if use_paid:
-            cur.execute(
-                "UPDATE users SET paid_tokens = paid_tokens - ? WHERE tg_id=?",
-                (use_paid, user_id),
-            )
-            _log_token(cur, user_id, -use_paid, "spend_paid")
+        free = int(row[0] if row else 0) - _held(cur, user_id, now)
+        if free <= 0:
+            return None
+        cur.execute(
+            "INSERT INTO token_holds(id, user_id, amount, expires_at) VALUES (?,?,?,?)",
+            (
+                _next_id("token_holds"),
+                user_id,
+                min(max(1, int(estimate)), free),
+                now + int(_cfg("hold_ttl_s", 600)),
+            ),
+        )
+    return int(cur.lastrowid)
 
-        _conn.commit()
-        return use_free, use_paid, need  # need==deficit
+
+@_sharded(row="reservation")
+def settle(reservation: int, actual: int) -> Tuple[int, int, int]:
+    """Charge ``actual`` for a hold and drop it; ``(spent_free, spent_paid, deficit)``.
+
+    The charge may use the hold and any balance other holds leave free. An
+    unknown hold (already settled, released or long expired) charges nothing.
+    """
+    assert _conn is not None
+    with _conn_lock, _conn:
+        cur = _conn.cursor()
+        _begin_write(cur)
+        done = _settle(cur, reservation, actual)
+    if done is None:
+        logger.warning("settle of unknown hold %s", reservation)
+        return 0, 0, 0
+    user_id, spent = done
+    invalidate_user(user_id)
+    return spent
+
+
+def _settle(cur: sqlite3.Cursor, reservation: int, actual: int) -> Tuple[int, Tuple[int, int, int]] | None:
+    """Charge a hold and drop it inside an open transaction; ``(user_id, spent)``."""
+    r = cur.execute("SELECT user_id FROM token_holds WHERE id=?", (reservation,)).fetchone()
+    if r is None:
+        return None
+    user_id = int(r["user_id"])
+    cur.execute("DELETE FROM token_holds WHERE id=?", (reservation,))
+    return user_id, _charge(cur, user_id, actual, _held(cur, user_id, int(time.time())))
+
+
+@_sharded(row="reservation")
+def release(reservation: int) -> bool:
+    """Drop a hold without charging; ``False`` if it is already gone."""
+    return _exec("DELETE FROM token_holds WHERE id=?", (reservation,)).rowcount > 0
+
+
+# ----- Turn commit -----
+# Завершённый ход диалога — одно событие и одна транзакция: списание по
+# резерву, ответ модели (с FTS-строкой и сводками), cached_tokens и
+# updated_at чата, сброс флага «в диалоге». При split_history ответ
+# пишется в файл истории, его коммит идёт сразу за основным.
+@_sharded(row="chat_id")
+def turn_commit(
+    chat_id: int,
+    content: str,
+    *,
+    usage_in: int | None = None,
+    usage_out: int | None = None,
+    billed: int = 0,
+    reservation: int | None = None,
+    model: str | None = None,
+) -> Tuple[int, int]:
+    """Bill ``billed`` and store the assistant reply; ``(message_id, deficit)``.
+
+    Without ``reservation`` (or when the hold is gone) the chat owner's free
+    balance is charged. A reply that is not paid in full is not stored and
+    ``message_id`` is 0.
+    """
+    ch = _unarchived(chat_id)
+    if not ch:
+        spent = settle(reservation, billed) if reservation is not None else (0, 0, 0)
+        return 0, spent[2]
+    user_id = int(ch["user_id"])
+    if model is None:
+        u = get_user(user_id) or {}
+        model = u.get("default_model") or getattr(settings, "default_model", None)
+    now = int(time.time())
+    row = (chat_id, 0, content, usage_in, usage_out, now)
+    cached = int(usage_in or 0) + int(usage_out or 0)
+    wb = _wb_enabled()
+    msg_id = 0
+    assert _conn is not None
+    with _history_tx() as hconn:
+        cur = _conn.cursor()
+        _begin_write(cur)
+        done = _settle(cur, reservation, billed) if reservation is not None else None
+        if done is None:
+            done = user_id, _charge(cur, user_id, billed, _held(cur, user_id, int(time.time())))
+        deficit = done[1][2]
+        if not deficit:
+            msg_id = int(hconn.execute(_INSERT_MESSAGE_SQL, row).lastrowid)
+            _book_message(_conn, ch, chat_id, now, model, False, usage_in, usage_out)
+            _conn.execute("UPDATE chats SET cached_tokens=? WHERE id=?", (cached, chat_id))
+        if not wb:
+            _conn.execute("UPDATE users SET is_chatting=0 WHERE tg_id=?", (user_id,))
+    invalidate_user(user_id)
+    if wb:
+        _wb_put(user=(user_id, "is_chatting", 0))
+    if msg_id:
+        _message_cached(ch, msg_id, row)
+        _chat_cache_set(chat_id, "cached_tokens", cached)
+    return msg_id, deficit
 
 
 # Ночной бонус «токов»
+@_sharded(user="user_id")
 def nightly_bonus_toki(user_id: int, amount: int) -> None:
     today = datetime.utcnow().strftime("%Y-%m-%d")
     add_toki(user_id, amount, meta=f"nightly:{today}")
 
 
+@_sharded(user="user_id")
 def get_toki_log(user_id: int, limit: int = 10) -> List[Dict[str, Any]]:
     rows = _q(
         "SELECT amount, meta, created_at FROM toki_log WHERE user_id=? ORDER BY id DESC LIMIT ?",
@@ -1058,31 +3437,74 @@ def get_toki_log(user_id: int, limit: int = 10) -> List[Dict[str, Any]]:
     return [dict(r) for r in rows]
 
 
-def daily_bonus_free_users() -> List[int]:
+def _bulk_users(select_sql: str, params: Tuple, apply: Tuple[Tuple[str, Tuple], ...], limit: int | None) -> List[int]:
+    """Apply set-based statements to users picked by ``select_sql``, in chunks.
+
+    Every chunk is one transaction: the picked ids go to the temp table
+    ``_bulk_ids`` and each ``apply`` statement works on that set. The select
+    must stop matching processed users, so the next chunk picks new ones.
+    Between chunks the write lock is released. With ``limit`` at most one
+    chunk of that size is processed (callers on the writer queue loop).
+    """
+    return _fan_out_limited(lambda n: _bulk_users_shard(select_sql, params, apply, n), limit)
+
+
+def _bulk_users_shard(
+    select_sql: str, params: Tuple, apply: Tuple[Tuple[str, Tuple], ...], limit: int | None
+) -> List[int]:
+    chunk = max(1, int(limit or _cfg("bulk_chunk_rows", 1000)))
+    assert _conn is not None
+    uids: List[int] = []
+    while True:
+        with _conn_lock, _conn:
+            _conn.execute("CREATE TEMP TABLE IF NOT EXISTS _bulk_ids (tg_id INTEGER PRIMARY KEY)")
+            _conn.execute("DELETE FROM _bulk_ids")
+            ids = sorted(
+                int(r[0])
+                for r in _conn.execute(
+                    f"INSERT INTO _bulk_ids(tg_id) {select_sql} LIMIT ? RETURNING tg_id",
+                    (*params, chunk),
+                ).fetchall()
+            )
+            for sql, p in apply:
+                _conn.execute(sql, p)
+        for uid in ids:
+            invalidate_user(uid)
+        uids.extend(ids)
+        if limit or len(ids) < chunk:
+            return uids
+
+
+def daily_bonus_free_users(limit: int | None = None) -> List[int]:
+    """Grant the nightly free bonus; returns the rewarded user ids."""
     amount = int(settings.subs.nightly_toki_bonus.get("free", 0))
     if amount <= 0:
         return []
-    rows = _q(
+    now = _utcnow_sql()
+    today = now[:10]
+    return _bulk_users(
         """
         SELECT tg_id FROM users
          WHERE subscription='free'
-           AND (last_daily_bonus_at IS NULL OR date(last_daily_bonus_at) < date('now','utc'))
-        """
-    ).fetchall()
-    today = datetime.utcnow().strftime("%Y-%m-%d")
-    uids: List[int] = []
-    for r in rows:
-        uid = int(r["tg_id"])
-        add_toki(uid, amount, meta=f"daily:{today}")
-        _exec(
-            "UPDATE users SET last_daily_bonus_at=CURRENT_TIMESTAMP WHERE tg_id=?",
-            (uid,),
-        )
-        uids.append(uid)
-    return uids
+           AND (last_daily_bonus_at IS NULL OR last_daily_bonus_at < ?)
+        """,
+        (today,),
+        (
+            (
+                "UPDATE users SET free_toki = free_toki + ?, last_daily_bonus_at = ? "
+                "WHERE tg_id IN (SELECT tg_id FROM _bulk_ids)",
+                (amount, now),
+            ),
+            (
+                "INSERT INTO token_log(user_id, amount, meta, created_at) SELECT tg_id, ?, ?, ? FROM _bulk_ids",
+                (amount, f"daily:{today}", int(time.time())),
+            ),
+        ),
+        limit,
+    )
 
 
-def expire_subscriptions(col: str | None = None) -> List[int]:
+def expire_subscriptions(col: str | None = None, limit: int | None = None) -> List[int]:
     """Downgrade users whose subscription has expired.
 
     Parameters
@@ -1090,6 +3512,8 @@ def expire_subscriptions(col: str | None = None) -> List[int]:
     col:
         Optional name of the column that stores subscription end timestamp.
         When provided, the value must be one of the supported column names.
+    limit:
+        Process at most one chunk of this many users.
 
     Returns
     -------
@@ -1110,24 +3534,22 @@ def expire_subscriptions(col: str | None = None) -> List[int]:
         if col is None:
             return []
 
-    rows = _q(
+    return _bulk_users(
         f"""
         SELECT tg_id FROM users
-         WHERE subscription <> 'free'
-           AND {col} IS NOT NULL
-           AND {col} < CURRENT_TIMESTAMP
-        """
-    ).fetchall()
-
-    uids: List[int] = []
-    for r in rows:
-        uid = int(r["tg_id"])
-        _exec(
-            f"UPDATE users SET subscription='free', {col}=NULL WHERE tg_id=?",
-            (uid,),
-        )
-        uids.append(uid)
-    return uids
+         WHERE {col} < ?
+           AND subscription <> 'free'
+        """,
+        (_utcnow_sql(),),
+        (
+            (
+                f"UPDATE users SET subscription='free', {col}=NULL "
+                "WHERE tg_id IN (SELECT tg_id FROM _bulk_ids)",
+                (),
+            ),
+        ),
+        limit,
+    )
 
 
 # ------------- Proactive helpers -------------
@@ -1139,53 +3561,78 @@ def select_proactive_candidates() -> List[int]:
     user identifier (``tg_id``) is returned.
     """
 
-    rows = _q(
-        """
-        SELECT u.tg_id
-          FROM users AS u
-         WHERE u.proactive_enabled = 1
-           AND COALESCE(u.banned, 0) = 0
-           AND EXISTS (
-                SELECT 1 FROM chats AS c WHERE c.user_id = u.tg_id
-           )
-        """
-    ).fetchall()
-    return [int(r["tg_id"]) for r in rows]
+    def _shard():
+        rows = _q(
+            """
+            SELECT u.tg_id
+              FROM users AS u
+             WHERE u.proactive_enabled = 1
+               AND COALESCE(u.banned, 0) = 0
+               AND EXISTS (
+                    SELECT 1 FROM chats AS c WHERE c.user_id = u.tg_id
+               )
+            """
+        ).fetchall()
+        return [int(r["tg_id"]) for r in rows]
+
+    return [uid for part in _fan_out(_shard) for uid in part]
 
 
+@_sharded(user="user_id")
 def proactive_count_today(user_id: int) -> int:
+    start = int(time.time()) // 86400 * 86400  # полночь UTC
     r = _q(
         """
         SELECT COUNT(*) AS c
           FROM proactive_log
-         WHERE user_id=? AND date(sent_at)=date('now','utc')
+         WHERE user_id=? AND sent_at >= ? AND sent_at < ?
         """,
-        (user_id,),
+        (user_id, start, start + 86400),
     ).fetchone()
-    return int(r["c"] or 0)
+    with _wb_lock:
+        pending = sum(
+            1
+            for _sh, sql, params in _wb_rows
+            if "proactive_log" in sql and params[0] == user_id and params[-1] >= start
+        )
+    return int(r["c"] or 0) + pending
 
 
 
+@_sharded(user="user_id")
 def log_proactive(
     user_id: int, chat_id: int, char_id: int, kind: str = "regular"
 ) -> None:
+    now = int(time.time())
+    if _wb_enabled():
+        _wb_put(
+            user=(user_id, "last_proactive_at", now),
+            row=(
+                "INSERT INTO proactive_log(user_id, chat_id, char_id, kind, sent_at) VALUES (?,?,?,?,?)",
+                (user_id, chat_id, char_id, kind, now),
+            ),
+        )
+        return
     _exec(
-        "INSERT INTO proactive_log(user_id, chat_id, char_id, kind) VALUES (?,?,?,?)",
-        (user_id, chat_id, char_id, kind),
+        "INSERT INTO proactive_log(user_id, chat_id, char_id, kind, sent_at) VALUES (?,?,?,?,?)",
+        (user_id, chat_id, char_id, kind, now),
     )
     _exec(
-        "UPDATE users SET last_proactive_at=CURRENT_TIMESTAMP WHERE tg_id=?", (user_id,)
+        "UPDATE users SET last_proactive_at=? WHERE tg_id=?", (now, user_id)
     )
+    invalidate_user(user_id)
 
 
 
 # ------------- Payments -------------
+@_sharded(user="user_id")
 def create_topup_pending(user_id: int, amount: float, provider: str) -> int:
     tokens = int(float(amount) * 1000)
-    cur = _exec(
-        "INSERT INTO topups(user_id, amount, tokens, provider, status) VALUES (?,?,?,?, 'pending')",
-        (user_id, float(amount), tokens, provider),
-    )
+    with _conn_lock:
+        cur = _exec(
+            "INSERT INTO topups(id, user_id, amount, tokens, provider, status) VALUES (?,?,?,?,?, 'pending')",
+            (_next_id("topups"), user_id, float(amount), tokens, provider),
+        )
     tid = int(cur.lastrowid)
     topups_logger.info(
         "user_id=%s tid=%s status=pending amount=%.3f tokens=%d",
@@ -1197,15 +3644,18 @@ def create_topup_pending(user_id: int, amount: float, provider: str) -> int:
     return tid
 
 
+@_sharded(row="topup_id")
 def get_topup(topup_id: int):
     return _q("SELECT * FROM topups WHERE id=?", (topup_id,)).fetchone()
 
 
+@_sharded(row="topup_id")
 def delete_topup(topup_id: int) -> bool:
     cur = _exec("DELETE FROM topups WHERE id=? AND status='pending'", (topup_id,))
     return cur.rowcount > 0
 
 
+@_sharded(user="user_id")
 def has_pending_topup(user_id: int) -> bool:
     r = _q(
         "SELECT 1 FROM topups WHERE user_id=? AND status='pending' LIMIT 1",
@@ -1215,6 +3665,7 @@ def has_pending_topup(user_id: int) -> bool:
 
 
 
+@_sharded(user="user_id")
 def get_active_topup(user_id: int) -> Dict[str, Any] | None:
     r = _q(
         "SELECT * FROM topups WHERE user_id=? AND status IN ('waiting_receipt','pending') ORDER BY id DESC LIMIT 1",
@@ -1223,6 +3674,7 @@ def get_active_topup(user_id: int) -> Dict[str, Any] | None:
     return dict(r) if r else None
 
 
+@_sharded(row="topup_id")
 def attach_receipt(topup_id: int, file_id: str) -> None:
     _exec(
         "UPDATE topups SET receipt_file_id=?, status='pending' WHERE id=?",
@@ -1230,11 +3682,13 @@ def attach_receipt(topup_id: int, file_id: str) -> None:
     )
 
 
+@_sharded(row="topup_id")
 def get_topup(topup_id: int) -> Dict[str, Any] | None:
     r = _q("SELECT * FROM topups WHERE id=?", (topup_id,)).fetchone()
     return dict(r) if r else None
 
 
+@_sharded(user="user_id")
 def create_transaction(topup_id: int, user_id: int, amount: float, provider: str) -> int:
     cur = _exec(
         "INSERT INTO transactions(topup_id, user_id, amount, provider) VALUES (?,?,?,?)",
@@ -1243,6 +3697,7 @@ def create_transaction(topup_id: int, user_id: int, amount: float, provider: str
     return int(cur.lastrowid)
 
 
+@_sharded(row="topup_id")
 def approve_topup(topup_id: int, admin_id: int) -> bool:
     r = _q(
         "SELECT user_id, amount, status, provider FROM topups WHERE id=?",
@@ -1274,6 +3729,7 @@ def approve_topup(topup_id: int, admin_id: int) -> bool:
 
 
 
+@_sharded(row="topup_id")
 def decline_topup(topup_id: int, admin_id: int) -> bool:
     r = _q("SELECT id, status FROM topups WHERE id=?", (topup_id,)).fetchone()
     if not r or r["status"] != "pending":
@@ -1291,6 +3747,10 @@ def expire_old_topups(max_age_hours: int) -> List[int]:
         return []
     cutoff = datetime.now(timezone.utc) - timedelta(hours=int(max_age_hours))
     cutoff_str = cutoff.strftime("%Y-%m-%d %H:%M:%S")
+    return [uid for part in _fan_out(lambda: _expire_old_topups(cutoff_str)) for uid in part]
+
+
+def _expire_old_topups(cutoff_str: str) -> List[int]:
     rows = _q(
         """
         SELECT DISTINCT user_id FROM topups
@@ -1312,16 +3772,26 @@ def expire_old_topups(max_age_hours: int) -> List[int]:
 
 
 # ----- Chatting flag -----
+@_sharded(user="user_id")
 def set_user_chatting(user_id: int, on: bool) -> None:
+    if _wb_enabled():
+        _wb_put(user=(user_id, "is_chatting", 1 if on else 0))
+        return
     _exec("UPDATE users SET is_chatting=? WHERE tg_id=?", (1 if on else 0, user_id))
+    invalidate_user(user_id)
 
 
+@_sharded(user="user_id")
 def is_user_chatting(user_id: int) -> bool:
+    pending = _wb_pending_user(user_id, "is_chatting")
+    if pending is not None:
+        return bool(pending)
     r = _q("SELECT is_chatting FROM users WHERE tg_id=?", (user_id,)).fetchone()
     return bool(r and int(r["is_chatting"] or 0))
 
 
 # ----- Proactive Plan -----
+@_sharded(user="user_id")
 def get_user_settings(user_id: int) -> tuple[int, int]:
     u = get_user(user_id) or {}
     per_day = int(u.get("pro_per_day") or 2)
@@ -1329,6 +3799,7 @@ def get_user_settings(user_id: int) -> tuple[int, int]:
     return per_day, min_gap_sec
 
 
+@_sharded(user="user_id")
 def get_delay_range(user_id: int) -> tuple[int, int]:
     """Возвращает (min_delay_sec, max_delay_sec) с дефолтами."""
     u = get_user(user_id) or {}
@@ -1339,6 +3810,7 @@ def get_delay_range(user_id: int) -> tuple[int, int]:
     return min_delay_sec, max_delay_sec
 
 
+@_sharded(user="user_id")
 def get_pending_plan(user_id: int) -> list[dict]:
     rows = _q(
         "SELECT * FROM proactive_plan WHERE user_id=? AND status='PENDING' ORDER BY fire_at",
@@ -1347,26 +3819,37 @@ def get_pending_plan(user_id: int) -> list[dict]:
     return [dict(r) for r in rows]
 
 
+@_sharded(user="user_id")
 def insert_plan(user_id: int, chat_id: int, fire_at: int) -> int:
-    cur = _exec(
-        "INSERT INTO proactive_plan(user_id,chat_id,fire_at,created_at) VALUES (?,?,?, strftime('%s','now'))",
-        (user_id, chat_id, int(fire_at)),
-    )
+    with _conn_lock:
+        cur = _exec(
+            "INSERT INTO proactive_plan(id,user_id,chat_id,fire_at,created_at) "
+            "VALUES (?,?,?,?, strftime('%s','now'))",
+            (_next_id("proactive_plan"), user_id, chat_id, int(fire_at)),
+        )
     return int(cur.lastrowid)
 
 
+@_sharded(user="user_id")
 def delete_future_plan(user_id: int) -> None:
     _exec("DELETE FROM proactive_plan WHERE user_id=? AND status='PENDING'", (user_id,))
 
 
 def get_due_plans(now_ts: int, limit: int = 100) -> list[dict]:
-    rows = _q(
-        "SELECT * FROM proactive_plan WHERE status='PENDING' AND fire_at<=? ORDER BY fire_at LIMIT ?",
-        (int(now_ts), int(limit)),
-    ).fetchall()
-    return [dict(r) for r in rows]
+    def _shard():
+        rows = _q(
+            "SELECT * FROM proactive_plan WHERE status='PENDING' AND fire_at<=? ORDER BY fire_at LIMIT ?",
+            (int(now_ts), int(limit)),
+        ).fetchall()
+        return [dict(r) for r in rows]
+
+    parts = _fan_out(_shard)
+    if len(parts) == 1:
+        return parts[0]
+    return sorted((p for part in parts for p in part), key=lambda p: p["fire_at"])[: int(limit)]
 
 
+@_sharded(row="plan_id")
 def mark_plan_sent(plan_id: int, ts: int) -> None:
     _exec(
         "UPDATE proactive_plan SET status='SENT', sent_at=? WHERE id=?",
@@ -1374,6 +3857,7 @@ def mark_plan_sent(plan_id: int, ts: int) -> None:
     )
 
 
+@_sharded(row="plan_id")
 def skip_and_reschedule(plan_id: int, new_fire_at: int) -> None:
     _exec("UPDATE proactive_plan SET status='SKIPPED' WHERE id=?", (int(plan_id),))
     row = _q("SELECT user_id, chat_id FROM proactive_plan WHERE id=?", (int(plan_id),)).fetchone()
@@ -1383,7 +3867,16 @@ def skip_and_reschedule(plan_id: int, new_fire_at: int) -> None:
 
 # ------------- Broadcast log -------------
 
+@_sharded(user="user_id")
 def log_broadcast_status(user_id: int, status: str, note: str | None = None) -> None:
+    if _wb_enabled():
+        _wb_put(
+            row=(
+                "INSERT INTO broadcast_log(user_id, status, note, created_at) VALUES (?,?,?,?)",
+                (user_id, status, note, _utcnow_sql()),
+            )
+        )
+        return
     _exec(
         "INSERT INTO broadcast_log(user_id, status, note) VALUES (?,?,?)",
         (user_id, status, note),
@@ -1397,3 +3890,291 @@ def log_broadcast_sent(user_id: int) -> None:
 def log_broadcast_error(user_id: int, note: str) -> None:
     log_broadcast_status(user_id, "error", note)
 
+
+
+# ------------- Retention -------------
+# Журналы пишутся только в конец, поэтому старые строки — их голова по id.
+# retention_step() за вызов срезает с каждой таблицы не больше одного окна
+# из bulk_chunk_rows строк (своя короткая транзакция) и останавливается на
+# первой строке моложе срока хранения. token_log перед удалением
+# сворачивается в помесячные итоги token_log_monthly. Освобождённые страницы
+# переиспользуются сразу; vacuum_step() возвращает их ОС без полного VACUUM
+# (для баз, созданных с auto_vacuum=INCREMENTAL).
+_TOKEN_LOG_ROLLUP_SQL = """
+    INSERT INTO token_log_monthly(user_id, month, credit, debit, entries)
+    SELECT user_id, strftime('%Y-%m', created_at, 'unixepoch'),
+           SUM(MAX(amount, 0)), SUM(MIN(amount, 0)), COUNT(*)
+      FROM token_log
+     WHERE id > 0 AND id <= :hi AND created_at < :cutoff
+     GROUP BY 1, 2
+    ON CONFLICT(user_id, month) DO UPDATE SET
+        credit = credit + excluded.credit,
+        debit = debit + excluded.debit,
+        entries = entries + excluded.entries
+"""
+
+# (таблица, колонка времени, настройка срока, сколько дней по умолчанию, свёртка)
+_RETENTION: Tuple[Tuple[str, str, str, float, str | None], ...] = (
+    ("token_log", "created_at", "token_log_keep_days", 180, _TOKEN_LOG_ROLLUP_SQL),
+    ("toki_log", "created_at", "log_keep_days", 90, None),
+    ("broadcast_log", "created_at", "log_keep_days", 90, None),
+    ("proactive_log", "sent_at", "log_keep_days", 90, None),
+)
+
+
+def _prune_head(table: str, ts_col: str, cutoff: int | str, chunk: int, rollup: str | None) -> bool:
+    """Delete old rows from the first ``chunk`` rows of a log; ``True`` if more may follow."""
+    assert _conn is not None
+    with _conn_lock, _conn:
+        n, hi = _conn.execute(
+            f"SELECT COUNT(*), MAX(id) FROM (SELECT id FROM {table} WHERE id > 0 ORDER BY id LIMIT ?)",
+            (chunk,),
+        ).fetchone()
+        if not n:
+            return False
+        params = {"hi": int(hi), "cutoff": cutoff}
+        if rollup:
+            _conn.execute(rollup, params)
+        deleted = _conn.execute(
+            f"DELETE FROM {table} WHERE id > 0 AND id <= :hi AND {ts_col} < :cutoff", params
+        ).rowcount
+    return deleted == n == chunk
+
+
+def _prune_plans(chunk: int) -> bool:
+    """Delete SENT/SKIPPED plans older than ``plan_keep_days``."""
+    cutoff = int(time.time() - float(_cfg("plan_keep_days", 7)) * 86400)
+    assert _conn is not None
+    with _conn_lock, _conn:
+        deleted = _conn.execute(
+            "DELETE FROM proactive_plan WHERE id IN ("
+            " SELECT id FROM proactive_plan WHERE status IN ('SENT','SKIPPED') AND fire_at < ? LIMIT ?)",
+            (cutoff, chunk),
+        ).rowcount
+    return deleted == chunk
+
+
+def _prune_holds(chunk: int) -> bool:
+    """Delete expired balance holds left by turns that never finished."""
+    assert _conn is not None
+    with _conn_lock, _conn:
+        deleted = _conn.execute(
+            "DELETE FROM token_holds WHERE id IN ("
+            " SELECT id FROM token_holds WHERE expires_at <= ? LIMIT ?)",
+            (int(time.time()), chunk),
+        ).rowcount
+    return deleted == chunk
+
+
+def retention_step(limit: int | None = None) -> bool:
+    """Prune one chunk from every log table; ``False`` once nothing is left.
+
+    Retention is set per table in days (``token_log_keep_days``,
+    ``log_keep_days``, ``plan_keep_days``); ``0`` keeps rows forever.
+    """
+    _wb_flush()
+    return any(_fan_out(lambda: _retention_step(limit)))
+
+
+def _retention_step(limit: int | None) -> bool:
+    chunk = max(1, int(limit or _cfg("bulk_chunk_rows", 1000)))
+    now = datetime.utcnow()
+    epoch = {(table, col) for table, col, _batch in _EPOCH_COLUMNS}
+    more = False
+    for table, ts_col, setting, default, rollup in _RETENTION:
+        days = float(_cfg(setting, default))
+        if days > 0:
+            if (table, ts_col) in epoch:
+                cutoff: int | str = int(time.time() - days * 86400)
+            else:
+                cutoff = (now - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+            more |= _prune_head(table, ts_col, cutoff, chunk, rollup)
+    if float(_cfg("plan_keep_days", 7)) > 0:
+        more |= _prune_plans(chunk)
+    more |= _prune_holds(chunk)
+    return more
+
+
+def vacuum_step(pages: int | None = None) -> int:
+    """Return up to ``pages`` free pages to the OS; the number released.
+
+    With shards every file gets its own budget of ``pages``.
+    """
+    released = 0
+    for sh in _files():
+        token = _ctx.set(sh)
+        try:
+            released += _vacuum_step(pages)
+        finally:
+            _ctx.reset(token)
+    return released
+
+
+def _vacuum_step(pages: int | None) -> int:
+    assert _conn is not None
+    with _conn_lock:
+        if _conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:  # INCREMENTAL
+            return 0
+        pages = max(1, int(pages or _cfg("vacuum_pages", 2000)))
+        before = _conn.execute("PRAGMA freelist_count").fetchone()[0]
+        # execute() делает у этой прагмы лишь один шаг (одну страницу)
+        _conn.executescript(f"PRAGMA incremental_vacuum({pages})")
+        return before - _conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+# ------------- Backup -------------
+# Горячая копия: снимок берётся через отдельное read-only соединение с
+# открытой читающей транзакцией (WAL), поэтому писатель продолжает работу,
+# а копирование не перезапускается от его коммитов. Страницы копируются
+# пачками по backup_pages с паузой между шагами; _conn_lock не берётся.
+# Свежая копия подключается как неизменяемая реплика для тяжёлой аналитики.
+# При шардировании копируется каждый файл; реплика — своя у каждого шарда.
+# _snapshot_lock защищает только смену реплики: запросы идут без него, каждый
+# на своём соединении, так что тяжёлые /stats не ждут друг друга и ротацию.
+_snapshot_lock = threading.Lock()
+
+
+class _Replica:
+    """Read-only connections to one snapshot file, one per running query."""
+
+    __slots__ = ("uri", "idle", "closed")
+
+    def __init__(self, path: Path):
+        self.uri = f"{path.resolve().as_uri()}?mode=ro&immutable=1"
+        self.idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self.closed = False
+
+    def get(self) -> sqlite3.Connection:
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            conn = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            return conn
+
+    def put(self, conn: sqlite3.Connection) -> None:
+        self.idle.put(conn)
+        if self.closed:  # реплику сменили, пока шёл запрос
+            self._drain()
+
+    def close(self) -> None:
+        self.closed = True
+        self._drain()
+
+    def _drain(self) -> None:
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def _backup_dir() -> Path:
+    assert _conn_path is not None
+    d = _cfg("backup_dir", "")
+    return Path(d) if d else _conn_path.parent / "backups"
+
+
+def _latest_backup() -> Path | None:
+    d = _backup_dir()
+    files = sorted(d.glob(f"{_cur().path.stem}-*.db")) if d.is_dir() else []
+    return files[-1] if files else None
+
+
+def _attach_snapshot(path: Path | None) -> None:
+    """Serve analytics from ``path`` (``None`` detaches the replica)."""
+    sh = _cur()
+    replica = _Replica(path) if path is not None else None
+    with _snapshot_lock:
+        old, sh.snapshot = sh.snapshot, replica
+        sh.snapshot_at = path.stat().st_mtime if path is not None else None
+    if old is not None:
+        old.close()
+
+
+def _snap_q(sql: str, params: Tuple | Dict | None = None) -> _Rows:
+    """Read from the analytics replica if it is fresh enough, else live."""
+    sh = _cur()
+    max_age = float(_cfg("snapshot_max_age_h", 24)) * 3600
+    with _snapshot_lock:
+        replica = sh.snapshot
+        if sh.snapshot_at is None or time.time() - sh.snapshot_at > max_age:
+            replica = None
+    if replica is None:
+        return _q(sql, params)
+    conn = replica.get()
+    try:
+        return _Rows(conn.execute(sql, params or ()).fetchall())
+    finally:
+        replica.put(conn)
+
+
+def snapshot_taken_at() -> datetime | None:
+    """UTC time of the replica used by the stats, ``None`` when reading live.
+
+    With shards this is the oldest replica, and ``None`` as soon as any
+    shard reads live.
+    """
+    max_age = float(_cfg("snapshot_max_age_h", 24)) * 3600
+    with _snapshot_lock:
+        stamps = [sh.snapshot_at for sh in _shards]
+    if any(ts is None or time.time() - ts > max_age for ts in stamps):
+        return None
+    return datetime.utcfromtimestamp(min(stamps))
+
+
+def backup(dest: str | Path | None = None) -> Path:
+    """Copy the live database to ``dest`` without stopping writes.
+
+    Without ``dest`` the copy goes to the backup directory, only the newest
+    ``backup_keep`` copies are kept and the new one becomes the analytics
+    replica.
+    """
+    assert _conn_path is not None
+    _wb_flush()
+    rotate = dest is None
+    if dest is None:
+        dest = _backup_dir() / f"{_conn_path.stem}-{datetime.utcnow():%Y%m%d-%H%M%S}.db"
+    dest = Path(dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    for sh in _files():
+        # шарды — рядом, с тем же суффиксом, что и у живых файлов
+        name = dest.name if sh is _shared else f"{sh.path.stem}{dest.name[len(_conn_path.stem):]}"
+        token = _ctx.set(sh)
+        try:
+            _backup_file(dest.with_name(name), rotate)
+        finally:
+            _ctx.reset(token)
+    return dest
+
+
+def _backup_file(dest: Path, rotate: bool) -> None:
+    sh = _cur()
+    assert sh.conn is not None
+    part = dest.with_name(dest.name + ".part")
+    part.unlink(missing_ok=True)
+    pages = max(1, int(_cfg("backup_pages", 256)))
+    pause = max(0, int(_cfg("backup_pause_ms", 5))) / 1000.0
+    dst = sqlite3.connect(str(part))
+    try:
+        if str(sh.path) == ":memory:":
+            with _conn_lock:
+                _conn.backup(dst)
+        else:
+            src = _connect(sh.path, readonly=True)
+            try:
+                src.execute("BEGIN")
+                src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()  # фиксируем снимок
+                src.backup(dst, pages=pages, progress=lambda *_: time.sleep(pause))
+                src.rollback()
+            finally:
+                src.close()
+        # копия самодостаточна: без -wal/-shm, открывается и только на чтение
+        dst.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        dst.close()
+    os.replace(part, dest)
+    if rotate:
+        keep = max(1, int(_cfg("backup_keep", 3)))
+        for old in sorted(dest.parent.glob(f"{sh.path.stem}-*.db"))[:-keep]:
+            old.unlink(missing_ok=True)
+        _attach_snapshot(dest)
@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import re
+
+# Курсор keyset-пагинации в callback_data (лимит Telegram — 64 байта):
+# ключ (флаг, unix time, id) -> "1.1704112200.42"; в курсоре нет ':', и он
+# не ломает разбор callback.
+_CURSOR_RE = re.compile(r"^(\d)\.(\d+)\.(\d+)$")
+
+
+def encode_cursor(key: tuple[int, int, int]) -> str:
+    flag, ts, row_id = key
+    return f"{int(flag)}.{int(ts or 0)}.{int(row_id)}"
+
+
+def decode_cursor(s: str) -> tuple[int, int, int] | None:
+    m = _CURSOR_RE.match(s or "")
+    if not m:
+        return None
+    flag, ts, row_id = m.groups()
+    return int(flag), int(ts), int(row_id)
+
+
+def parse_page_data(data: str) -> tuple[int, str | None, tuple[int, int, int] | None] | None:
+    """Parse ``<prefix>:page:<n>[:<n|p><cursor>]`` callback data.
+
+    Returns ``(page, direction, key)``; direction is ``"n"`` (after key),
+    ``"p"`` (before key) or ``None`` for a plain page number.
+    """
+    parts = (data or "").split(":")
+    if len(parts) < 3 or not parts[2].isdigit():
+        return None
+    page = max(1, int(parts[2]))
+    if len(parts) < 4:
+        return page, None, None
+    tok = parts[3]
+    key = decode_cursor(tok[1:]) if tok[:1] in ("n", "p") else None
+    if key is None:
+        return page, None, None
+    return page, tok[0], key
+
+
+def page_nav_data(prefix: str, page: int, direction: str, key: tuple[int, int, int]) -> str:
+    return f"{prefix}:page:{page}:{direction}{encode_cursor(key)}"
+
+
+def total_pages(count: int, page_size: int, pages_max: int) -> int:
+    pages = max(1, -(-int(count) // max(1, int(page_size))))
+    return min(pages, max(1, int(pages_max)))
@@ -0,0 +1,97 @@
+from pathlib import Path
+
+from app import storage
+
+
+def _setup(tmp_path: Path):
+    storage.init(tmp_path / "db.sqlite")
+    storage.ensure_user(1, "u")
+    storage.ensure_user(2, "v")
+    char_id = storage.ensure_character("Alice")
+    return char_id
+
+
+def _trace():
+    statements: list[str] = []
+    for c in [storage._conn, *storage._reader_conns]:
+        c.set_trace_callback(statements.append)
+    return statements
+
+
+def test_pointer_follows_create_message_and_open(tmp_path: Path):
+    char_id = _setup(tmp_path)
+    first = storage.create_chat(1, char_id)
+    second = storage.create_chat(1, char_id)
+    assert storage.get_last_chat(1)["id"] == second
+
+    storage.add_message(first, is_user=True, content="hi")
+    assert storage.get_last_chat(1)["id"] == first
+
+    storage.set_active_chat(1, second)
+    assert storage.get_last_chat(1)["id"] == second
+
+    # чужой чат активным не становится
+    other = storage.create_chat(2, char_id)
+    storage.set_active_chat(1, other)
+    assert storage.get_last_chat(1)["id"] == second
+
+
+def test_active_chat_lookup_is_cached(tmp_path: Path):
+    char_id = _setup(tmp_path)
+    chat_id = storage.create_chat(1, char_id)
+    storage.add_message(chat_id, is_user=True, content="hi")
+    storage.get_last_chat(1)
+
+    statements = _trace()
+    for _ in range(3):
+        last = storage.get_last_chat(1)
+        assert last["id"] == chat_id and last["char_name"] == "Alice"
+        assert storage.get_chat(chat_id)["mode"] == last["mode"]
+    assert not [s for s in statements if s.lstrip().upper().startswith("SELECT")]
+
+
+def test_cache_invalidation(tmp_path: Path):
+    char_id = _setup(tmp_path)
+    chat_id = storage.create_chat(1, char_id)
+    storage.get_chat(chat_id)
+
+    storage.update_user_chats_mode(1, "chat")
+    assert storage.get_chat(chat_id)["mode"] == "chat"
+
+    storage.toggle_fav_chat(1, chat_id, allow_max=5)
+    assert storage.get_chat(chat_id)["is_favorite"] == 1
+
+    storage.set_cached_tokens(chat_id, 77)
+    assert storage.get_cached_tokens(chat_id) == 77
+    assert storage.get_chat(chat_id)["cached_tokens"] == 77
+
+    storage.set_character_photo(char_id, "file1")
+    assert storage.get_chat(chat_id)["char_photo"] == "file1"
+
+    before = storage.get_chat(chat_id)["updated_at"]
+    storage.add_message(chat_id, is_user=True, content="x")
+    assert storage.get_chat(chat_id)["updated_at"] >= before
+
+
+def test_delete_resets_pointer(tmp_path: Path):
+    char_id = _setup(tmp_path)
+    older = storage.create_chat(1, char_id)
+    newer = storage.create_chat(1, char_id)
+    assert storage.delete_chat(newer, 1)
+    assert storage.get_chat(newer) is None
+    assert storage.get_user(1)["active_chat_id"] is None
+    assert storage.get_last_chat(1)["id"] == older
+
+
+def test_migration_backfills_pointer(tmp_path: Path):
+    char_id = _setup(tmp_path)
+    storage.create_chat(1, char_id)
+    newer = storage.create_chat(1, char_id)
+    # база до появления schema_version и active_chat_id
+    storage._exec("ALTER TABLE users DROP COLUMN active_chat_id")
+    storage._exec("DROP TABLE schema_version")
+    storage.close()
+
+    storage.init(tmp_path / "db.sqlite")
+    assert storage.get_user(1)["active_chat_id"] == newer
+    assert storage.get_user(2)["active_chat_id"] is None
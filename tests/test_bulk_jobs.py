@@ -0,0 +1,59 @@
+from pathlib import Path
+from types import SimpleNamespace
+
+from app import storage
+
+
+def _settings(chunk: int):
+    return SimpleNamespace(
+        subs=SimpleNamespace(nightly_toki_bonus={"free": 50}),
+        storage=SimpleNamespace(bulk_chunk_rows=chunk),
+    )
+
+
+def _commits(fn, *args, **kwargs):
+    commits: list[str] = []
+    storage._conn.set_trace_callback(lambda s: commits.append(s) if s == "COMMIT" else None)
+    try:
+        res = fn(*args, **kwargs)
+    finally:
+        storage._conn.set_trace_callback(None)
+    return res, len(commits)
+
+
+def test_daily_bonus_runs_in_chunked_transactions(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(storage, "settings", _settings(10))
+    storage.init(tmp_path / "db.sqlite")
+    for uid in range(1, 26):
+        storage.ensure_user(uid, f"u{uid}")
+    storage.set_user_field(7, "subscription", "pro")
+    storage._exec("UPDATE users SET last_daily_bonus_at=? WHERE tg_id=8", (storage._utcnow_sql(),))
+    storage.get_user(1)  # закэшированная строка должна сброситься
+
+    uids, commits = _commits(storage.daily_bonus_free_users)
+    assert uids == [u for u in range(1, 26) if u not in (7, 8)]
+    assert commits == 3
+    assert storage.get_user(1)["free_toki"] == 50
+    assert storage.get_user(7)["free_toki"] == 0
+    rows = storage.query("SELECT user_id, amount, meta FROM token_log ORDER BY user_id")
+    assert [r["user_id"] for r in rows] == uids
+    assert {(r["amount"], r["meta"][:6]) for r in rows} == {(50, "daily:")}
+
+    assert storage.daily_bonus_free_users() == []
+
+
+def test_limit_processes_one_chunk(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(storage, "settings", _settings(1000))
+    storage.init(tmp_path / "db.sqlite")
+    for uid in range(1, 8):
+        storage.ensure_user(uid, f"u{uid}")
+        storage.set_user_field(uid, "subscription", "pro")
+        storage.set_user_field(uid, "sub_end", "2000-01-01 00:00:00")
+    storage.set_user_field(3, "sub_end", "2999-01-01 00:00:00")
+
+    first, commits = _commits(storage.expire_subscriptions, limit=4)
+    assert len(first) == 4 and commits == 1
+    rest = storage.expire_subscriptions(limit=4)
+    assert sorted(first + rest) == [1, 2, 4, 5, 6, 7]
+    assert storage.get_user(3)["subscription"] == "pro"
+    assert storage.get_user(1)["sub_end"] is None
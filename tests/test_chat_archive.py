@@ -0,0 +1,81 @@
+from pathlib import Path
+from types import SimpleNamespace
+
+from app import storage
+
+_Y2020 = 1577836800  # 2020-01-01 00:00:00 UTC
+
+
+def _chat(tmp_path: Path, n: int = 7):
+    storage.init(tmp_path / "db.sqlite")
+    storage.ensure_user(1, "u")
+    char_id = storage.ensure_character("Alice")
+    chat_id = storage.create_chat(1, char_id)
+    for i in range(n):
+        storage.add_message(chat_id, is_user=i % 2 == 0, content=f"pizza line {i}", usage_in=i, usage_out=1)
+    return char_id, chat_id
+
+
+def _snapshot(chat_id: int):
+    return [dict(m) for m in storage.list_messages(chat_id)]
+
+
+def test_archive_roundtrip_keeps_rows_and_stats(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(
+        storage, "settings", SimpleNamespace(storage=SimpleNamespace(archive_segment_rows=3))
+    )
+    char_id, chat_id = _chat(tmp_path)
+    before = _snapshot(chat_id)
+    totals = storage.user_totals(1)
+    stats = storage.get_user_char_stats(1, char_id)
+
+    assert storage.archive_chat(chat_id) is True
+    assert storage.archive_chat(chat_id) is False
+    assert storage._q("SELECT COUNT(*) FROM messages WHERE chat_id=?", (chat_id,)).fetchone()[0] == 0
+    segs = storage.query("SELECT msg_count FROM chat_archive WHERE chat_id=? ORDER BY seg", (chat_id,))
+    assert [r[0] for r in segs] == [3, 3, 1]
+    # тексты ушли и из полнотекстового индекса
+    assert storage._q("SELECT COUNT(*) FROM messages_fts WHERE messages_fts MATCH 'pizza'").fetchone()[0] == 0
+    assert storage.get_chat(chat_id)["archived"] == 1
+    assert storage.last_message_ts(chat_id) is not None
+    assert storage.user_totals(1) == totals
+    assert storage.get_user_char_stats(1, char_id) == stats
+
+    # первое чтение возвращает чат на место целиком
+    assert _snapshot(chat_id) == before
+    assert storage.get_chat(chat_id)["archived"] == 0
+    assert storage._q("SELECT COUNT(*) FROM chat_archive").fetchone()[0] == 0
+    assert len(storage.search_messages(chat_id, "pizza", limit=100)) == 7
+    storage._exec("INSERT INTO messages_fts(messages_fts, rank) VALUES ('integrity-check', 1)")
+
+
+def test_export_search_and_continue_restore(tmp_path: Path):
+    _, chat_id = _chat(tmp_path, 3)
+    text = storage.export_chat_txt(chat_id)
+
+    storage.archive_chat(chat_id)
+    assert storage.export_chat_txt(chat_id) == text
+
+    storage.archive_chat(chat_id)
+    assert len(storage.search_messages(chat_id, "pizza")) == 3
+
+    storage.archive_chat(chat_id)
+    storage.add_message(chat_id, is_user=True, content="pizza again")
+    ids = [m["id"] for m in storage.list_messages(chat_id)]
+    assert len(ids) == 4 and ids == sorted(ids)
+
+
+def test_idle_chats_are_archived_and_deleted_cleanly(tmp_path: Path):
+    char_id, old = _chat(tmp_path, 4)
+    fresh = storage.create_chat(1, char_id)
+    storage.add_message(fresh, is_user=True, content="hi")
+    storage._exec("UPDATE chats SET updated_at=? WHERE id=?", (_Y2020, old))
+
+    assert storage.archive_idle_chats(max_age_days=30) == [old]
+    assert storage.archive_idle_chats(max_age_days=30) == []
+    assert storage.get_chat(fresh)["archived"] == 0
+
+    assert storage.delete_chat(old, 1)
+    assert storage._q("SELECT COUNT(*) FROM chat_archive").fetchone()[0] == 0
+    assert storage.get_user_char_stats(1, char_id)["message_count"] == 1
+    assert storage.user_totals(1)["chats"] == 1
@@ -134,3 +134,58 @@ def test_chat_stream_single_chunk_split(monkeypatch):
         "Alpha bravo charlie delta.",
         "Echo foxtrot golf hotel. India juliet kilo lima.",
     ]
+
+
+def test_handed_over_hold_is_released_without_commit(tmp_path, monkeypatch):
+    from app import storage as real_storage
+
+    monkeypatch.setattr(
+        real_storage, "settings",
+        types.SimpleNamespace(storage=types.SimpleNamespace(write_behind_ms=0)),
+    )
+    real_storage.init(tmp_path / "db.sqlite")
+    real_storage.ensure_user(1, "u")
+    chat_id = real_storage.create_chat(1, real_storage.ensure_character("Alice"))
+    real_storage.update_user_chats_mode(1, "chat")
+    real_storage.add_paid_tokens(1, 100)
+    hold = real_storage.reserve(1, 30)
+
+    class DummyBot:
+        async def send_chat_action(self, *args, **kwargs):
+            pass
+
+    class DummyMessage:
+        from_user = types.SimpleNamespace(id=1)
+        chat = types.SimpleNamespace(id=1)
+        bot = DummyBot()
+        text = "hi"
+
+        async def answer(self, text, **kwargs):
+            pass
+
+    async def fake_chat_stream(user_id, chat_id, text):
+        # финал live передаёт резерв хендлеру
+        yield {"kind": "final", "text": "reply", "billed": 5, "reservation": str(hold)}
+
+    async def fake_typing_loop(msg, stop_evt):
+        pass
+
+    def broken_sections(buf, force=False):
+        raise RuntimeError("boom")
+
+    def turn_commit(*args, **kwargs):
+        raise AssertionError("turn_commit must not be reached")
+
+    monkeypatch.setattr(chats_module, "chat_stream", fake_chat_stream)
+    monkeypatch.setattr(chats_module, "storage", real_storage)
+    monkeypatch.setattr(chats_module, "_typing_loop", fake_typing_loop)
+    monkeypatch.setattr(chats_module, "_extract_sections", broken_sections)
+    monkeypatch.setattr(real_storage, "turn_commit", turn_commit)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(chatting_text(DummyMessage()))
+
+    assert real_storage.query("SELECT COUNT(*) FROM token_holds")[0][0] == 0
+    assert real_storage.get_user(1)["paid_tokens"] == 100
+    assert not real_storage.get_user(1)["is_chatting"]
+    assert [m["content"] for m in real_storage.list_messages(chat_id)] == ["hi"]
@@ -4,7 +4,7 @@ import pytest
 from app import storage
 
 
-def test_compress_history_rollback(tmp_path, monkeypatch):
+def test_compress_history_rollback(tmp_path):
     storage.init(tmp_path / "db.sqlite")
     storage.ensure_user(1, "u")
     char_id = storage._exec("INSERT INTO characters(name) VALUES (?)", ("Char",)).lastrowid
@@ -12,12 +12,60 @@ def test_compress_history_rollback(tmp_path, monkeypatch):
     storage.add_message(chat_id, is_user=True, content="hi")
     before = storage.list_messages(chat_id)
 
-    def fail_add_message(*args, **kwargs):
-        raise sqlite3.IntegrityError("fail")
-
-    monkeypatch.setattr(storage, "add_message", fail_add_message)
+    storage._exec(
+        "CREATE TRIGGER fail_checkpoint BEFORE INSERT ON chat_checkpoints "
+        "BEGIN SELECT RAISE(ABORT, 'fail'); END"
+    )
 
     with pytest.raises(sqlite3.IntegrityError):
         storage.compress_history(chat_id, "summary")
 
     assert storage.list_messages(chat_id) == before
+    assert storage.latest_checkpoint(chat_id) is None
+
+
+def test_checkpoint_is_not_counted_as_reply(tmp_path):
+    storage.init(tmp_path / "db.sqlite")
+    storage.ensure_user(1, "u")
+    char_id = storage.ensure_character("Char")
+    chat_id = storage.create_chat(1, char_id)
+    storage.add_message(chat_id, is_user=True, content="hi")
+    storage.add_message(chat_id, is_user=False, content="yo", usage_in=5, usage_out=6)
+
+    def counters():
+        return [
+            [tuple(r) for r in storage.query(f"SELECT * FROM {table} ORDER BY 1, 2")]
+            for table in ("user_counters", "user_char_stats", "usage_daily")
+        ]
+
+    before = counters()
+    storage.compress_history(chat_id, "summary", usage_in=3, usage_out=2)
+    assert storage.latest_checkpoint(chat_id)["summary"] == "summary"
+    assert counters() == before
+    assert storage.user_totals(1)["ai_msgs"] == 1
+
+
+def test_checkpoint_keeps_history(tmp_path):
+    storage.init(tmp_path / "db.sqlite")
+    storage.ensure_user(1, "u")
+    char_id = storage.ensure_character("Char")
+    chat_id = storage.create_chat(1, char_id)
+    ids = [storage.add_message(chat_id, is_user=i % 2 == 0, content=f"m{i}") for i in range(4)]
+
+    storage.compress_history(chat_id, "summary", usage_in=3, usage_out=2)
+    cp = storage.latest_checkpoint(chat_id)
+    assert (cp["upto_message_id"], cp["summary"], cp["usage_in"], cp["usage_out"]) == (ids[-1], "summary", 3, 2)
+    assert storage.list_messages(chat_id, after_id=cp["upto_message_id"]) == []
+
+    new = storage.add_message(chat_id, is_user=True, content="after")
+    storage.drop_tail()
+    for limit in (None, 1, 10):
+        assert [m["id"] for m in storage.list_messages(chat_id, limit=limit, after_id=ids[-1])] == [new]
+    # экспорт — вся история, сводка не подменяет сообщения
+    assert storage.export_chat_txt(chat_id).splitlines() == [
+        "[User] m0", "[Char] m1", "[User] m2", "[Char] m3", "[User] after"
+    ]
+
+    storage.compress_history(chat_id, "summary 2")
+    assert storage.latest_checkpoint(chat_id)["summary"] == "summary 2"
+    assert storage.list_messages(chat_id, limit=2, after_id=ids[1]) == storage.list_messages(chat_id, limit=2)
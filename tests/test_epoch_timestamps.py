@@ -0,0 +1,122 @@
+import calendar
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from app import storage
+
+_LEGACY = "2024-03-01 12:00:00"
+_TS = calendar.timegm(time.strptime(_LEGACY, "%Y-%m-%d %H:%M:%S"))
+
+
+def _settings(monkeypatch, **kw):
+    kw.setdefault("write_behind_ms", 0)
+    monkeypatch.setattr(storage, "settings", SimpleNamespace(storage=SimpleNamespace(**kw)))
+
+
+def _assert_no_text() -> None:
+    for table, col, _batch in storage._EPOCH_COLUMNS:
+        n = storage.query(f"SELECT COUNT(*) FROM {table} WHERE {col} IS NOT NULL AND typeof({col}) <> 'integer'")
+        assert n[0][0] == 0, (table, col)
+
+
+def _hist_exec(sql: str) -> None:
+    with storage._on(storage._hist()):
+        storage._exec(sql)
+
+
+def _legacy_db(db: Path, monkeypatch) -> tuple[int, int]:
+    """Database at v10: the timestamps are CURRENT_TIMESTAMP text."""
+    migrations = storage._MIGRATIONS
+    monkeypatch.setattr(storage, "_MIGRATIONS", migrations[:10])
+    storage.init(db)
+    storage._m012_chat_totals()  # колонки итогов чатов нужны нынешним писателям
+    storage.ensure_user(1, "u")
+    char_id = storage.ensure_character("Alice")
+    live, cold = storage.create_chat(1, char_id), storage.create_chat(1, char_id)
+    for chat_id in (live, cold):
+        for i in range(3):
+            storage.add_message(chat_id, is_user=i % 2 == 0, content=f"m{i}")
+    storage.add_paid_tokens(1, 10)
+    _hist_exec(f"UPDATE messages SET created_at='{_LEGACY}'")
+    storage.archive_chat(cold)  # сегмент с временем текстом
+    for table, col in (("chats", "updated_at"), ("token_log", "created_at"), ("user_char_stats", "last_use")):
+        storage._exec(f"UPDATE {table} SET {col}='{_LEGACY}'")
+    storage._exec("INSERT INTO proactive_log(user_id, chat_id, char_id) VALUES (1, ?, ?)", (live, char_id))
+    storage._exec("UPDATE users SET last_proactive_at=CURRENT_TIMESTAMP")
+    storage.close()
+    monkeypatch.setattr(storage, "_MIGRATIONS", migrations)
+    return live, cold
+
+
+@pytest.mark.parametrize("split", [False, True])
+def test_legacy_timestamps_are_converted(tmp_path: Path, monkeypatch, split):
+    _settings(monkeypatch, split_history=split, migrate_batch=2)
+    live, cold = _legacy_db(tmp_path / "db.sqlite", monkeypatch)
+    storage.init(tmp_path / "db.sqlite")
+
+    _assert_no_text()
+
+    assert storage.last_message_ts(live) == datetime.fromtimestamp(_TS, timezone.utc)
+    assert storage.last_message_ts(cold) == datetime.fromtimestamp(_TS, timezone.utc)
+    assert {m["created_at"] for m in storage.list_messages(cold)} == {_TS}  # восстановлен из архива
+    assert storage.get_chat(live)["updated_at"] == _TS
+    assert storage.get_user_char_stats(1, storage.get_chat(live)["char_id"])["last_use"] == _TS
+    assert storage.list_token_log(1, limit=1)[0]["created_at"] == _TS
+    assert storage.proactive_count_today(1) == 1
+    assert time.time() - storage.get_user(1)["last_proactive_at"] < 3600
+
+
+def test_every_writer_stores_unix_time(tmp_path: Path, monkeypatch):
+    # в схеме остался DEFAULT CURRENT_TIMESTAMP — время передают сами вставки
+    monkeypatch.setattr(
+        storage, "settings",
+        SimpleNamespace(
+            storage=SimpleNamespace(write_behind_ms=0),
+            subs=SimpleNamespace(nightly_toki_bonus={"free": 5}),
+        ),
+    )
+    storage.init(tmp_path / "db.sqlite")
+    storage.ensure_user(1, "u")
+    char_id = storage.ensure_character("Alice")
+    chat_id = storage.create_chat(1, char_id)
+    storage.add_message(chat_id, is_user=True, content="hi")
+    storage.add_paid_tokens(1, 100)
+    storage.add_toki(1, 5)
+    storage.spend_tokens(1, 3)
+    storage.settle(storage.reserve(1, 10), 4)
+    storage.turn_commit(chat_id, "reply", billed=1, reservation=storage.reserve(1, 5))
+    storage.daily_bonus_free_users()
+    storage.compress_history(chat_id, "summary")
+    storage.log_proactive(1, chat_id, char_id)
+    storage.archive_chat(chat_id)
+    _assert_no_text()
+    storage.restore_chat(chat_id)
+    _assert_no_text()
+
+
+def test_today_is_a_range(tmp_path: Path, monkeypatch):
+    _settings(monkeypatch)
+    storage.init(tmp_path / "db.sqlite")
+    storage.ensure_user(1, "u")
+    midnight = int(time.time()) // 86400 * 86400
+    for ts in (midnight - 1, midnight, midnight + 86399, midnight + 86400):
+        storage._exec("INSERT INTO proactive_log(user_id, chat_id, char_id, sent_at) VALUES (1, 1, 1, ?)", (ts,))
+    storage.log_proactive(1, 1, 1)
+    assert storage.proactive_count_today(1) == 3
+    plan = storage.query(
+        "EXPLAIN QUERY PLAN SELECT COUNT(*) FROM proactive_log WHERE user_id=? AND sent_at >= ? AND sent_at < ?",
+        (1, midnight, midnight + 86400),
+    )
+    assert "idx_proactive_log_user (user_id=? AND sent_at>? AND sent_at<?)" in plan[0][3]
+
+
+def test_admin_output_keeps_text_dates():
+    assert storage.ts_text(_TS) == _LEGACY
+    assert storage.ts_text(_LEGACY) == _LEGACY
+    assert storage.ts_text(_TS, "%Y-%m-%d %H:%M") == "2024-03-01 12:00"
+    assert storage.ts_text("2024-03") == "2024-03"  # помесячные итоги token_log_monthly
+    assert storage.ts_text(None) == ""
@@ -0,0 +1,82 @@
+import sqlite3
+from pathlib import Path
+
+from app import storage
+
+
+def _legacy_db(path: Path, n: int) -> None:
+    """Database as written before the index became external-content."""
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        """
+        CREATE TABLE messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL,
+            is_user INTEGER NOT NULL, content TEXT NOT NULL,
+            usage_in INTEGER, usage_out INTEGER,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP);
+        CREATE VIRTUAL TABLE messages_fts USING fts5(
+            content, chat_id UNINDEXED, is_user UNINDEXED);
+        """
+    )
+    conn.executemany(
+        "INSERT INTO messages(chat_id, is_user, content) VALUES (1, 1, ?)",
+        [(f"pizza number {i}",) for i in range(n)],
+    )
+    conn.execute(
+        "INSERT INTO messages_fts(rowid, content, chat_id, is_user) "
+        "SELECT id, content, chat_id, is_user FROM messages"
+    )
+    conn.commit()
+    conn.close()
+
+
+def test_triggers_keep_index_in_sync(tmp_path: Path):
+    storage.init(tmp_path / "db.sqlite")
+    storage.ensure_user(1, "u")
+    char_id = storage.ensure_character("Alice")
+    chat_id = storage.create_chat(1, char_id)
+    storage.add_message(chat_id, is_user=True, content="I love pizza")
+    assert storage.search_messages(chat_id, "pizza")
+
+    # сводка — контрольная точка, а не сообщение: поиск видит всю историю
+    storage.compress_history(chat_id, "summary about pasta")
+    assert storage.search_messages(chat_id, "pizza")
+    assert storage.search_messages(chat_id, "pasta") == []
+
+    assert storage.delete_chat(chat_id, 1)
+    assert storage.search_messages(chat_id, "pizza") == []
+    storage._exec("INSERT INTO messages_fts(messages_fts, rank) VALUES ('integrity-check', 1)")
+    # no second copy of message bodies
+    assert storage._q("SELECT 1 FROM sqlite_master WHERE name='messages_fts_content'").fetchone() is None
+
+
+def test_legacy_index_is_replaced_and_backfilled_in_batches(tmp_path: Path):
+    db = tmp_path / "db.sqlite"
+    _legacy_db(db, 25)
+    storage.init(db)
+    assert storage.search_messages(1, "pizza", limit=100) == []
+
+    # new rows are indexed immediately, old ones wait for the backfill
+    storage.add_message(1, is_user=True, content="fresh pizza")
+    assert [h["content"] for h in storage.search_messages(1, "pizza", limit=100)] == ["fresh pizza"]
+
+    # deleting a not yet indexed row must not touch the index
+    storage._exec("DELETE FROM messages WHERE id=3")
+    assert storage.fts_backfill_step(10) is True
+
+    # restart in the middle: progress survives
+    storage.close()
+    storage.init(db)
+    assert len(storage.search_messages(1, "pizza", limit=100)) == 11
+
+    steps = 0
+    while storage.fts_backfill_step(10):
+        steps += 1
+    assert steps == 1
+    assert storage.fts_backfill_step() is False
+    assert len(storage.search_messages(1, "pizza", limit=100)) == 25
+    assert storage._q("SELECT COUNT(*) FROM fts_backfill").fetchone()[0] == 0
+
+    storage.fts_optimize(100)
+    storage.fts_optimize()
+    storage._exec("INSERT INTO messages_fts(messages_fts, rank) VALUES ('integrity-check', 1)")
@@ -58,11 +58,14 @@ def test_history_size_bounded(tmp_path, monkeypatch):
     # Send many messages to trigger compression repeatedly
     for i in range(100):
         storage.add_message(chat_id, is_user=True, content=("msg" + str(i)) * 20)
-        asyncio.run(
+        ctx = asyncio.run(
             chats._collect_context(chat_id, user_id=1, model=settings.default_model)
         )
+        assert len(ctx) <= 30
+        assert sum(1 for m in ctx if m["content"] == "summary") <= 1
 
-    msgs = storage.list_messages(chat_id)
-    assert len(msgs) <= 30
-    assert sum(1 for m in msgs if m["content"] == "summary") == 1
+    # the context stays small while the stored history is kept in full
+    assert sum(1 for m in ctx if m["content"] == "summary") == 1
+    assert len(storage.list_messages(chat_id)) == 100
+    assert storage.latest_checkpoint(chat_id)["upto_message_id"] > 0
 
@@ -0,0 +1,80 @@
+import random
+from pathlib import Path
+
+from app import storage
+from app.utils.paging import decode_cursor, encode_cursor, page_nav_data, parse_page_data, total_pages
+
+
+def _populate():
+    rnd = random.Random(3)
+    storage.ensure_user(1, "u")
+    chars = [storage.ensure_character(f"C{i}") for i in range(23)]
+    for n in range(27):
+        chat = storage.create_chat(1, rnd.choice(chars))
+        # часть чатов с одинаковым updated_at — порядок решает id
+        storage._exec("UPDATE chats SET updated_at=? WHERE id=?", (1704067200 + n // 3, chat))
+    for chat in rnd.sample(range(1, 28), 4):
+        storage.toggle_fav_chat(1, chat, allow_max=10)
+    for char_id in rnd.sample(chars, 3):
+        storage.toggle_fav_char(1, char_id)
+    storage.rebuild_user_char_stats(1)
+
+
+def _walk(fn, key, size):
+    first = fn(page=1, page_size=size)
+    pages = [first]
+    while len(pages[-1]) == size:
+        nxt = fn(page_size=size, after=key(pages[-1][-1]))
+        if not nxt:
+            break
+        pages.append(nxt)
+    back = [pages[-1]]
+    while True:
+        prev = fn(page_size=size, before=key(back[-1][0]))
+        if not prev:
+            break
+        back.append(prev)
+    return pages, back[::-1]
+
+
+def test_keyset_pages_match_offset_order(tmp_path: Path):
+    storage.init(tmp_path / "db.sqlite")
+    _populate()
+    assert storage.count_user_chats(1) == 27
+    assert storage.count_characters() == 23
+
+    for fn, key in (
+        (lambda **kw: storage.list_user_chats(1, **kw), storage.chat_key),
+        (lambda **kw: storage.list_characters_for_user(1, **kw), storage.character_key),
+    ):
+        full = [r["id"] for r in fn(page=1, page_size=1000)]
+        for size in (1, 4, 10):
+            fwd, back = _walk(fn, key, size)
+            assert [r["id"] for p in fwd for r in p] == full
+            assert [[r["id"] for r in p] for p in back] == [[r["id"] for r in p] for p in fwd]
+
+
+def test_keyset_page_has_no_offset(tmp_path: Path):
+    storage.init(tmp_path / "db.sqlite")
+    _populate()
+    last = storage.list_user_chats(1, page=2, page_size=5)[-1]
+    statements: list[str] = []
+    for c in [storage._conn, *storage._reader_conns]:
+        c.set_trace_callback(statements.append)
+    storage.list_user_chats(1, page_size=5, after=storage.chat_key(last))
+    assert any("OFFSET 0" in s for s in statements)
+
+
+def test_cursor_callback_data():
+    key = (1, 1714979289, 123456789)
+    assert decode_cursor(encode_cursor(key)) == key
+    assert decode_cursor(encode_cursor((0, 0, 5))) == (0, 0, 5)
+    data = page_nav_data("chats", 3, "n", key)
+    assert len(data.encode()) <= 64
+    assert parse_page_data(data) == (3, "n", key)
+    assert parse_page_data("chats:page:2") == (2, None, None)
+    assert parse_page_data("chats:page:2:xjunk") == (2, None, None)
+    assert parse_page_data("chats:page:foo") is None
+    assert total_pages(0, 10, 4) == 1
+    assert total_pages(21, 10, 4) == 3
+    assert total_pages(100, 10, 4) == 4
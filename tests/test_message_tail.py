@@ -0,0 +1,91 @@
+import sqlite3
+from pathlib import Path
+from types import SimpleNamespace
+
+from app import storage
+
+
+def _db_rows(chat_id: int):
+    conn = sqlite3.connect(str(storage._conn_path))
+    conn.row_factory = sqlite3.Row
+    try:
+        rows = conn.execute(
+            "SELECT * FROM messages WHERE chat_id=? ORDER BY id", (chat_id,)
+        ).fetchall()
+    finally:
+        conn.close()
+    return [dict(r) for r in rows]
+
+
+def _trace():
+    statements: list[str] = []
+    for c in [storage._conn, *storage._reader_conns]:
+        c.set_trace_callback(statements.append)
+    return statements
+
+
+def _selects(statements):
+    return [s for s in statements if "FROM messages" in s and s.lstrip().startswith("SELECT")]
+
+
+def _setup(tmp_path: Path, monkeypatch, **cfg):
+    if cfg:
+        monkeypatch.setattr(storage, "settings", SimpleNamespace(storage=SimpleNamespace(**cfg)))
+    storage.init(tmp_path / "db.sqlite")
+    storage.ensure_user(1, "u")
+    char_id = storage.ensure_character("Alice")
+    return storage.create_chat(1, char_id)
+
+
+def test_active_chat_context_needs_no_reads(tmp_path: Path, monkeypatch):
+    chat_id = _setup(tmp_path, monkeypatch, tail_size=50, tail_cache_bytes=1 << 20)
+    for i in range(5):
+        storage.add_message(chat_id, is_user=bool(i % 2), content=f"m{i}")
+    assert storage.list_messages(chat_id, limit=50) == _db_rows(chat_id)
+
+    statements = _trace()
+    for i in range(5, 60):
+        storage.add_message(chat_id, is_user=bool(i % 2), content=f"m{i}", usage_in=i)
+        assert storage.list_messages(chat_id, limit=16) == _db_rows(chat_id)[-16:]
+        assert storage.list_messages(chat_id, limit=40) == _db_rows(chat_id)[-40:]
+    assert storage.list_messages(chat_id, limit=50) == _db_rows(chat_id)[-50:]
+    assert _selects(statements) == []
+
+    # хвост больше не содержит весь чат — полный список читается из базы
+    assert storage.list_messages(chat_id) == _db_rows(chat_id)
+    assert _selects(statements)
+
+
+def test_compress_and_delete_reset_tail(tmp_path: Path, monkeypatch):
+    chat_id = _setup(tmp_path, monkeypatch)
+    for i in range(3):
+        storage.add_message(chat_id, is_user=True, content=f"m{i}")
+    storage.list_messages(chat_id, limit=10)
+
+    storage.compress_history(chat_id, "summary")
+    msgs = storage.list_messages(chat_id, limit=10)
+    assert [m["content"] for m in msgs] == [m["content"] for m in _db_rows(chat_id)]
+
+    storage.delete_chat(chat_id, 1)
+    assert storage.list_messages(chat_id, limit=10) == []
+
+
+def test_returned_rows_are_copies(tmp_path: Path, monkeypatch):
+    chat_id = _setup(tmp_path, monkeypatch)
+    storage.add_message(chat_id, is_user=True, content="hi")
+    storage.list_messages(chat_id, limit=5)[0]["content"] = "changed"
+    assert storage.list_messages(chat_id, limit=5)[0]["content"] == "hi"
+
+
+def test_memory_cap_evicts_idle_chats(tmp_path: Path, monkeypatch):
+    first = _setup(tmp_path, monkeypatch, tail_size=10, tail_cache_bytes=250)
+    second = storage.create_chat(1, storage.ensure_character("Bob"))
+    storage.add_message(first, is_user=True, content="a" * 100)
+    storage.add_message(second, is_user=True, content="b" * 100)
+    storage.list_messages(first, limit=5)
+    storage.list_messages(second, limit=5)
+    assert set(storage._tails) == {first, second}
+
+    storage.add_message(second, is_user=True, content="c" * 100)
+    assert set(storage._tails) == {second}
+    assert storage._tails_bytes <= 250
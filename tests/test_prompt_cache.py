@@ -0,0 +1,63 @@
+from pathlib import Path
+
+from app import character, config, storage
+
+
+def _setup(tmp_path: Path):
+    storage.init(tmp_path / "db.sqlite")
+    storage.ensure_user(1, "u")
+    char_id = storage.ensure_character("Alice")
+    storage.set_character_prompt(char_id, prompt="You are Alice.", keywords="tea")
+    chat_id = storage.create_chat(1, char_id, mode="rp")
+    return char_id, chat_id
+
+
+def test_same_object_until_character_changes(tmp_path: Path):
+    char_id, chat_id = _setup(tmp_path)
+    first = character.get_system_prompt_for_chat(chat_id)
+    assert first == "You are Alice.\nКлючевые слова: tea"
+    assert character.get_system_prompt_for_chat(chat_id) is first
+
+    storage.set_character_prompt(char_id, prompt="You are Alice v2.")
+    second = character.get_system_prompt_for_chat(chat_id)
+    assert second.startswith("You are Alice v2.")
+    assert character.get_system_prompt_for_chat(chat_id) is second
+
+
+def test_cached_prompt_needs_no_reads(tmp_path: Path):
+    _char_id, chat_id = _setup(tmp_path)
+    character.get_system_prompt_for_chat(chat_id)
+    statements: list[str] = []
+    for c in [storage._conn, *storage._reader_conns]:
+        c.set_trace_callback(statements.append)
+    character.get_system_prompt_for_chat(chat_id)
+    assert statements == []
+
+
+def test_mode_is_part_of_key(tmp_path: Path):
+    _char_id, chat_id = _setup(tmp_path)
+    rp = character.get_system_prompt_for_chat(chat_id)
+    storage.update_user_chats_mode(1, "chat")
+    chat = character.get_system_prompt_for_chat(chat_id)
+    assert chat.endswith(character.CHAT_STYLE)
+    assert character.CHAT_STYLE not in rp
+
+
+def test_reload_hook_drops_cache(tmp_path: Path):
+    _char_id, chat_id = _setup(tmp_path)
+    assert character.invalidate_prompts in config._ReloadHooks
+    first = character.get_system_prompt_for_chat(chat_id)
+    character.invalidate_prompts(config.settings)
+    again = character.get_system_prompt_for_chat(chat_id)
+    assert again == first and again is not first
+
+
+def test_reinit_does_not_reuse_prompts(tmp_path: Path):
+    _char_id, chat_id = _setup(tmp_path)
+    character.get_system_prompt_for_chat(chat_id)
+    storage.close()
+    storage.init(tmp_path / "other.sqlite")
+    storage.ensure_user(1, "u")
+    char_id = storage.ensure_character("Bob")
+    chat_id = storage.create_chat(1, char_id, mode="rp")
+    assert character.get_system_prompt_for_chat(chat_id) == ""
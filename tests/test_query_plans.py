@@ -0,0 +1,147 @@
+import re
+import types
+from pathlib import Path
+
+from app import storage
+
+# Queries that legitimately walk a whole table (catalog listing) or a virtual
+# table without a usable index.
+ALLOWED_SCANS = {
+    "list_characters_for_user": {"c"},
+    "messages_fts": {"messages_fts"},
+}
+
+_SCAN_RE = re.compile(r"^SCAN (\w+)")
+
+
+def _exercise(uid: int = 1) -> None:
+    storage.ensure_user(uid, "user")
+    storage.ensure_user(uid, "user2")
+    storage.get_user(uid)
+    storage.set_user_field(uid, "pro_per_day", 3)
+    storage.touch_activity(uid)
+    char_id = storage.ensure_character("Alice", slug="alice")
+    storage.ensure_character("Alice", fandom="F")
+    storage.get_character(char_id)
+    storage.toggle_fav_char(uid, char_id, allow_max=5)
+    storage.is_fav_char(uid, char_id)
+    storage.get_user_char_stats(uid, char_id)
+    chat_id = storage.create_chat(uid, char_id)
+    storage.get_chat(chat_id)
+    storage.get_cached_tokens(chat_id)
+    storage.set_cached_tokens(chat_id, 10)
+    storage.list_user_chats(uid, page=1, page_size=10)
+    storage.list_user_chats(uid, page_size=10, after=(1, "9999", 10**9))
+    storage.list_user_chats(uid, page_size=10, before=(0, "", 0))
+    storage.count_user_chats(uid)
+    storage.list_user_chats_by_char(uid, char_id, limit=1)
+    storage.get_last_chat(uid)
+    storage.set_active_chat(uid, chat_id)
+    storage.toggle_fav_chat(uid, chat_id, allow_max=5)
+    storage.update_user_chats_mode(uid, "rp")
+    storage.add_message(chat_id, is_user=True, content="hello there")
+    storage.add_message(chat_id, is_user=False, content="hi", usage_in=1, usage_out=2)
+    storage.list_messages(chat_id, limit=50)
+    storage.list_messages(chat_id)
+    storage.last_message_ts(chat_id)
+    storage.search_messages(chat_id, "hello")
+    storage.export_chat_txt(chat_id)
+    storage.archive_chat(chat_id)
+    storage.last_message_ts(chat_id)
+    storage.list_messages(chat_id)
+    storage.archive_idle_chats(max_age_days=0)
+    storage.restore_chat(chat_id)
+    storage.user_totals(uid)
+    storage.usage_by_day(ttl=0)
+    storage.add_toki(uid, 100)
+    storage.add_paid_tokens(uid, 100)
+    storage.spend_tokens(uid, 150)
+    hold = storage.reserve(uid, 10)
+    storage.settle(hold, 5)
+    storage.release(storage.reserve(uid, 10))
+    storage.list_token_log(uid, limit=5)
+    storage.retention_step()
+    storage.vacuum_step()
+    storage.get_toki_log(uid, limit=5)
+    storage.daily_bonus_free_users()
+    storage.set_user_field(uid, "subscription", "gold")
+    storage.set_user_field(uid, "sub_end", "2000-01-01 00:00:00")
+    storage.expire_subscriptions()
+    storage.log_proactive(uid, chat_id, char_id)
+    storage.proactive_count_today(uid)
+    storage.set_user_chatting(uid, True)
+    storage.is_user_chatting(uid)
+    storage.get_delay_range(uid)
+    pid = storage.insert_plan(uid, chat_id, 100)
+    storage.get_pending_plan(uid)
+    storage.get_due_plans(200)
+    storage.skip_and_reschedule(pid, 300)
+    storage.mark_plan_sent(pid, 300)
+    storage.delete_future_plan(uid)
+    tid = storage.create_topup_pending(uid, 1.5, "manual")
+    storage.has_pending_topup(uid)
+    storage.get_active_topup(uid)
+    storage.get_topup(tid)
+    storage.approve_topup(tid, 0)
+    storage.decline_topup(tid, 0)
+    storage.expire_old_topups(1)
+    storage.list_characters_for_user(uid, page=1, page_size=10)
+    storage.compress_history(chat_id, "summary")
+    storage.latest_checkpoint(chat_id)
+    storage.drop_tail()
+    storage.list_messages(chat_id, after_id=1)
+    storage.list_messages(chat_id, limit=5, after_id=1)
+    storage.delete_chat(chat_id, uid)
+
+
+def test_hot_queries_use_indexes(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(
+        storage,
+        "settings",
+        types.SimpleNamespace(subs=types.SimpleNamespace(nightly_toki_bonus={"free": 10})),
+    )
+    storage.init(tmp_path / "db.sqlite")
+    statements: list[str] = []
+    conns = [storage._conn, *storage._reader_conns]
+    for c in conns:
+        c.set_trace_callback(statements.append)
+    try:
+        _exercise()
+    finally:
+        for c in conns:
+            c.set_trace_callback(None)
+
+    conn = storage._conn
+    offenders = []
+    checked = 0
+    for sql in dict.fromkeys(statements):
+        head = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ""
+        if head not in {"SELECT", "UPDATE", "DELETE", "WITH"}:
+            continue
+        if "'main'." in sql:
+            continue  # FTS5 reading its own shadow tables
+        checked += 1
+        allowed = set()
+        if "messages_fts" in sql:
+            allowed |= ALLOWED_SCANS["messages_fts"]
+        if "FROM characters c WHERE NOT EXISTS" in " ".join(sql.split()):
+            allowed |= ALLOWED_SCANS["list_characters_for_user"]
+        for row in conn.execute("EXPLAIN QUERY PLAN " + sql).fetchall():
+            m = _SCAN_RE.match(row[3])
+            if m and m.group(1) not in allowed:
+                offenders.append((" ".join(sql.split()), row[3]))
+    assert checked > 30
+    assert offenders == []
+
+
+def test_managed_indexes_created_and_stale_dropped(tmp_path: Path):
+    storage.init(tmp_path / "db.sqlite")
+    storage._exec("CREATE INDEX idx_stale ON users(username)")
+    storage._exec("DROP INDEX idx_messages_chat")
+    storage._ensure_indexes()
+    names = {
+        r["name"]
+        for r in storage.query("SELECT name FROM sqlite_master WHERE type='index'")
+    }
+    assert "idx_stale" not in names
+    assert {name for name, _t, _c in storage._INDEXES} <= names
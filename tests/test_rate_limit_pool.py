@@ -0,0 +1,82 @@
+import asyncio
+from types import SimpleNamespace
+
+from app.mw.rate_limit import RateLimitLLM
+
+
+class Message:
+    def __init__(self, uid: int, text: str):
+        self.text = text
+        self.from_user = SimpleNamespace(id=uid)
+
+
+def test_users_processed_in_parallel():
+    mw = RateLimitLLM(rate_seconds=0.01, workers=2)
+    calls = []
+
+    async def run():
+        gate = asyncio.Event()
+        b_done = asyncio.Event()
+
+        async def handler(event, data):
+            calls.append((event.from_user.id, event.text))
+            if event.from_user.id == 1:
+                await gate.wait()
+            else:
+                b_done.set()
+
+        await mw(handler, Message(1, "a1"), {})
+        await mw(handler, Message(2, "b1"), {})
+        # user 2 is served while user 1 is still inside the handler
+        await asyncio.wait_for(b_done.wait(), timeout=1)
+        assert mw.stats()["busy"] == 1
+        gate.set()
+        await asyncio.sleep(0.05)
+        await mw.shutdown()
+
+    asyncio.run(run())
+    assert calls == [(1, "a1"), (2, "b1")]
+
+
+def test_per_user_order_and_cooldown():
+    mw = RateLimitLLM(rate_seconds=0.05, workers=4)
+    seen = []
+
+    async def run():
+        loop = asyncio.get_running_loop()
+
+        async def handler(event, data):
+            seen.append((event.text, loop.time()))
+
+        for i in range(3):
+            await mw(handler, Message(7, f"m{i}"), {})
+        assert mw.stats()["queued"] >= 2
+        await asyncio.sleep(0.3)
+        stats = mw.stats()
+        await mw.shutdown()
+        return stats
+
+    stats = asyncio.run(run())
+    assert [t for t, _ in seen] == ["m0", "m1", "m2"]
+    gaps = [b - a for (_, a), (_, b) in zip(seen, seen[1:])]
+    assert all(g >= 0.045 for g in gaps)
+    assert stats["processed"] == 3
+    assert stats["queued"] == 0
+    assert stats["wait_max"] >= 0.045
+
+
+def test_commands_bypass_queue():
+    mw = RateLimitLLM(rate_seconds=1, workers=1)
+    calls = []
+
+    async def handler(event, data):
+        calls.append(event.text)
+        return "ok"
+
+    async def run():
+        res = await mw(handler, Message(1, "/start"), {})
+        await mw.shutdown()
+        return res
+
+    assert asyncio.run(run()) == "ok"
+    assert calls == ["/start"]
@@ -0,0 +1,84 @@
+import calendar
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from app import storage
+
+
+def _ts(text: str) -> int:
+    return calendar.timegm(time.strptime(text, "%Y-%m-%d %H:%M:%S"))
+
+
+def _settings(monkeypatch, **kw):
+    monkeypatch.setattr(storage, "settings", SimpleNamespace(storage=SimpleNamespace(**kw)))
+
+
+def test_token_log_is_rolled_into_monthly_totals(tmp_path: Path, monkeypatch):
+    _settings(monkeypatch, token_log_keep_days=30, log_keep_days=0, plan_keep_days=0)
+    storage.init(tmp_path / "db.sqlite")
+    storage.ensure_user(1, "u")
+    storage.add_paid_tokens(1, 100)
+    storage.spend_tokens(1, 30)
+    storage.add_paid_tokens(1, 5)
+    storage.spend_tokens(1, 2)
+    ids = [r[0] for r in storage.query("SELECT id FROM token_log ORDER BY id")]
+    for rid, ts in zip(ids, ("2024-01-05", "2024-01-20", "2024-02-01", "2099-01-01")):
+        storage._exec("UPDATE token_log SET created_at=? WHERE id=?", (_ts(f"{ts} 10:00:00"), rid))
+
+    # окно по 2 строки: голова целиком старая — будет ещё шаг
+    assert storage.retention_step(2) is True
+    assert storage.retention_step(2) is False
+    assert storage.retention_step(2) is False
+
+    assert storage.query("SELECT COUNT(*) FROM token_log")[0][0] == 1
+    months = [tuple(r) for r in storage.query("SELECT month, credit, debit, entries FROM token_log_monthly")]
+    assert months == [("2024-01", 100, -30, 2), ("2024-02", 5, 0, 1)]
+    log = storage.list_token_log(1, limit=3)
+    assert [(r["amount"], r["meta"]) for r in log] == [(-2, "spend_paid"), (5, "monthly"), (70, "monthly")]
+    # баланс не меняется
+    assert storage.get_user(1)["paid_tokens"] == 73
+
+
+def test_logs_and_finished_plans_are_pruned(tmp_path: Path, monkeypatch):
+    _settings(monkeypatch, log_keep_days=10, token_log_keep_days=0, plan_keep_days=1, write_behind_ms=0)
+    storage.init(tmp_path / "db.sqlite")
+    for i in range(5):
+        storage._exec(
+            "INSERT INTO proactive_log(user_id, chat_id, char_id, kind, sent_at) VALUES (1, 1, 1, 'free', ?)",
+            (_ts("2020-01-01 00:00:00" if i < 3 else "2099-01-01 00:00:00"),),
+        )
+        storage.log_broadcast_sent(i)
+    old = int(time.time()) - 3 * 86400
+    plans = [storage.insert_plan(1, 1, old) for _ in range(3)]
+    storage.mark_plan_sent(plans[0], old)
+    storage._exec("UPDATE proactive_plan SET status='SKIPPED' WHERE id=?", (plans[1],))
+
+    while storage.retention_step(2):
+        pass
+
+    assert storage.query("SELECT COUNT(*) FROM proactive_log")[0][0] == 2
+    assert storage.query("SELECT COUNT(*) FROM broadcast_log")[0][0] == 5
+    assert [r[0] for r in storage.query("SELECT id FROM proactive_plan")] == [plans[2]]
+
+
+def test_incremental_vacuum_shrinks_file(tmp_path: Path, monkeypatch):
+    _settings(monkeypatch, log_keep_days=1, token_log_keep_days=0, plan_keep_days=0, write_behind_ms=0)
+    db = tmp_path / "db.sqlite"
+    storage.init(db)
+    assert storage.query("PRAGMA auto_vacuum")[0][0] == 2
+    with storage._conn_lock, storage._conn:
+        storage._conn.executemany(
+            "INSERT INTO broadcast_log(user_id, status, note, created_at) VALUES (?, 'sent', ?, '2020-01-01')",
+            ((i, "x" * 200) for i in range(5000)),
+        )
+    storage._exec("PRAGMA wal_checkpoint(TRUNCATE)")
+    size = db.stat().st_size
+
+    while storage.retention_step(1000):
+        pass
+    assert storage.vacuum_step(100) == 100
+    assert storage.vacuum_step() > 0
+    assert storage.vacuum_step() == 0
+    storage._exec("PRAGMA wal_checkpoint(TRUNCATE)")
+    assert db.stat().st_size < size / 2
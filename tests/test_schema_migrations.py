@@ -0,0 +1,77 @@
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from app import storage
+
+
+def _traced_connect(monkeypatch, statements):
+    real = storage._connect
+
+    def connect(path, *, readonly=False):
+        conn = real(path, readonly=readonly)
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    monkeypatch.setattr(storage, "_connect", connect)
+
+
+def test_fresh_database_is_at_latest_version(tmp_path: Path):
+    storage.init(tmp_path / "db.sqlite")
+    r = storage._q("SELECT MAX(version) FROM schema_version").fetchone()
+    assert r[0] == len(storage._MIGRATIONS)
+
+
+def test_time_to_ready_on_large_database(tmp_path: Path, monkeypatch):
+    db = tmp_path / "db.sqlite"
+    storage.init(db)
+    with storage._conn_lock, storage._conn:
+        storage._conn.executemany(
+            "INSERT INTO users(tg_id, username, default_chat_mode) VALUES (?,?,'rp')",
+            ((10_000_000 + i, f"u{i}") for i in range(50_000)),
+        )
+        storage._conn.executemany(
+            "INSERT INTO chats(user_id, char_id) VALUES (?, 1)",
+            ((10_000_000 + i,) for i in range(50_000)),
+        )
+        storage._conn.executemany(
+            "INSERT INTO messages(chat_id, is_user, content) VALUES (?, 1, 'hello there')",
+            ((i % 50_000 + 1,) for i in range(50_000)),
+        )
+    storage.close()
+
+    statements: list[str] = []
+    _traced_connect(monkeypatch, statements)
+    t0 = time.perf_counter()
+    storage.init(db)
+    ready = time.perf_counter() - t0
+
+    writer = [s for s in statements if not s.startswith("PRAGMA")]
+    assert writer == ["SELECT MAX(version) FROM schema_version"]
+    print(f"time-to-ready {ready:.3f}s")  # замер для лога, не проверка: зависит от машины
+
+
+def test_pre_versioned_database_is_migrated_in_resumable_batches(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(
+        storage, "settings", SimpleNamespace(storage=SimpleNamespace(migrate_batch=2))
+    )
+    db = tmp_path / "db.sqlite"
+    storage.init(db)
+    for uid in range(1, 8):
+        storage.ensure_user(uid, f"u{uid}")
+    storage._exec("UPDATE users SET default_chat_mode='live'")
+    # база без версии, прошлый запуск упал после первых трёх пользователей
+    storage._exec("DROP TABLE schema_version")
+    storage._exec("INSERT INTO schema_backfill(name, cursor, upto) VALUES ('users.live_mode', 3, 7)")
+    storage.close()
+
+    statements: list[str] = []
+    _traced_connect(monkeypatch, statements)
+    storage.init(db)
+
+    modes = [r[0] for r in storage.query("SELECT default_chat_mode FROM users ORDER BY tg_id")]
+    assert modes == ["live"] * 3 + ["chat"] * 4
+    progress = [s for s in statements if s.startswith("UPDATE schema_backfill") and "users.live_mode" in s]
+    assert len(progress) == 2
+    assert storage.query("SELECT COUNT(*) FROM schema_backfill")[0][0] == 0
+    assert storage.query("SELECT MAX(version) FROM schema_version")[0][0] == len(storage._MIGRATIONS)
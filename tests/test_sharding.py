@@ -0,0 +1,164 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from app import storage
+
+
+def _settings(monkeypatch, shards: int, **kw):
+    kw.setdefault("write_behind_ms", 0)
+    monkeypatch.setattr(storage, "settings", SimpleNamespace(storage=SimpleNamespace(shards=shards, **kw)))
+
+
+def _count(path: Path, sql: str) -> int:
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute(sql).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_users_live_in_their_shard_file(tmp_path: Path, monkeypatch):
+    _settings(monkeypatch, 4)
+    db = tmp_path / "db.sqlite"
+    storage.init(db)
+    char_id = storage.ensure_character("Alice")
+    for uid in range(1, 41):
+        storage.ensure_user(uid, f"u{uid}")
+        chat_id = storage.create_chat(uid, char_id)
+        # id чата кодирует шард владельца
+        assert (chat_id - 1) % 4 == storage._user_shard(uid).index
+        storage.add_message(chat_id, is_user=True, content="hi", usage_in=1)
+        storage.add_paid_tokens(uid, 10)
+
+    files = [tmp_path / f"db.s{k}.sqlite" for k in range(4)]
+    per_file = [_count(f, "SELECT COUNT(*) FROM users") for f in files]
+    assert sum(per_file) == 40 and all(per_file)
+    for k, f in enumerate(files):
+        conn = sqlite3.connect(f)
+        for (uid,) in conn.execute("SELECT tg_id FROM users"):
+            assert storage._user_shard(uid).index == k
+        assert conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0] == per_file[k]
+        assert conn.execute("SELECT COUNT(*) FROM token_log").fetchone()[0] == per_file[k]
+        conn.close()
+    assert _count(db, "SELECT COUNT(*) FROM users") == 0
+    assert _count(db, "SELECT COUNT(*) FROM characters") == 1
+
+    # персонажи видны из шардов: join в user_totals и списках
+    chat = storage.get_last_chat(7)
+    assert chat["char_name"] == "Alice"
+    assert storage.get_chat(chat["id"])["char_name"] == "Alice"
+    assert storage.list_messages(chat["id"])[0]["content"] == "hi"
+    assert sum(r[0] for r in storage.query("SELECT COUNT(*) FROM users")) == 40  # по строке на шард
+    assert len(storage.select_proactive_candidates()) == 40
+
+
+def test_cross_shard_jobs_and_stats(tmp_path: Path, monkeypatch):
+    _settings(monkeypatch, 3)
+    storage.init(tmp_path / "db.sqlite")
+    alice = storage.ensure_character("Alice")
+    bob = storage.ensure_character("Bob")
+    for uid in range(1, 13):
+        storage.ensure_user(uid, f"u{uid}")
+        chat_id = storage.create_chat(uid, alice if uid % 2 else bob)
+        for _ in range(uid):
+            storage.add_message(chat_id, is_user=False, content="x", usage_in=1, usage_out=2)
+    storage._fan_out(lambda: storage._exec("UPDATE chats SET updated_at=1577836800"))
+
+    day = storage.usage_by_day(ttl=0)
+    assert len(day) == 1 and day[0]["out_tokens"] == 2 * sum(range(1, 13))
+    assert [r["user_id"] for r in storage.active_users(3, ttl=0)] == [12, 11, 10]
+    top = storage.top_characters(ttl=0)
+    assert top == [{"name": "Bob", "cnt": 42}, {"name": "Alice", "cnt": 36}]
+
+    assert len(storage.archive_idle_chats(max_age_days=30, limit=5)) == 5
+    assert len(storage.archive_idle_chats(max_age_days=30)) == 7
+    assert storage.list_messages(storage.get_last_chat(5)["id"])[-1]["content"] == "x"
+
+    now = int(time.time())
+    plans = [storage.insert_plan(uid, 1, now - uid) for uid in range(1, 13)]
+    assert len(set(plans)) == 12
+    due = storage.get_due_plans(now, limit=4)
+    assert [p["user_id"] for p in due] == [12, 11, 10, 9]
+
+    # копия — по файлу на шард; статистика читает реплики шардов
+    path = storage.backup()
+    assert len(list(path.parent.glob("db*.db"))) == 4
+    assert storage.snapshot_taken_at() is not None
+    assert storage.top_characters(ttl=0) == top
+
+
+def test_shard_count_is_fixed(tmp_path: Path, monkeypatch):
+    _settings(monkeypatch, 1)
+    storage.init(tmp_path / "db.sqlite")
+    storage.ensure_user(1, "u")
+    storage.close()
+    _settings(monkeypatch, 2)
+    with pytest.raises(RuntimeError, match="resharding"):
+        storage.init(tmp_path / "db.sqlite")
+
+    _settings(monkeypatch, 2)
+    storage.init(tmp_path / "other.sqlite")
+    storage.close()
+    _settings(monkeypatch, 3)
+    with pytest.raises(RuntimeError):
+        storage.init(tmp_path / "other.sqlite")
+
+
+def test_aio_writes_run_on_a_writer_per_shard(tmp_path: Path, monkeypatch):
+    _settings(monkeypatch, 2)
+    storage.init(tmp_path / "db.sqlite")
+    seen: dict[int, set[str]] = {}
+    real = storage.add_toki
+
+    def spy(user_id, amount):
+        seen.setdefault(storage._cur().index, set()).add(threading.current_thread().name)
+        return real(user_id, amount)
+
+    spy.shard_of = real.shard_of
+    monkeypatch.setattr(storage, "add_toki", spy)
+    for uid in range(1, 11):
+        storage.ensure_user(uid, "u")
+
+    async def run():
+        await asyncio.gather(*(storage.aio.add_toki(uid, 1) for uid in range(1, 11)))
+        return await storage.aio.ensure_character("Carol")
+
+    assert asyncio.run(run())
+    assert seen == {0: {"storage-writer-0"}, 1: {"storage-writer-1"}}
+
+
+def _write_rate(tmp_path: Path, monkeypatch, shards: int) -> float:
+    _settings(monkeypatch, shards)
+    storage.init(tmp_path / f"bench{shards}.sqlite")
+    char_id = storage.ensure_character("Alice")
+    chats = []
+    for uid in range(1, 9):
+        storage.ensure_user(uid, "u")
+        chats.append(storage.create_chat(uid, char_id))
+
+    def one(chat_id):
+        for _ in range(200):
+            storage.add_message(chat_id, is_user=True, content="hello " * 20, usage_in=1, usage_out=1)
+
+    threads = [threading.Thread(target=one, args=(c,)) for c in chats]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    rate = len(chats) * 200 / (time.perf_counter() - t0)
+    storage.close()
+    return rate
+
+
+def test_write_throughput_scales_with_shards(tmp_path: Path, monkeypatch):
+    rates = {n: _write_rate(tmp_path, monkeypatch, n) for n in (1, 4)}
+    print(f"add_message/s: 1 shard {rates[1]:.0f}, 4 shards {rates[4]:.0f}")
+    # нестрого: на CI время шумное, важно, что шарды не упираются в один писатель
+    assert rates[4] > rates[1] * 0.9
@@ -0,0 +1,192 @@
+import asyncio
+import sqlite3
+import statistics
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from app import storage
+
+
+def _settings(monkeypatch, split: bool = True, **kw):
+    kw.setdefault("write_behind_ms", 0)
+    monkeypatch.setattr(
+        storage, "settings", SimpleNamespace(storage=SimpleNamespace(split_history=split, **kw))
+    )
+
+
+def _tables(path: Path) -> set[str]:
+    conn = sqlite3.connect(path)
+    try:
+        return {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    finally:
+        conn.close()
+
+
+def _chat(n: int = 4):
+    storage.ensure_user(1, "u")
+    char_id = storage.ensure_character("Alice")
+    chat_id = storage.create_chat(1, char_id)
+    for i in range(n):
+        storage.add_message(chat_id, is_user=i % 2 == 0, content=f"pizza line {i}", usage_in=1, usage_out=2)
+    return char_id, chat_id
+
+
+def test_history_lives_in_its_own_file(tmp_path: Path, monkeypatch):
+    _settings(monkeypatch)
+    db = tmp_path / "db.sqlite"
+    storage.init(db)
+    char_id, chat_id = _chat()
+
+    assert "messages" not in _tables(db)
+    conn = sqlite3.connect(tmp_path / "db.history.sqlite")
+    assert conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0] == 4
+    assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0
+    conn.close()
+
+    storage.drop_tail()
+    assert [m["content"] for m in storage.list_messages(chat_id)][-1] == "pizza line 3"
+    assert len(storage.search_messages(chat_id, "pizza")) == 4
+    assert storage.last_message_ts(chat_id) is not None
+    # сводные запросы основного файла видят историю через ATTACH
+    assert storage.query("SELECT COUNT(*) FROM messages")[0][0] == 4
+    storage.rebuild_user_char_stats(1)
+    assert storage.get_user_char_stats(1, char_id)["message_count"] == 4
+    assert storage.user_totals(1)["ai_msgs"] == 2
+
+    storage.compress_history(chat_id, "summary")
+    assert storage.latest_checkpoint(chat_id)["summary"] == "summary"
+    assert storage.query("SELECT COUNT(*) FROM chat_checkpoints")[0][0] == 1
+    assert "chat_checkpoints" not in _tables(db)
+    assert storage.list_messages(chat_id, after_id=storage.latest_checkpoint(chat_id)["upto_message_id"]) == []
+
+    assert storage.archive_chat(chat_id)
+    assert storage.query("SELECT COUNT(*) FROM chat_archive")[0][0] == 1
+    assert storage.export_chat_txt(chat_id).splitlines()[-1] == "[Alice] pizza line 3"
+    assert storage.delete_chat(chat_id, 1)
+    assert storage.query("SELECT COUNT(*) FROM messages")[0][0] == 0
+    assert storage.latest_checkpoint(chat_id) is None
+    assert storage.user_totals(1)["chats"] == 0
+
+
+def test_existing_history_is_moved(tmp_path: Path, monkeypatch):
+    db = tmp_path / "db.sqlite"
+    _settings(monkeypatch, split=False)
+    storage.init(db)
+    _, chat_id = _chat(3)
+    storage.close()
+
+    _settings(monkeypatch)
+    storage.init(db)
+    assert "messages" not in _tables(db)
+    assert len(storage.list_messages(chat_id)) == 3
+    assert len(storage.search_messages(chat_id, "pizza")) == 3
+    storage.close()
+
+    _settings(monkeypatch, split=False)
+    with pytest.raises(RuntimeError, match="split_history"):
+        storage.init(db)
+
+
+def test_failed_bookkeeping_removes_the_message(tmp_path: Path, monkeypatch):
+    _settings(monkeypatch)
+    storage.init(tmp_path / "db.sqlite")
+    _, chat_id = _chat(1)
+
+    def boom(*args, **kwargs):
+        raise sqlite3.IntegrityError("fail")
+
+    monkeypatch.setattr(storage, "_count_message", boom)
+    with pytest.raises(sqlite3.IntegrityError):
+        storage.add_message(chat_id, is_user=True, content="lost")
+    storage.drop_tail()
+    assert [m["content"] for m in storage.list_messages(chat_id)] == ["pizza line 0"]
+
+
+def test_aio_history_writes_use_their_own_writer(tmp_path: Path, monkeypatch):
+    _settings(monkeypatch)
+    storage.init(tmp_path / "db.sqlite")
+    _, chat_id = _chat(0)
+    storage.add_paid_tokens(1, 10)
+    seen: dict[str, str] = {}
+    for name in ("add_message", "spend_tokens"):
+        real = getattr(storage, name)
+
+        def spy(*args, _real=real, _name=name, **kwargs):
+            seen[_name] = threading.current_thread().name
+            return _real(*args, **kwargs)
+
+        monkeypatch.setattr(storage, name, spy)
+
+    async def run():
+        await storage.aio.add_message(chat_id, is_user=True, content="hi")
+        await storage.aio.spend_tokens(1, 1)
+
+    asyncio.run(run())
+    assert seen == {"add_message": "storage-history", "spend_tokens": "storage-writer"}
+
+
+def test_compress_does_not_wait_for_the_main_file(tmp_path: Path, monkeypatch):
+    _settings(monkeypatch)
+    storage.init(tmp_path / "db.sqlite")
+    _, chat_id = _chat()
+    done = threading.Event()
+
+    def compress():
+        storage.compress_history(chat_id, "summary")
+        done.set()
+
+    with storage._shared.lock:  # основной файл занят биллингом
+        th = threading.Thread(target=compress)
+        th.start()
+        assert done.wait(5)
+    th.join()
+    assert storage.latest_checkpoint(chat_id)["summary"] == "summary"
+
+
+def _billing_latency(tmp_path: Path, monkeypatch, split: bool) -> float:
+    _settings(monkeypatch, split)
+    storage.init(tmp_path / f"bench{int(split)}.sqlite")
+    char_id = storage.ensure_character("Alice")
+    chats = []
+    for uid in range(1, 17):
+        storage.ensure_user(uid, "u")
+        chats.append(storage.create_chat(uid, char_id))
+    storage.add_paid_tokens(1, 10**6)
+
+    async def run():
+        stop = asyncio.Event()
+        lat: list[float] = []
+
+        async def chat(chat_id):
+            i = 0
+            while not stop.is_set():
+                i += 1
+                await storage.aio.add_message(chat_id, is_user=i % 2 == 0, content="слово " * 400, usage_in=10)
+                if i % 40 == 0:
+                    await storage.aio.compress_history(chat_id, "summary")
+
+        async def bill():
+            for _ in range(60):
+                t0 = time.perf_counter()
+                await storage.aio.spend_tokens(1, 1)
+                lat.append(time.perf_counter() - t0)
+                await asyncio.sleep(0.005)
+            stop.set()
+
+        await asyncio.gather(bill(), *(chat(c) for c in chats))
+        return lat
+
+    lat = asyncio.run(run())
+    storage.close()
+    return statistics.median(lat)
+
+
+def test_billing_latency_under_chat_load(tmp_path: Path, monkeypatch):
+    shared = _billing_latency(tmp_path, monkeypatch, split=False)
+    split = _billing_latency(tmp_path, monkeypatch, split=True)
+    print(f"spend_tokens median under chat load: one file {shared * 1000:.1f} ms, split {split * 1000:.1f} ms")
+    assert split < shared
@@ -0,0 +1,85 @@
+import asyncio
+import threading
+import time
+from pathlib import Path
+
+from app import storage
+
+_SLOW_SQL = (
+    "WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n WHERE x < ?) "
+    "SELECT sum(x) FROM n"
+)
+
+
+def test_aio_roundtrip(tmp_path: Path):
+    storage.init(tmp_path / "db.sqlite")
+
+    async def run():
+        await storage.aio.ensure_user(1, "u")
+        await storage.aio.add_toki(1, 5)
+        return await storage.aio.get_user(1)
+
+    u = asyncio.run(run())
+    assert u["username"] == "u"
+    assert int(u["free_toki"]) >= 5
+
+
+def test_aio_writes_on_single_thread_reads_elsewhere(tmp_path: Path, monkeypatch):
+    storage.init(tmp_path / "db.sqlite")
+    seen: dict[str, set[str]] = {"read": set(), "write": set()}
+
+    def fake_get_user(uid):
+        seen["read"].add(threading.current_thread().name)
+        return {"id": uid}
+
+    def fake_touch(uid):
+        seen["write"].add(threading.current_thread().name)
+
+    monkeypatch.setattr(storage, "get_user", fake_get_user)
+    monkeypatch.setattr(storage, "touch_activity", fake_touch)
+
+    async def run():
+        await asyncio.gather(
+            *(storage.aio.touch_activity(i) for i in range(20)),
+            *(storage.aio.get_user(i) for i in range(20)),
+        )
+
+    asyncio.run(run())
+    assert len(seen["write"]) == 1
+    assert seen["write"].isdisjoint(seen["read"])
+    assert threading.main_thread().name not in seen["read"] | seen["write"]
+
+
+def test_aio_keeps_event_loop_responsive(tmp_path: Path):
+    storage.init(tmp_path / "db.sqlite")
+
+    n = 200_000
+    while True:
+        t0 = time.perf_counter()
+        storage.query(_SLOW_SQL, (n,))
+        slow = time.perf_counter() - t0
+        if slow >= 0.3 or n >= 50_000_000:
+            break
+        n *= 4
+
+    async def run():
+        stop = asyncio.Event()
+        gaps = []
+
+        async def ticker():
+            last = time.perf_counter()
+            while not stop.is_set():
+                await asyncio.sleep(0.005)
+                now = time.perf_counter()
+                gaps.append(now - last)
+                last = now
+
+        task = asyncio.create_task(ticker())
+        await storage.aio.query(_SLOW_SQL, (n,))
+        stop.set()
+        await task
+        return gaps
+
+    gaps = asyncio.run(run())
+    assert gaps
+    assert max(gaps) < slow / 3
@@ -48,6 +48,7 @@ def test_chatting_text_strips_markers_rp(monkeypatch):
             text = "ok"
             usage_in = usage_out = 0
             deficit = 0
+            message_id = 0
         return R()
 
     monkeypatch.setattr(chats_module, "chat_turn", fake_chat_turn)
@@ -94,6 +95,7 @@ def test_chatting_text_preserves_embedded_markers_rp(monkeypatch):
             text = "ok"
             usage_in = usage_out = 0
             deficit = 0
+            message_id = 0
         return R()
 
     monkeypatch.setattr(chats_module, "chat_turn", fake_chat_turn)
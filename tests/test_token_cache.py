@@ -36,6 +36,9 @@ def test_chat_turn_no_tokens_returns_warning(monkeypatch):
         def get_cached_tokens(self, chat_id):
             return 0
 
+        def reserve(self, user_id, estimate):
+            return None
+
     storage = DummyStorage()
     monkeypatch.setattr(chats_module, "storage", storage)
     monkeypatch.setattr(chats_module, "settings", _fake_settings())
@@ -66,12 +69,14 @@ def test_chat_turn_uses_cached_tokens(monkeypatch):
         def get_cached_tokens(self, chat_id):
             return 10
 
-        def set_cached_tokens(self, chat_id, amount):
-            self.cached = amount
+        def reserve(self, user_id, estimate):
+            return 7
 
-        def spend_tokens(self, user_id, amount):
-            self.spent = amount
-            return (0, 0, 0)
+        def turn_commit(self, chat_id, content, *, usage_in, usage_out, billed, reservation, model):
+            assert reservation == 7
+            self.spent = billed
+            self.cached = usage_in + usage_out
+            return (11, 0)
 
         def list_messages(self, chat_id, limit=50):
             return []
@@ -105,6 +110,7 @@ def test_chat_turn_uses_cached_tokens(monkeypatch):
     r = asyncio.run(chats_module.chat_turn(1, 1, "hello"))
 
     assert r.text == "hi"
+    assert r.message_id == 11
     assert storage.cached == 50  # 20 + 30
     assert storage.spent == 40  # delta 40 billed
 
@@ -120,6 +126,9 @@ def test_live_stream_no_tokens(monkeypatch):
         def get_cached_tokens(self, chat_id):
             return 0
 
+        def reserve(self, user_id, estimate):
+            return None
+
     storage = DummyStorage()
     monkeypatch.setattr(chats_module, "storage", storage)
     monkeypatch.setattr(chats_module, "settings", _fake_settings())
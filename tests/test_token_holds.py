@@ -0,0 +1,199 @@
+import asyncio
+import threading
+import types
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from app import storage
+from app.domain import chats as chats_module
+
+
+def _settings(monkeypatch, **kw):
+    kw.setdefault("write_behind_ms", 0)
+    monkeypatch.setattr(storage, "settings", SimpleNamespace(storage=SimpleNamespace(**kw)))
+
+
+def _balance(user_id: int) -> int:
+    u = storage.get_user(user_id) or {}
+    return int(u.get("free_toki") or 0) + int(u.get("paid_tokens") or 0)
+
+
+def test_holds_limit_what_other_turns_can_take(tmp_path: Path, monkeypatch):
+    _settings(monkeypatch)
+    storage.init(tmp_path / "db.sqlite")
+    storage.ensure_user(1, "u")
+    storage.add_toki(1, 30)
+    storage.add_paid_tokens(1, 70)
+
+    a = storage.reserve(1, 60)
+    b = storage.reserve(1, 60)  # свободно только 40
+    assert a and b
+    assert storage.reserve(1, 1) is None
+    assert _balance(1) == 100  # резерв баланс не меняет
+
+    assert storage.release(b)
+    assert not storage.release(b)
+    # ход дороже резерва берёт только не занятое другими
+    c = storage.reserve(1, 10)
+    assert storage.settle(a, 95) == (30, 60, 5)
+    assert storage.settle(a, 95) == (0, 0, 0)  # повторно не списывается
+    assert _balance(1) == 10
+    assert storage.settle(c, 4) == (0, 4, 0)
+    log = storage.list_token_log(1, limit=3)
+    assert [(r["amount"], r["meta"]) for r in log] == [(-4, "spend_paid"), (-60, "spend_paid"), (-30, "spend_free")]
+
+
+def test_holds_of_a_crashed_process_expire(tmp_path: Path, monkeypatch):
+    _settings(monkeypatch, hold_ttl_s=0)
+    storage.init(tmp_path / "db.sqlite")
+    storage.ensure_user(1, "u")
+    storage.add_paid_tokens(1, 10)
+    assert storage.reserve(1, 10)
+    assert storage.reserve(1, 10)  # прошлый уже истёк
+    assert storage.query("SELECT COUNT(*) FROM token_holds")[0][0] == 1
+    storage.retention_step()
+    assert storage.query("SELECT COUNT(*) FROM token_holds")[0][0] == 0
+
+
+@pytest.mark.parametrize("shards", [1, 2])
+def test_concurrent_turns_never_double_spend(tmp_path: Path, monkeypatch, shards):
+    _settings(monkeypatch, shards=shards)
+    storage.init(tmp_path / "db.sqlite")
+    for uid in (1, 2):
+        storage.ensure_user(uid, "u")
+        storage.add_toki(uid, 300)
+        storage.add_paid_tokens(uid, 700)
+
+    settled: list[tuple[int, int, int]] = []
+    rejected = threading.Event()
+    lock = threading.Lock()
+
+    def turns(uid: int, n: int):
+        i = 0
+        while True:
+            hold = storage.reserve(uid, 10)
+            if hold is None:
+                rejected.set()
+                return
+            i += 1
+            if i % 3 == n % 3:  # ошибка провайдера — резерв снимается
+                storage.release(hold)
+                continue
+            spent = storage.settle(hold, 10)
+            with lock:
+                settled.append(spent)
+            assert storage.settle(hold, 10) == (0, 0, 0)
+
+    threads = [threading.Thread(target=turns, args=(1 + k % 2, k)) for k in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert rejected.is_set()
+    # каждый начатый ход оплачен целиком, и ходов ровно на баланс
+    assert len(settled) == 200
+    assert all(s[2] == 0 and s[0] + s[1] == 10 for s in settled)
+    for uid in (1, 2):
+        assert _balance(uid) == 0
+        assert sum(r[0] or 0 for r in storage.query("SELECT SUM(amount) FROM token_log WHERE user_id=?", (uid,))) == 0
+    assert sum(r[0] for r in storage.query("SELECT COUNT(*) FROM token_holds")) == 0
+
+
+@pytest.mark.parametrize("shards", [1, 2])
+def test_direct_spends_leave_holds_alone(tmp_path: Path, monkeypatch, shards):
+    # списания без резерва (сводка, платный нудж) идут параллельно с ходами
+    _settings(monkeypatch, shards=shards)
+    storage.init(tmp_path / "db.sqlite")
+    storage.ensure_user(1, "u")
+    storage.add_toki(1, 300)
+    storage.add_paid_tokens(1, 700)
+
+    settled: list[tuple[int, int, int]] = []
+    spent: list[tuple[int, int, int]] = []
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def turns():
+        while True:
+            hold = storage.reserve(1, 10)
+            if hold is None:
+                return
+            s = storage.settle(hold, 10)
+            with lock:
+                settled.append(s)
+
+    def spends():
+        while not done.is_set():
+            s = storage.spend_tokens(1, 10)  # кратно резерву: частичных резервов нет
+            with lock:
+                spent.append(s)
+            if s[2]:
+                return
+
+    threads = [threading.Thread(target=turns) for _ in range(4)]
+    threads += [threading.Thread(target=spends) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads[:4]:
+        t.join()
+    done.set()
+    for t in threads[4:]:
+        t.join()
+
+    # резерв хода списывается целиком: прямое списание его не съело
+    assert settled and all(s[2] == 0 and s[0] + s[1] == 10 for s in settled)
+    taken = sum(s[0] + s[1] for s in settled + spent)
+    assert taken + _balance(1) == 1000
+    assert _balance(1) >= 0
+    assert storage.query("SELECT COUNT(*) FROM token_holds")[0][0] == 0
+
+
+def test_parallel_chat_turns_are_limited_by_the_balance(tmp_path: Path, monkeypatch):
+    _settings(monkeypatch)
+    storage.init(tmp_path / "db.sqlite")
+    storage.ensure_user(1, "u")
+    char_id = storage.ensure_character("Alice")
+    chat_id = storage.create_chat(1, char_id)
+    storage.add_paid_tokens(1, 100)
+
+    monkeypatch.setattr(
+        chats_module,
+        "settings",
+        types.SimpleNamespace(
+            default_model="m",
+            toki_spend_coeff=1,
+            limits=types.SimpleNamespace(
+                request_timeout_seconds=30, context_threshold_tokens=0, auto_compress_default=False
+            ),
+        ),
+    )
+    monkeypatch.setattr(chats_module, "usage_to_toki", lambda model, i, o, cached=0: 25)
+    calls = []
+
+    async def fake_provider_chat(**kwargs):
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return types.SimpleNamespace(text="hi", usage_in=1, usage_out=1)
+
+    async def _collect(*args, **kwargs):
+        return []
+
+    async def _noop(*args, **kwargs):
+        return None
+
+    monkeypatch.setattr(chats_module, "provider_chat", fake_provider_chat)
+    monkeypatch.setattr(chats_module, "_collect_context", _collect)
+    monkeypatch.setattr(chats_module, "_maybe_compress_history", _noop)
+
+    async def run():
+        return await asyncio.gather(*(chats_module.chat_turn(1, chat_id, "hi") for _ in range(10)))
+
+    replies = asyncio.run(run())
+    # прежняя проверка по get_user пустила бы к модели все десять ходов
+    assert len(calls) == 4
+    assert sum(r.billed for r in replies) == 100
+    assert sum(r.deficit for r in replies if r.billed) == 0
+    assert _balance(1) == 0
@@ -0,0 +1,100 @@
+import sqlite3
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from app import storage
+
+
+def _settings(monkeypatch, **kw):
+    kw.setdefault("write_behind_ms", 0)
+    monkeypatch.setattr(storage, "settings", SimpleNamespace(storage=SimpleNamespace(**kw)))
+
+
+def _turn(tmp_path: Path, balance: int = 100):
+    storage.init(tmp_path / "db.sqlite")
+    storage.ensure_user(1, "u")
+    char_id = storage.ensure_character("Alice")
+    chat_id = storage.create_chat(1, char_id)
+    storage.add_paid_tokens(1, balance)
+    storage.add_message(chat_id, is_user=True, content="hi")
+    storage.set_user_chatting(1, True)
+    return chat_id, storage.reserve(1, 30)
+
+
+def _state(chat_id: int) -> dict:
+    u = storage.get_user(1)
+    return {
+        "paid": u["paid_tokens"],
+        "chatting": u["is_chatting"],
+        "cached": storage.get_cached_tokens(chat_id),
+        "msgs": [m["content"] for m in storage.list_messages(chat_id)],
+        "holds": storage.query("SELECT COUNT(*) FROM token_holds")[0][0],
+        "log": len(storage.list_token_log(1, limit=50)),
+    }
+
+
+def test_turn_is_one_transaction(tmp_path: Path, monkeypatch):
+    _settings(monkeypatch)
+    chat_id, hold = _turn(tmp_path)
+    statements: list[str] = []
+    storage._conn.set_trace_callback(statements.append)
+    try:
+        msg_id, deficit = storage.turn_commit(
+            chat_id, "pizza reply", usage_in=10, usage_out=15, billed=25, reservation=hold, model="m"
+        )
+    finally:
+        storage._conn.set_trace_callback(None)
+
+    assert [s for s in statements if s.split()[0].upper() in {"BEGIN", "COMMIT"}] == ["BEGIN", "COMMIT"]
+    assert msg_id and deficit == 0
+    assert _state(chat_id) == {
+        "paid": 75, "chatting": 0, "cached": 25, "msgs": ["hi", "pizza reply"], "holds": 0, "log": 2,
+    }
+    assert storage.get_chat(chat_id)["updated_at"]
+    assert [m["id"] for m in storage.search_messages(chat_id, "pizza")] == [msg_id]
+    storage.drop_tail()
+    storage.invalidate_chat()
+    assert storage.get_cached_tokens(chat_id) == 25
+    assert storage.list_messages(chat_id)[-1]["usage_out"] == 15
+    assert storage.user_totals(1)["ai_msgs"] == 1
+
+
+def test_failed_turn_changes_nothing(tmp_path: Path, monkeypatch):
+    _settings(monkeypatch)
+    chat_id, hold = _turn(tmp_path)
+    before = _state(chat_id)
+
+    def boom(*args, **kwargs):
+        raise sqlite3.IntegrityError("fail")
+
+    monkeypatch.setattr(storage, "_count_message", boom)
+    with pytest.raises(sqlite3.IntegrityError):
+        storage.turn_commit(chat_id, "lost", usage_in=1, usage_out=1, billed=5, reservation=hold)
+    storage.drop_tail()
+    assert _state(chat_id) == before
+    monkeypatch.undo()
+    _settings(monkeypatch)
+    # резерв цел — ход можно зафиксировать ещё раз
+    assert storage.turn_commit(chat_id, "ok", billed=5, reservation=hold)[1] == 0
+    assert storage.get_user(1)["paid_tokens"] == 95
+
+
+def test_unpaid_reply_is_not_stored(tmp_path: Path, monkeypatch):
+    _settings(monkeypatch)
+    chat_id, hold = _turn(tmp_path, balance=10)
+    msg_id, deficit = storage.turn_commit(chat_id, "too long", usage_in=1, usage_out=1, billed=25, reservation=hold)
+    assert (msg_id, deficit) == (0, 15)
+    state = _state(chat_id)
+    assert (state["paid"], state["msgs"], state["cached"], state["chatting"]) == (0, ["hi"], 0, 0)
+
+
+def test_turn_with_history_file(tmp_path: Path, monkeypatch):
+    _settings(monkeypatch, split_history=True)
+    chat_id, hold = _turn(tmp_path)
+    msg_id, _ = storage.turn_commit(chat_id, "split reply", billed=3, reservation=hold)
+    conn = sqlite3.connect(tmp_path / "db.history.sqlite")
+    assert conn.execute("SELECT content FROM messages WHERE id=?", (msg_id,)).fetchone()[0] == "split reply"
+    conn.close()
+    assert storage.get_user(1)["paid_tokens"] == 97
@@ -0,0 +1,77 @@
+from pathlib import Path
+
+from app import storage
+
+
+def _trace(statements):
+    for c in [storage._conn, *storage._reader_conns]:
+        c.set_trace_callback(statements.append)
+
+
+def _setup(tmp_path: Path):
+    storage.init(tmp_path / "db.sqlite")
+    storage.ensure_user(1, "alice")
+    storage.ensure_user(2, "bob")
+    storage.set_user_field(2, "default_model", "deepseek-chat")
+    a = storage.ensure_character("A")
+    b = storage.ensure_character("B")
+    c1 = storage.create_chat(1, a)
+    c2 = storage.create_chat(2, b)
+    storage.add_message(c1, is_user=True, content="hi")
+    storage.add_message(c1, is_user=False, content="yo", usage_in=10, usage_out=5)
+    storage.add_message(c2, is_user=True, content="hi")
+    storage.add_message(c2, is_user=False, content="yo", usage_in=7, usage_out=3, model="gpt-4o")
+    storage.add_message(c2, is_user=False, content="yo", usage_in=1, usage_out=1)
+    return c1, c2
+
+
+def test_stats_read_rollup_only(tmp_path: Path):
+    c1, c2 = _setup(tmp_path)
+    statements: list[str] = []
+    _trace(statements)
+    days = storage.usage_by_day(ttl=0)
+    weeks = storage.usage_by_week(ttl=0)
+    top = storage.top_characters(ttl=0)
+    act = storage.active_users(ttl=0)
+    totals = storage.user_totals(2)
+    assert not any("messages" in s for s in statements)
+
+    assert [(d["in_tokens"], d["out_tokens"]) for d in days] == [(18, 9)]
+    assert [(w["in_tokens"], w["out_tokens"]) for w in weeks] == [(18, 9)]
+    assert [(r["name"], r["cnt"]) for r in top] == [("B", 2), ("A", 1)]
+    assert [(r["username"], r["cnt"]) for r in act] == [("bob", 3), ("alice", 2)]
+    assert totals == dict(
+        user_msgs=1, ai_msgs=2, in_tokens=8, out_tokens=4, chats=1, top_character="B", top_count=2
+    )
+    models = {
+        r["model"]: r["ai_msgs"]
+        for r in storage.query("SELECT model, ai_msgs FROM usage_daily WHERE user_id=2")
+    }
+    assert models == {"deepseek-chat": 1, "gpt-4o": 1}
+
+
+def test_history_cleanup_keeps_usage(tmp_path: Path):
+    c1, _ = _setup(tmp_path)
+    storage.compress_history(c1, "summary", usage_in=2, usage_out=1)
+    storage.delete_chat(c1, 1)
+    # статистика расхода остаётся, профиль считает только существующие чаты
+    assert [(d["in_tokens"], d["out_tokens"]) for d in storage.usage_by_day(ttl=0)] == [(18, 9)]
+    assert storage.user_totals(1) == dict(
+        user_msgs=0, ai_msgs=0, in_tokens=0, out_tokens=0, chats=0, top_character=None, top_count=0
+    )
+
+
+def test_migration_builds_rollup_from_history(tmp_path: Path):
+    db = tmp_path / "db.sqlite"
+    _setup(tmp_path)
+    storage._exec("DROP TABLE usage_daily")
+    storage._exec("DELETE FROM schema_version WHERE version >= 4")
+    storage.close()
+
+    storage.init(db)
+    assert storage.user_totals(1) == dict(
+        user_msgs=1, ai_msgs=1, in_tokens=10, out_tokens=5, chats=1, top_character="A", top_count=1
+    )
+    assert storage.user_totals(2)["ai_msgs"] == 2
+    rows = storage.query("SELECT DISTINCT model FROM usage_daily WHERE user_id=2")
+    assert [r[0] for r in rows] == ["deepseek-chat"]
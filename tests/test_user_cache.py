@@ -0,0 +1,79 @@
+from pathlib import Path
+from types import SimpleNamespace
+
+from app import storage
+
+
+def _count_user_reads(statements):
+    return sum(1 for s in statements if s.startswith("SELECT * FROM users"))
+
+
+def _trace(statements):
+    for c in [storage._conn, *storage._reader_conns]:
+        c.set_trace_callback(statements.append)
+
+
+def test_repeated_get_user_reads_once(tmp_path: Path):
+    storage.init(tmp_path / "db.sqlite")
+    storage.ensure_user(1, "u")
+    statements: list[str] = []
+    _trace(statements)
+    before = storage.user_cache_stats()
+    for _ in range(5):
+        assert storage.get_user(1)["username"] == "u"
+    after = storage.user_cache_stats()
+    assert _count_user_reads(statements) == 1
+    assert after["misses"] - before["misses"] == 1
+    assert after["hits"] - before["hits"] == 4
+
+
+def test_writes_refresh_cached_row(tmp_path: Path):
+    storage.init(tmp_path / "db.sqlite")
+    storage.ensure_user(1, "u")
+    assert storage.get_user(1)["subscription"] == "free"
+
+    storage.set_user_field(1, "subscription", "pro")
+    assert storage.get_user(1)["subscription"] == "pro"
+
+    storage.add_toki(1, 10)
+    storage.add_paid_tokens(1, 5)
+    u = storage.get_user(1)
+    assert (u["free_toki"], u["paid_tokens"]) == (10, 5)
+
+    storage.spend_tokens(1, 12)
+    u = storage.get_user(1)
+    assert (u["free_toki"], u["paid_tokens"]) == (0, 3)
+
+    storage.set_user_field(1, "sub_end", "2000-01-01 00:00:00")
+    storage.get_user(1)
+    assert storage.expire_subscriptions() == [1]
+    assert storage.get_user(1)["subscription"] == "free"
+
+    storage.set_user_chatting(1, True)
+    assert storage.get_user(1)["is_chatting"] == 1
+
+
+def test_returned_rows_are_copies(tmp_path: Path):
+    storage.init(tmp_path / "db.sqlite")
+    storage.ensure_user(1, "u")
+    storage.get_user(1)["username"] = "mutated"
+    assert storage.get_user(1)["username"] == "u"
+
+
+def test_lru_bound_and_ttl(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(
+        storage,
+        "settings",
+        SimpleNamespace(storage=SimpleNamespace(user_cache_size=2, user_cache_ttl_s=0)),
+    )
+    storage.init(tmp_path / "db.sqlite")
+    for uid in (1, 2, 3):
+        storage.ensure_user(uid, f"u{uid}")
+        storage.get_user(uid)
+    assert storage.user_cache_stats()["size"] == 2
+
+    # ttl=0: every lookup goes to the database
+    before = storage.user_cache_stats()["misses"]
+    storage.get_user(3)
+    storage.get_user(3)
+    assert storage.user_cache_stats()["misses"] - before == 2
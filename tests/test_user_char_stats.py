@@ -0,0 +1,98 @@
+import random
+from pathlib import Path
+
+from app import storage
+
+# каталог до появления user_char_stats — эталон порядка
+_OLD_CATALOG = """
+    SELECT c.id
+      FROM characters c
+      LEFT JOIN fav_chars f ON f.char_id=c.id AND f.user_id=?
+      LEFT JOIN chats ch ON ch.char_id=c.id AND ch.user_id=?
+     GROUP BY c.id
+     ORDER BY CASE WHEN f.user_id IS NULL THEN 0 ELSE 1 END DESC,
+              COALESCE(MAX(ch.updated_at), 0) DESC, c.id DESC
+"""
+
+
+def _populate(seed: int = 7):
+    rnd = random.Random(seed)
+    for uid in (1, 2):
+        storage.ensure_user(uid, f"u{uid}")
+    chars = [storage.ensure_character(f"C{i}") for i in range(30)]
+    chats = []
+    for n in range(40):
+        uid = rnd.choice((1, 2))
+        chat = storage.create_chat(uid, rnd.choice(chars))
+        # разные updated_at, чтобы порядок не зависел от секунд
+        storage._exec("UPDATE chats SET updated_at=? WHERE id=?", (1704067200 + n, chat))
+        chats.append((uid, chat))
+    for uid, chat in rnd.sample(chats, 10):
+        storage.add_message(chat, is_user=True, content="hi")
+    for char_id in rnd.sample(chars, 6):
+        storage.toggle_fav_char(1, char_id)
+    return chars, chats
+
+
+def _catalog(uid: int, page_size: int):
+    ids, page = [], 1
+    while True:
+        rows = storage.list_characters_for_user(uid, page=page, page_size=page_size)
+        ids += [r["id"] for r in rows]
+        if len(rows) < page_size:
+            return ids
+        page += 1
+
+
+def test_catalog_order_matches_previous_query(tmp_path: Path):
+    storage.init(tmp_path / "db.sqlite")
+    _populate()
+    # last_use в сводке = MAX(updated_at) чатов, как считал старый запрос
+    storage._exec("DELETE FROM user_char_stats")
+    storage.rebuild_user_char_stats()
+    for uid in (1, 2, 3):
+        expected = [r[0] for r in storage.query(_OLD_CATALOG, (uid, uid))]
+        for size in (1, 4, 7, 100):
+            assert _catalog(uid, size) == expected
+
+
+def test_write_paths_keep_stats(tmp_path: Path):
+    storage.init(tmp_path / "db.sqlite")
+    storage.ensure_user(1, "u")
+    char_id = storage.ensure_character("A")
+    assert storage.get_user_char_stats(1, char_id)["chat_count"] == 0
+
+    c1 = storage.create_chat(1, char_id)
+    c2 = storage.create_chat(1, char_id)
+    for chat in (c1, c1, c2):
+        storage.add_message(chat, is_user=True, content="hi")
+    storage.toggle_fav_char(1, char_id)
+    st = storage.get_user_char_stats(1, char_id)
+    assert (st["chat_count"], st["message_count"], st["is_fav"]) == (2, 3, 1)
+    assert st["last_use"]
+
+    storage.compress_history(c1, "summary")
+    assert storage.get_user_char_stats(1, char_id)["message_count"] == 3
+    storage.delete_chat(c2, 1)
+    storage.toggle_fav_char(1, char_id)
+    st = storage.get_user_char_stats(1, char_id)
+    assert (st["chat_count"], st["message_count"], st["is_fav"]) == (1, 2, 0)
+
+    storage.delete_chat(c1, 1)
+    st = storage.get_user_char_stats(1, char_id)
+    assert (st["chat_count"], st["message_count"], st["last_use"]) == (0, 0, None)
+
+
+def test_migration_fills_stats(tmp_path: Path):
+    db = tmp_path / "db.sqlite"
+    storage.init(db)
+    _populate()
+    before = storage.query("SELECT * FROM user_char_stats ORDER BY user_id, char_id")
+    storage._exec("DROP TABLE user_char_stats")
+    storage._exec("DELETE FROM schema_version WHERE version >= 6")
+    storage.close()
+
+    storage.init(db)
+    after = storage.query("SELECT * FROM user_char_stats ORDER BY user_id, char_id")
+    key = lambda r: (r["user_id"], r["char_id"], r["chat_count"], r["message_count"], r["is_fav"])
+    assert [key(r) for r in after] == [key(r) for r in before]
@@ -0,0 +1,120 @@
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from app import storage
+
+
+def _trace(statements):
+    for c in [storage._conn, *storage._reader_conns]:
+        c.set_trace_callback(statements.append)
+
+
+def _counters(uid: int):
+    r = storage.query("SELECT * FROM user_counters WHERE user_id=?", (uid,))
+    return dict(r[0]) if r else None
+
+
+def test_counters_follow_write_paths(tmp_path: Path):
+    storage.init(tmp_path / "db.sqlite")
+    storage.ensure_user(1, "u")
+    a = storage.ensure_character("A")
+    b = storage.ensure_character("B")
+    c1 = storage.create_chat(1, a)
+    c2 = storage.create_chat(1, b)
+    storage.add_message(c1, is_user=True, content="hi")
+    storage.add_message(c1, is_user=False, content="yo", usage_in=3, usage_out=4)
+    storage.add_message(c2, is_user=False, content="yo")
+    storage.add_message(c2, is_user=False, content="yo")
+
+    statements: list[str] = []
+    _trace(statements)
+    t = storage.user_totals(1)
+    assert not any("messages" in s or "FROM chats" in s for s in statements)
+    assert t == dict(
+        user_msgs=1, ai_msgs=3, in_tokens=3, out_tokens=4, chats=2, top_character="B", top_count=2
+    )
+
+    storage.compress_history(c1, "summary", usage_in=1, usage_out=1)
+    assert storage.user_totals(1)["ai_msgs"] == 3  # сводка — не ответ модели
+    assert storage.delete_chat(c2, 1)
+    assert storage.delete_chat(c2, 1) is False
+    # удалённый чат уходит из профиля целиком, топ переходит к оставшимся
+    assert storage.user_totals(1) == dict(
+        user_msgs=1, ai_msgs=1, in_tokens=3, out_tokens=4, chats=1, top_character="A", top_count=1
+    )
+    storage.archive_chat(c1)
+    assert storage.delete_chat(c1, 1)
+    assert storage.user_totals(1) == dict(
+        user_msgs=0, ai_msgs=0, in_tokens=0, out_tokens=0, chats=0, top_character=None, top_count=0
+    )
+
+
+def test_rebuild_repairs_counters(tmp_path: Path):
+    storage.init(tmp_path / "db.sqlite")
+    for uid in (1, 2):
+        storage.ensure_user(uid, f"u{uid}")
+    a = storage.ensure_character("A")
+    chat = storage.create_chat(1, a)
+    storage.add_message(chat, is_user=False, content="yo", usage_in=5, usage_out=6)
+    expected = _counters(1)
+
+    storage._exec("UPDATE user_counters SET ai_msgs=99, chat_count=7, top_char_id=NULL")
+    assert storage.rebuild_user_counters(1) == 1
+    assert _counters(1) == expected
+
+    storage._exec("DELETE FROM user_counters")
+    assert storage.rebuild_user_counters() == 2
+    assert _counters(1) == expected
+    assert _counters(2)["chat_count"] == 0
+
+
+def _populate_archived() -> None:
+    storage.ensure_user(1, "u")
+    a = storage.ensure_character("A")
+    b = storage.ensure_character("B")
+    live, cold, gone = (storage.create_chat(1, c) for c in (a, b, b))
+    storage.add_message(live, is_user=True, content="hi")
+    storage.add_message(live, is_user=False, content="yo", usage_in=5, usage_out=6)
+    for chat in (cold, gone):
+        for _ in range(2):
+            storage.add_message(chat, is_user=False, content="yo", usage_in=1, usage_out=2)
+    storage.archive_chat(cold)
+    storage.delete_chat(gone, 1)
+
+
+def test_rebuild_counts_live_and_archived_chats(tmp_path: Path):
+    storage.init(tmp_path / "db.sqlite")
+    _populate_archived()
+    expected = _counters(1)
+    assert (expected["ai_msgs"], expected["in_tokens"], expected["chat_count"], expected["top_count"]) == (3, 7, 2, 2)
+
+    storage._exec("UPDATE chats SET user_msgs=0, ai_msgs=0, in_tokens=0, out_tokens=0")
+    storage._exec("DELETE FROM user_counters")
+    assert storage.rebuild_user_counters(1) == 1
+    assert _counters(1) == expected
+    storage._exec("UPDATE chats SET ai_msgs=9")
+    assert storage.rebuild_user_counters() == 1
+    assert _counters(1) == expected
+
+
+@pytest.mark.parametrize("split", [False, True])
+def test_migration_fills_chat_totals(tmp_path: Path, monkeypatch, split):
+    monkeypatch.setattr(
+        storage, "settings", SimpleNamespace(storage=SimpleNamespace(split_history=split, migrate_batch=1))
+    )
+    db = tmp_path / "db.sqlite"
+    storage.init(db)
+    _populate_archived()
+    expected = _counters(1)
+    # база до итогов в чатах: счётчики ещё накопительные
+    for col in storage._CHAT_TOTAL_COLS:
+        storage._exec(f"ALTER TABLE chats DROP COLUMN {col}")
+    storage._exec("UPDATE user_counters SET ai_msgs=ai_msgs + 2")
+    storage._exec("DELETE FROM schema_version WHERE version >= 12")
+    storage.close()
+
+    storage.init(db)
+    assert _counters(1) == expected
+    assert not storage.query("SELECT 1 FROM schema_backfill")
@@ -0,0 +1,99 @@
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from app import storage
+
+
+def _settings(ms: int, rows: int):
+    return SimpleNamespace(storage=SimpleNamespace(write_behind_ms=ms, write_behind_rows=rows))
+
+
+def _raw(sql: str, params=()):
+    with storage._conn_lock:
+        return storage._conn.execute(sql, params).fetchall()
+
+
+def test_deferred_writes_visible_and_flushed_on_close(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(storage, "settings", _settings(60_000, 10_000))
+    db = tmp_path / "db.sqlite"
+    storage.init(db)
+    storage.ensure_user(1, "u")
+
+    storage.touch_activity(1)
+    storage.set_user_chatting(1, True)
+    storage.log_broadcast_sent(1)
+    storage.log_proactive(1, 5, 7, "free")
+
+    # nothing committed yet, but readers see the pending values
+    assert _raw("SELECT is_chatting FROM users WHERE tg_id=1")[0][0] == 0
+    assert storage.is_user_chatting(1)
+    u = storage.get_user(1)
+    assert u["is_chatting"] == 1 and u["last_activity_at"] and u["last_proactive_at"]
+    assert storage.proactive_count_today(1) == 1
+    assert storage.write_behind_stats()["pending"] == 5
+
+    storage.close()
+    storage.init(db)
+    assert _raw("SELECT is_chatting FROM users WHERE tg_id=1")[0][0] == 1
+    assert _raw("SELECT COUNT(*) FROM broadcast_log")[0][0] == 1
+    assert _raw("SELECT kind FROM proactive_log")[0][0] == "free"
+    assert storage.proactive_count_today(1) == 1
+
+
+def test_flush_by_row_count_is_one_transaction(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(storage, "settings", _settings(60_000, 50))
+    storage.init(tmp_path / "db.sqlite")
+    commits = []
+    storage._conn.set_trace_callback(lambda s: commits.append(s) if s == "COMMIT" else None)
+
+    for uid in range(50):
+        storage.log_broadcast_sent(uid)
+
+    storage._conn.set_trace_callback(None)
+    assert _raw("SELECT COUNT(*) FROM broadcast_log")[0][0] == 50
+    assert len(commits) == 1
+    st = storage.write_behind_stats()
+    assert st["pending"] == 0 and st["flushes"] >= 1 and st["last_ms"] > 0
+
+
+def test_flush_by_timer(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(storage, "settings", _settings(20, 10_000))
+    storage.init(tmp_path / "db.sqlite")
+    storage.ensure_user(1, "u")
+    storage.set_user_chatting(1, True)
+    deadline = time.monotonic() + 2
+    while storage.write_behind_stats()["pending"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert _raw("SELECT is_chatting FROM users WHERE tg_id=1")[0][0] == 1
+
+
+def test_disabled_writes_through(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(storage, "settings", _settings(0, 10))
+    storage.init(tmp_path / "db.sqlite")
+    storage.ensure_user(1, "u")
+    storage.set_user_chatting(1, True)
+    assert _raw("SELECT is_chatting FROM users WHERE tg_id=1")[0][0] == 1
+    assert storage.write_behind_stats()["pending"] == 0
+
+
+def test_cached_reads_and_deferred_writes_do_not_deadlock(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(storage, "settings", _settings(60_000, 10_000))
+    storage.init(tmp_path / "db.sqlite")
+    storage.ensure_user(1, "u")
+    storage.get_user(1)  # строка в кэше — get_user идёт по ветке попадания
+
+    def loop(fn):
+        for _ in range(3000):
+            fn(1)
+
+    threads = [
+        threading.Thread(target=loop, args=(fn,), daemon=True)
+        for fn in (storage.get_user, storage.touch_activity) * 3
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=20)
+    assert not any(t.is_alive() for t in threads), "get_user / _wb_put deadlock"